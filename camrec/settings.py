@@ -37,7 +37,27 @@ load_dotenv()
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 LOGFILE = BASE_DIR / 'logs' / 'recording.log'
+# Ротация системного лога службы записи: по размеру и по времени
+LOG_MAX_SIZE_MB = int(os.environ.get('LOG_MAX_SIZE_MB', 50))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 7))
+LOG_ROTATE_HOURS = int(os.environ.get('LOG_ROTATE_HOURS', 24))
+LOG_JSON = os.environ.get('LOG_JSON', '').strip().casefold() in {'true', '1'}  # строки JSON вместо текста
 SEGMENT_FORMAT = 'ts'
+# Служебные файлы службы записи (снимок состояния для веб-интерфейса)
+RUN_DIR = Path(os.environ.get('RUN_DIR', BASE_DIR / 'run'))
+# Живой просмотр: короткие HLS-части потоков; лучше держать в tmpfs (например, /dev/shm/camrec-live)
+LIVE_DIR = Path(os.environ.get('LIVE_DIR', RUN_DIR / 'live'))
+# Токен для /metrics (Authorization: Bearer <токен>); без него метрики доступны только персоналу
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Готовые выгрузки (кэш результатов фоновых задач): объём в GB, старые по последнему скачиванию удаляются
+EXPORT_DIR = Path(os.environ.get('EXPORT_DIR', BASE_DIR / 'exports'))
+EXPORT_CACHE_GB = float(os.environ.get('EXPORT_CACHE_GB', 20))
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 2))  # одновременных выгрузок в службе записи
+# Ретрансляция потоков службой записи (HTTP, MPEG-TS): порт 0 — выключена
+RELAY_HOST = os.environ.get('RELAY_HOST', '127.0.0.1')
+RELAY_PORT = int(os.environ.get('RELAY_PORT', 8554))
+# Токен клиентов ретрансляции (?token=<токен>); пустой — без проверки
+RELAY_TOKEN = os.environ.get('RELAY_TOKEN', '')
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -92,6 +112,8 @@ JAZZMIN_SETTINGS = {
         "auth.Group": "fas fa-users",
         "recorder.Stream": "fas fa-video",
         "recorder.System": "fas fa-cogs",
+        "recorder.Segment": "fas fa-film",
+        "recorder.StreamGroup": "fas fa-layer-group",
         "admin.LogEntry": "fas fa-file-alt",
         "sessions.Session": "fas fa-satellite-dish",
     },
@@ -4,9 +4,10 @@ from django.contrib.sessions.models import Session
 from django.contrib.admin.models import LogEntry
 from django.http import HttpResponseRedirect
 from django.urls import reverse
+from django.utils.http import urlencode
 
 from .forms import StreamActionForm
-from .models import Stream, System
+from .models import ExportJob, Segment, StorageTask, Stream, StreamGroup, System, trigger_exports, trigger_restart
 
 
 @admin.register(Session)
@@ -39,12 +40,18 @@ class SystemAdmin(admin.ModelAdmin):
         return False
 
 
+@admin.register(StreamGroup)
+class StreamGroupAdmin(ModelAdmin):
+    list_display = ('name', 'max_age_days', 'max_size_gb')
+    search_fields = ('name',)
+
+
 @admin.register(Stream)
 class StreamAdmin(ModelAdmin):
-    list_display = ('__str__', 'segment_duration', 'loglevel', 'created_at')
+    list_display = ('__str__', 'group', 'segment_duration', 'loglevel', 'max_age_days', 'max_size_gb', 'created_at')
     search_fields = ('host', 'login')
-    actions = ('set_segment_duration', 'set_loglevel', 'delete_selected')
-    list_filter = ('loglevel',)
+    actions = ('set_segment_duration', 'set_loglevel', 'export_archive', 'delete_selected')
+    list_filter = ('group', 'loglevel')
     action_form = StreamActionForm
 
     fieldsets = (
@@ -57,7 +64,16 @@ class StreamAdmin(ModelAdmin):
             'description': 'Логин и пароль для доступа к видеопотоку камеры.'
         }),
         ('Настройки записи и логирования', {
-            'fields': ('segment_duration', 'loglevel')
+            'fields': ('segment_duration', 'loglevel', 'live_preview', 'relay_enabled')
+        }),
+        ('Лог ffmpeg', {
+            'classes': ('collapse',),
+            'fields': ('log_mode', 'log_max_size_mb', 'log_backup_count', 'log_compress'),
+            'description': 'Изменения применяются без перезапуска записи.'
+        }),
+        ('Хранение записей', {
+            'fields': ('group', 'max_age_days', 'max_size_gb'),
+            'description': 'Ограничения проверяются службой записи раз в минуту, независимо от свободного места.'
         }),
     )
 
@@ -67,6 +83,7 @@ class StreamAdmin(ModelAdmin):
             try:
                 value = int(value)
                 updated = queryset.update(segment_duration=value)
+                trigger_restart()
                 self.message_user(request, f"Обновлена длительность сегмента до {value} для {updated} потоков")
             except ValueError:
                 self.message_user(request, "Некорректное число", level=messages.ERROR)
@@ -77,6 +94,72 @@ class StreamAdmin(ModelAdmin):
     def set_loglevel(self, request, queryset):
         if value := request.POST.get('loglevel'):
             updated = queryset.update(loglevel=value)
+            trigger_restart()
             self.message_user(request, f"Установлен уровень логирования {value!r} для {updated} потоков")
         else:
             self.message_user(request, "Выберите уровень логирования", level=messages.ERROR)
+
+
+    @admin.action(description="Выгрузить архив выбранных камер")
+    def export_archive(self, request, queryset):
+        params = [('stream', pk) for pk in queryset.values_list('pk', flat=True)]
+        return HttpResponseRedirect(f"{reverse('archive-export')}?{urlencode(params)}")
+
+
+@admin.register(Segment)
+class SegmentAdmin(ModelAdmin):
+    list_display = ('__str__', 'stream', 'start', 'end', 'size')
+    list_filter = ('stream',)
+    date_hierarchy = 'start'
+    readonly_fields = ('stream', 'start', 'end', 'size', 'path')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(StorageTask)
+class StorageTaskAdmin(ModelAdmin):
+    list_display = ('__str__', 'target', 'status', 'files_done', 'bytes_done', 'bytes_total', 'updated_at')
+    list_filter = ('kind', 'status')
+    readonly_fields = ('kind', 'source', 'target', 'status', 'files_total', 'bytes_total', 'files_done',
+                       'bytes_done', 'error', 'created_at', 'updated_at')
+    actions = ('retry',)
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description="Повторить задачу")
+    def retry(self, request, queryset):
+        updated = queryset.filter(status='failed').update(status='running', error='')
+        trigger_restart()
+        self.message_user(request, f"Повторно запущено задач: {updated}")
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(ModelAdmin):
+    list_display = ('__str__', 'status', 'size', 'created_by', 'created_at', 'accessed_at')
+    list_filter = ('format', 'status')
+    readonly_fields = ('key', 'streams', 'start', 'end', 'format', 'status', 'bytes_total', 'bytes_done', 'size',
+                       'error', 'created_by', 'created_at', 'updated_at', 'accessed_at')
+    actions = ('retry', 'delete_selected')
+
+    def has_add_permission(self, request):
+        return False
+
+    def delete_queryset(self, request, queryset):
+        for job in queryset:
+            job.result_path.unlink(missing_ok=True)
+        super().delete_queryset(request, queryset)
+
+    def delete_model(self, request, obj):
+        obj.result_path.unlink(missing_ok=True)
+        super().delete_model(request, obj)
+
+    @admin.action(description="Повторить выгрузку")
+    def retry(self, request, queryset):
+        updated = queryset.filter(status__in=('failed', 'expired')).update(status='pending', error='')
+        trigger_exports()
+        self.message_user(request, f"Повторно поставлено в очередь выгрузок: {updated}")
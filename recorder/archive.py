@@ -0,0 +1,271 @@
+"""Отдача архива: чтение сегментов крупными блоками с упреждением, раскладка склеенного тела для Range,
+перепаковка в фрагментированный MP4 на лету."""
+import asyncio
+import hashlib
+import logging
+import os
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+
+from .tsindex import TS_PACKET, load_index
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_CHUNK = 1 << 20  # байт за одно чтение
+ARCHIVE_READ_AHEAD = 4  # чтений в очереди впереди отдаваемого блока
+ARCHIVE_READ_WORKERS = 8  # потоков чтения на все одновременные загрузки
+REMUX_CHUNK = 256 << 10  # байт за одно чтение вывода ffmpeg
+REMUX_STDERR_LIMIT = 4096  # последних байт сообщений ffmpeg, попадающих в лог при ошибке
+# Фрагмент на каждый ключевой кадр, пустой moov в начале: файл отдаётся по мере перепаковки
+FMP4_MOVFLAGS = 'frag_keyframe+empty_moov+default_base_moof'
+
+# Без pread (Windows) блоки одного файла читаются строго по очереди
+_HAS_PREAD = hasattr(os, 'pread')
+
+FilePart = Tuple[str, int, Optional[int]]  # путь, смещение, длина (None — до конца файла)
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Отдельный пул: загрузки архива не занимают потоки sync_to_async и asyncio.to_thread."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(ARCHIVE_READ_WORKERS, thread_name_prefix='archive-read')
+    return _executor
+
+
+def _open(path: str) -> Tuple[int, int]:
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)  # ядро читает вперёд агрессивнее
+    return fd, os.fstat(fd).st_size
+
+
+def _read_at(fd: int, size: int, offset: int) -> bytes:
+    if _HAS_PREAD:
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def _close_after(fd: int, pending):
+    """Закрывает файл, когда завершатся уже начатые чтения (иначе номер fd может достаться другому файлу)."""
+    if not pending:
+        os.close(fd)
+        return
+    asyncio.gather(*pending, return_exceptions=True).add_done_callback(lambda _: os.close(fd))
+
+
+async def read_parts(parts: Iterable[FilePart], chunk_size: int = ARCHIVE_CHUNK,
+                     read_ahead: int = ARCHIVE_READ_AHEAD) -> AsyncIterator[bytes]:
+    """Отдаёт содержимое частей файлов по порядку.
+
+    Пока клиент получает очередной блок, следующие read_ahead блоков уже читаются
+    на пуле потоков, поэтому диск не простаивает между отправками. Файл, удалённый
+    очисткой до открытия, пропускается; открытый файл дочитывается до конца.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _get_executor()
+    depth = max(read_ahead, 1) if _HAS_PREAD else 1
+    for path, offset, length in parts:
+        try:
+            fd, size = await loop.run_in_executor(pool, _open, path)
+        except FileNotFoundError:
+            continue
+        pending = deque()
+        try:
+            end = size if length is None else min(size, offset + length)
+            position = offset
+            while pending or position < end:
+                while position < end and len(pending) < depth:
+                    size_to_read = min(chunk_size, end - position)
+                    pending.append(loop.run_in_executor(pool, _read_at, fd, size_to_read, position))
+                    position += size_to_read
+                data = await pending.popleft()
+                if not data:
+                    break
+                yield data
+        finally:
+            _close_after(fd, pending)
+
+
+async def read_parts_padded(parts: Iterable[FilePart], **kwargs) -> AsyncIterator[bytes]:
+    """Ровно заявленные длины частей: файл, удалённый или укороченный во время отдачи, дополняется нулями.
+
+    Иначе тело окажется короче уже отправленного Content-Length, а данные следующих частей
+    сдвинутся относительно смещений, по которым клиент докачивает файл. Длина каждой части обязательна.
+    """
+    for part in parts:
+        left = part[2]
+        async for data in read_parts((part,), **kwargs):
+            left -= len(data)
+            yield data
+        if left:
+            logger.warning(f"Файл {part[0]} изменился во время отдачи: недостающие {left} байт заполнены нулями.")
+        while left > 0:
+            size = min(left, ARCHIVE_CHUNK)
+            left -= size
+            yield bytes(size)
+
+
+def read_files(paths: Iterable, **kwargs) -> AsyncIterator[bytes]:
+    """Содержимое файлов целиком, один за другим."""
+    return read_parts(((str(path), 0, None) for path in paths), **kwargs)
+
+
+class ArchiveLayout:
+    """Части файлов как одно тело ответа: таблица накопленных смещений для запросов Range."""
+    __slots__ = ('files', 'offsets', 'length', 'etag')
+
+    def __init__(self, files: List[Tuple[str, int, int]]):
+        self.files = files
+        self.offsets = [0]
+        for _path, _offset, length in files:
+            self.offsets.append(self.offsets[-1] + length)
+        self.length = self.offsets[-1]
+        digest = hashlib.blake2b(repr(files).encode(), digest_size=12).hexdigest()
+        self.etag = f'"{digest}"'
+
+    @classmethod
+    def from_segments(cls, segments: Iterable[Tuple[str, int, datetime, Optional[datetime]]],
+                      start: Optional[datetime] = None, end: Optional[datetime] = None) -> 'ArchiveLayout':
+        """По строкам индекса (путь, размер, начало, конец): размер записываемого сегмента берётся с диска.
+
+        Если задан период, крайние сегменты MPEG-TS обрезаются по ключевым кадрам:
+        первый — с последнего кадра не позже start, последний — до первого кадра не раньше end.
+        """
+        files = []
+        for path, size, segment_start, segment_end in segments:
+            if segment_end is None:
+                try:
+                    size = os.stat(path).st_size
+                except FileNotFoundError:
+                    continue
+            head = (start - segment_start).total_seconds() if start and start > segment_start else 0
+            tail = (end - segment_start).total_seconds() if end and (segment_end is None or segment_end > end) else None
+            if head or tail is not None:
+                files.extend(_trim(path, size, head, tail))
+            elif size:
+                files.append((path, 0, size))
+        return cls(files)
+
+    def parts(self, start: int = 0, end: Optional[int] = None) -> List[FilePart]:
+        """Части файлов для байт [start, end) склеенного тела."""
+        end = self.length if end is None else min(end, self.length)
+        parts = []
+        index = bisect_right(self.offsets, start) - 1
+        while start < end and index < len(self.files):
+            part_start, part_end = self.offsets[index], self.offsets[index + 1]
+            if part_end > start:
+                path, offset, _length = self.files[index]
+                length = min(end, part_end) - start
+                parts.append((path, offset + start - part_start, length))
+                start += length
+            index += 1
+        return parts
+
+
+def _trim(path: str, size: int, head: float, tail: Optional[float]) -> List[Tuple[str, int, int]]:
+    """Части сегмента между ключевыми кадрами около head и tail (секунды от начала сегмента).
+
+    Перед данными с середины файла отдаются пакеты PAT и PMT из его начала.
+    Если ключевые кадры не найдены, сегмент отдаётся целиком.
+    """
+    index = load_index(path)
+    if index is None:
+        return [(path, 0, size)]  # файл пропал: read_parts пропустит его, отдача с длиной дополнит нулями
+    cut_from = index.offset_before(head) or 0 if head else 0
+    cut_to = index.offset_after(tail) if tail is not None else None
+    cut_to = size if cut_to is None or cut_to <= cut_from else min(cut_to, size)
+    files = []
+    if cut_from:
+        files.extend((path, table, TS_PACKET) for table in index.tables)
+    files.append((path, cut_from, cut_to - cut_from))
+    return files
+
+
+def parse_range(header: str, length: int) -> Optional[Tuple[int, int]]:
+    """Разбирает одиночный диапазон 'bytes=a-b' / 'bytes=a-' / 'bytes=-n' в [начало, конец).
+
+    None — заголовок не поддерживается (например, несколько диапазонов): отдаётся всё тело.
+    ValueError — диапазон за пределами тела (ответ 416).
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = (part.strip() for part in spec.partition('-'))
+    if not sep or not (first or last) or not (first.isdigit() or not first) or not (last.isdigit() or not last):
+        return None
+    if not first:
+        suffix = int(last)
+        if suffix == 0 or length == 0:
+            raise ValueError(header)
+        return max(length - suffix, 0), length
+    start = int(first)
+    end = int(last) + 1 if last else length
+    if start >= length or end <= start:
+        raise ValueError(header)
+    return start, min(end, length)
+
+
+def _remux_args(input_format: Optional[str]) -> List[str]:
+    return [
+        'ffmpeg', '-hide_banner', '-nostdin', '-nostats', '-loglevel', 'error',
+        *(('-f', input_format) if input_format else ()),
+        '-i', 'pipe:0',
+        # Только видео и звук: потоки данных из камер MP4 не примет
+        '-map', '0:v', '-map', '0:a?',
+        '-c', 'copy',
+        '-f', 'mp4', '-movflags', FMP4_MOVFLAGS,
+        'pipe:1',
+    ]
+
+
+async def _read_tail(stream: asyncio.StreamReader, limit: int) -> bytes:
+    """Читает поток до конца и возвращает последние limit байт: ffmpeg не блокируется на записи в stderr."""
+    tail = b''
+    while data := await stream.read(limit):
+        tail = (tail + data)[-limit:]
+    return tail
+
+
+async def remux_fmp4(chunks: AsyncIterator[bytes], input_format: Optional[str] = 'mpegts') -> AsyncIterator[bytes]:
+    """Перепаковывает поток байт в фрагментированный MP4 без перекодирования.
+
+    Вход подаётся в ffmpeg с ожиданием drain, вывод читается блоками по REMUX_CHUNK,
+    поэтому память не зависит от длины выгрузки, а первые байты уходят клиенту,
+    как только готов первый фрагмент. Если клиент отключился, ffmpeg завершается.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *_remux_args(input_format), stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+
+    async def feed():
+        try:
+            async for chunk in chunks:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg завершился раньше: причина будет в его сообщениях
+        finally:
+            process.stdin.close()
+
+    feeder = asyncio.create_task(feed())
+    errors = asyncio.create_task(_read_tail(process.stderr, REMUX_STDERR_LIMIT))
+    try:
+        while data := await process.stdout.read(REMUX_CHUNK):
+            yield data
+        await feeder
+        if await process.wait():
+            message = (await errors).decode('UTF-8', 'replace').strip()
+            logger.error(f"Перепаковка архива в MP4 завершилась с кодом {process.returncode}: {message}")
+    finally:
+        feeder.cancel()
+        errors.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
@@ -0,0 +1,208 @@
+"""Выгрузка нескольких камер одним архивом ZIP или TAR без сжатия.
+
+Размеры записей известны по индексу сегментов, поэтому заголовки и длина всего
+архива вычисляются до отправки первого байта: ответ идёт с Content-Length,
+данные читаются и отдаются блоками, память не зависит от объёма выгрузки.
+"""
+import logging
+import struct
+import tarfile
+import zlib
+from datetime import datetime
+from pathlib import PurePath
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+
+from django.utils import timezone
+
+from .archive import ARCHIVE_CHUNK, ArchiveLayout, read_parts
+
+logger = logging.getLogger(__name__)
+
+ZIP_VERSION = 20  # версия для распаковки: хранение без сжатия
+ZIP64_VERSION = 45  # версия для записей и архивов больше 4 GB
+ZIP_MADE_BY = 3 << 8 | ZIP64_VERSION  # Unix: права файлов берутся из внешних атрибутов
+ZIP_FLAGS = 1 << 3 | 1 << 11  # CRC в дескрипторе после данных, имена в UTF-8
+ZIP_EXTERNAL_ATTR = 0o100644 << 16
+ZIP_LIMIT = 0xFFFFFFFF  # больше — только через ZIP64
+ZIP_ENTRIES_LIMIT = 0xFFFF
+TAR_BLOCK = tarfile.BLOCKSIZE
+
+_LOCAL = struct.Struct('<IHHHHHIIIHH')
+_CENTRAL = struct.Struct('<IHHHHHHIIIHHHHHII')
+_DESCRIPTOR = struct.Struct('<IIII')
+_DESCRIPTOR64 = struct.Struct('<IIQQ')
+_END = struct.Struct('<IHHHHIIH')
+_END64 = struct.Struct('<IQHHIIQQQQ')
+_LOCATOR64 = struct.Struct('<IIQI')
+
+SegmentRow = Tuple[str, int, datetime, Optional[datetime]]  # путь, размер, начало, конец
+
+
+class BundleEntry:
+    """Файл архива: имя, части файлов сегмента (уже обрезанные по периоду) и время изменения."""
+    __slots__ = ('name', 'layout', 'mtime')
+
+    def __init__(self, name: str, layout: ArchiveLayout, mtime: datetime):
+        self.name = name
+        self.layout = layout
+        self.mtime = mtime
+
+    @property
+    def size(self) -> int:
+        return self.layout.length
+
+
+def entries_from_segments(folder: str, segments: Iterable[SegmentRow], start: Optional[datetime] = None,
+                          end: Optional[datetime] = None) -> List[BundleEntry]:
+    """Записи каталога folder: по одной на сегмент; с периодом крайние сегменты обрезаются по ключевым кадрам."""
+    entries = []
+    for row in segments:
+        layout = ArchiveLayout.from_segments((row,), start, end)
+        if layout.length:
+            entries.append(BundleEntry(f'{folder}/{PurePath(row[0]).name}', layout, row[2]))
+    return entries
+
+
+async def _entry_data(entry: BundleEntry) -> AsyncIterator[bytes]:
+    """Ровно entry.size байт: файл, удалённый очисткой во время выгрузки, дополняется нулями,
+    иначе заявленная длина и смещения в архиве разойдутся с данными."""
+    left = entry.size
+    async for data in read_parts(entry.layout.parts()):
+        left -= len(data)
+        yield data
+    if left:
+        logger.warning(f"Файл {entry.name} изменился во время выгрузки: недостающие {left} байт заполнены нулями.")
+    while left > 0:
+        size = min(left, ARCHIVE_CHUNK)
+        left -= size
+        yield bytes(size)
+
+
+def _dos_time(moment: datetime) -> Tuple[int, int]:
+    moment = timezone.localtime(moment) if timezone.is_aware(moment) else moment
+    if moment.year < 1980:
+        return 0, 1 << 5 | 1  # 1980-01-01 00:00
+    return (moment.hour << 11 | moment.minute << 5 | moment.second // 2,
+            (moment.year - 1980) << 9 | moment.month << 5 | moment.day)
+
+
+class ZipBundle:
+    """ZIP без сжатия; ZIP64 включается только там, где размеры или смещения не помещаются в 32 бита."""
+    __slots__ = ('entries', 'headers', 'offsets', 'central_offset', 'length')
+    content_type = 'application/zip'
+    extension = 'zip'
+
+    def __init__(self, entries: List[BundleEntry]):
+        self.entries = entries
+        self.headers, self.offsets = [], []
+        position = 0
+        for entry in entries:
+            header = self._local_header(entry)
+            self.headers.append(header)
+            self.offsets.append(position)
+            position += len(header) + entry.size + self._descriptor_size(entry)
+        self.central_offset = position
+        central_size = sum(len(self._central_record(entry, offset, 0))
+                           for entry, offset in zip(entries, self.offsets))
+        self.length = position + central_size + len(self._end_records(central_size))
+
+    @staticmethod
+    def _is_zip64(entry: BundleEntry) -> bool:
+        return entry.size >= ZIP_LIMIT
+
+    def _descriptor_size(self, entry: BundleEntry) -> int:
+        return (_DESCRIPTOR64 if self._is_zip64(entry) else _DESCRIPTOR).size
+
+    def _local_header(self, entry: BundleEntry) -> bytes:
+        name = entry.name.encode()
+        size, extra, version = entry.size, b'', ZIP_VERSION
+        if self._is_zip64(entry):
+            extra = struct.pack('<HHQQ', 1, 16, size, size)
+            size, version = ZIP_LIMIT, ZIP64_VERSION
+        dos_time, dos_date = _dos_time(entry.mtime)
+        return _LOCAL.pack(0x04034b50, version, ZIP_FLAGS, 0, dos_time, dos_date, 0, size, size,
+                           len(name), len(extra)) + name + extra
+
+    def _descriptor(self, entry: BundleEntry, crc: int) -> bytes:
+        if self._is_zip64(entry):
+            return _DESCRIPTOR64.pack(0x08074b50, crc, entry.size, entry.size)
+        return _DESCRIPTOR.pack(0x08074b50, crc, entry.size, entry.size)
+
+    @staticmethod
+    def _central_record(entry: BundleEntry, offset: int, crc: int) -> bytes:
+        name = entry.name.encode()
+        size, extra = entry.size, []
+        if size >= ZIP_LIMIT:
+            extra += [size, size]
+            size = ZIP_LIMIT
+        if offset >= ZIP_LIMIT:
+            extra.append(offset)
+            offset = ZIP_LIMIT
+        extra = struct.pack(f'<HH{len(extra)}Q', 1, 8 * len(extra), *extra) if extra else b''
+        version = ZIP64_VERSION if extra else ZIP_VERSION
+        dos_time, dos_date = _dos_time(entry.mtime)
+        return _CENTRAL.pack(0x02014b50, ZIP_MADE_BY, version, ZIP_FLAGS, 0, dos_time, dos_date, crc, size, size,
+                             len(name), len(extra), 0, 0, 0, ZIP_EXTERNAL_ATTR, offset) + name + extra
+
+    def _end_records(self, central_size: int) -> bytes:
+        count, offset = len(self.entries), self.central_offset
+        records = b''
+        if count >= ZIP_ENTRIES_LIMIT or offset >= ZIP_LIMIT or central_size >= ZIP_LIMIT:
+            end64_offset = offset + central_size
+            records = (_END64.pack(0x06064b50, _END64.size - 12, ZIP_MADE_BY, ZIP64_VERSION, 0, 0, count, count,
+                                   central_size, offset)
+                       + _LOCATOR64.pack(0x07064b50, 0, end64_offset, 1))
+            count, central_size, offset = (min(count, ZIP_ENTRIES_LIMIT), min(central_size, ZIP_LIMIT),
+                                           min(offset, ZIP_LIMIT))
+        return records + _END.pack(0x06054b50, 0, 0, count, count, central_size, offset, 0)
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        crcs = []
+        for entry, header in zip(self.entries, self.headers):
+            yield header
+            crc = 0
+            async for data in _entry_data(entry):
+                crc = zlib.crc32(data, crc)
+                yield data
+            crcs.append(crc)
+            yield self._descriptor(entry, crc)
+        central = b''.join(self._central_record(entry, offset, crc)
+                           for entry, offset, crc in zip(self.entries, self.offsets, crcs))
+        yield central + self._end_records(len(central))
+
+
+class TarBundle:
+    """TAR (PAX: длинные имена и файлы больше 8 GB) без сжатия."""
+    __slots__ = ('entries', 'headers', 'length')
+    content_type = 'application/x-tar'
+    extension = 'tar'
+
+    def __init__(self, entries: List[BundleEntry]):
+        self.entries = entries
+        self.headers = [self._header(entry) for entry in entries]
+        self.length = sum(len(header) + entry.size + self._padding(entry)
+                          for entry, header in zip(entries, self.headers)) + 2 * TAR_BLOCK
+
+    @staticmethod
+    def _padding(entry: BundleEntry) -> int:
+        return -entry.size % TAR_BLOCK
+
+    @staticmethod
+    def _header(entry: BundleEntry) -> bytes:
+        info = tarfile.TarInfo(entry.name)
+        info.size = entry.size
+        info.mtime = int(entry.mtime.timestamp())
+        info.mode = 0o644
+        return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        for entry, header in zip(self.entries, self.headers):
+            yield header
+            async for data in _entry_data(entry):
+                yield data
+            if padding := self._padding(entry):
+                yield bytes(padding)
+        yield bytes(2 * TAR_BLOCK)
+
+
+BUNDLE_FORMATS = {'zip': ZipBundle, 'tar': TarBundle}
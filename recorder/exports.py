@@ -0,0 +1,190 @@
+"""Фоновые выгрузки архива: задачи в БД, выполнение в службе записи, кэш готовых файлов.
+
+Веб-процесс только ставит задачу (или находит готовую с тем же ключом) и отдаёт результат
+с диска; чтение архива и перепаковка в MP4 идут в службе записи на ограниченном пуле,
+поэтому закрытая вкладка не прерывает работу, а повторный запрос не повторяет её.
+Кэш ограничен EXPORT_CACHE_GB: сверх него удаляются давно не запрашивавшиеся файлы.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from datetime import datetime
+from typing import AsyncIterator, Iterable, List, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .archive import ArchiveLayout, read_parts, remux_fmp4
+from .bundle import BUNDLE_FORMATS, BundleEntry, entries_from_segments
+from .models import ExportJob, Stream, trigger_exports
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHECKPOINT_INTERVAL = 1  # секунд между сохранениями прогресса
+EXPORT_CONTENT_TYPES = {
+    'raw': 'video/mp2t',
+    'mp4': 'video/mp4',
+    'zip': BUNDLE_FORMATS['zip'].content_type,
+    'tar': BUNDLE_FORMATS['tar'].content_type,
+}
+
+
+def export_key(stream_pks: Iterable[int], start: datetime, end: datetime, export_format: str) -> str:
+    """Ключ кэша: одинаковые потоки, период и формат — одна и та же выгрузка."""
+    streams = ','.join(str(pk) for pk in sorted(set(stream_pks)))
+    raw = f'{export_format}|{streams}|{start.timestamp():.0f}|{end.timestamp():.0f}'
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+
+def stream_layout(stream: Stream, start: datetime, end: datetime) -> ArchiveLayout:
+    """Записи потока за период одним телом; сегменты MPEG-TS обрезаются по ключевым кадрам."""
+    segments = stream.segments_in_range(start, end).values_list('path', 'size', 'start', 'end')
+    if settings.SEGMENT_FORMAT == 'ts':
+        return ArchiveLayout.from_segments(segments, start, end)
+    return ArchiveLayout.from_segments(segments)
+
+
+def collect_entries(streams: Iterable[Stream], start: datetime, end: datetime) -> List[BundleEntry]:
+    """Файлы архива нескольких камер: каталог на камеру, файл на сегмент."""
+    trim = settings.SEGMENT_FORMAT == 'ts'
+    entries = []
+    for stream in streams:
+        segments = stream.segments_in_range(start, end).values_list('path', 'size', 'start', 'end')
+        folder = f"{stream.pk}_{stream.host}_{stream.login}"
+        entries.extend(entries_from_segments(folder, segments, *((start, end) if trim else ())))
+    return entries
+
+
+def _is_reusable(job: ExportJob) -> bool:
+    """Идущая задача с тем же ключом — общая. Готовый файл годится для повторной отдачи, если период
+    закончился до постановки задачи (иначе в нём нет записей, сделанных позже) и файл ещё не вытеснен из кэша;
+    иначе ставится новая задача со своим файлом."""
+    if job.status in ExportJob.ACTIVE_STATUSES:
+        return True
+    return job.status == 'done' and job.end <= job.created_at and job.result_path.exists()
+
+
+def request_export(streams: List[Stream], start: datetime, end: datetime, export_format: str,
+                   user=None) -> Tuple[ExportJob, bool]:
+    """Задача выгрузки: уже идущая или готовая с тем же ключом, иначе новая в очереди службы.
+
+    Возвращает задачу и признак того, что она создана.
+    """
+    key = export_key((stream.pk for stream in streams), start, end, export_format)
+    for job in ExportJob.objects.filter(key=key, status__in=ExportJob.ACTIVE_STATUSES + ('done',)):
+        if _is_reusable(job):
+            touch(job)
+            return job, False
+    job = ExportJob.objects.create(key=key, start=start, end=end, format=export_format,
+                                   created_by=user if user and user.is_authenticated else None)
+    job.streams.set(streams)
+    trigger_exports()
+    return job, True
+
+
+def touch(job: ExportJob):
+    """Отмечает обращение к результату для вытеснения по LRU (без изменения updated_at)."""
+    job.accessed_at = timezone.now()
+    ExportJob.objects.filter(pk=job.pk).update(accessed_at=job.accessed_at)
+
+
+def evict(limit_bytes: int, keep: Iterable[int] = ()) -> Tuple[int, int]:
+    """Удаляет давно не запрашивавшиеся результаты, пока кэш больше limit_bytes. Возвращает (файлов, байт).
+
+    Задачи из keep (только что готовые) не удаляются, даже если одни больше предела:
+    их результат ещё не успели скачать.
+    """
+    jobs = list(ExportJob.objects.filter(status='done').order_by('accessed_at'))
+    total = sum(job.size for job in jobs)
+    keep = set(keep)
+    files = freed = 0
+    for job in jobs:
+        if total <= limit_bytes:
+            break
+        if job.pk in keep:
+            continue
+        total -= job.size
+        job.result_path.unlink(missing_ok=True)
+        job.status = 'expired'
+        job.save(update_fields=['status', 'updated_at'])
+        files += 1
+        freed += job.size
+    return files, freed
+
+
+class Export:
+    """Выполнение одной задачи выгрузки: файл пишется рядом с результатом и переименовывается в конце.
+
+    Прогресс — по прочитанным байтам архива (для MP4 — по входу ffmpeg), сохраняется раз
+    в EXPORT_CHECKPOINT_INTERVAL. Задача, прерванная остановкой службы, при следующем запуске
+    выполняется заново.
+    """
+    __slots__ = ('job', 'checkpoint_at')
+
+    def __init__(self, job: ExportJob):
+        self.job = job
+        self.checkpoint_at = 0.0
+
+    def _begin(self) -> AsyncIterator[bytes]:
+        """Готовит источник данных: работает с БД и индексами кадров, поэтому вне цикла событий."""
+        job = self.job
+        streams = list(job.streams.order_by('pk'))
+        if not streams:
+            raise ValueError("Потоки выгрузки удалены.")
+        if job.format in BUNDLE_FORMATS:
+            source = BUNDLE_FORMATS[job.format](collect_entries(streams, job.start, job.end))
+            if not source.entries:
+                raise ValueError("За указанный период записи не найдены.")
+            total, chunks = source.length, source.stream()
+        else:
+            layout = stream_layout(streams[0], job.start, job.end)
+            if not layout.length:
+                raise ValueError("За указанный период записи не найдены.")
+            total, chunks = layout.length, read_parts(layout.parts())
+        job.status, job.bytes_total, job.bytes_done, job.error = 'running', total, 0, ''
+        job.save(update_fields=['status', 'bytes_total', 'bytes_done', 'error', 'updated_at'])
+        return chunks
+
+    async def _counted(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        job = self.job
+        async for data in chunks:
+            job.bytes_done += len(data)
+            if time.monotonic() - self.checkpoint_at >= EXPORT_CHECKPOINT_INTERVAL:
+                self.checkpoint_at = time.monotonic()
+                await sync_to_async(job.save)(update_fields=['bytes_done', 'updated_at'])
+            yield data
+
+    def _finish(self, size: int):
+        job = self.job
+        job.status, job.size, job.bytes_done = 'done', size, job.bytes_total
+        job.accessed_at = timezone.now()
+        job.save(update_fields=['status', 'size', 'bytes_done', 'accessed_at', 'updated_at'])
+
+    async def run(self):
+        job = self.job
+        chunks = self._counted(await sync_to_async(self._begin)())
+        if job.format == 'mp4':
+            chunks = remux_fmp4(chunks, 'mpegts' if settings.SEGMENT_FORMAT == 'ts' else None)
+        path = job.result_path
+        part = path.with_name(f'{path.name}.part')
+        await asyncio.to_thread(path.parent.mkdir, parents=True, exist_ok=True)
+        logger.info(f"Выгрузка {job} ({job.pk}) начата: {job.bytes_total / (1 << 20):.1f} MB.")
+        out = await asyncio.to_thread(open, part, 'wb')
+        try:
+            async for data in chunks:
+                await asyncio.to_thread(out.write, data)
+            await asyncio.to_thread(out.close)
+            if job.format == 'mp4' and not os.path.getsize(part):
+                raise RuntimeError("ffmpeg не создал MP4, подробности в логе службы.")
+            await asyncio.to_thread(os.replace, part, path)
+        except BaseException:
+            out.close()
+            part.unlink(missing_ok=True)
+            await chunks.aclose()  # завершает ffmpeg перепаковки и чтение архива
+            raise
+        size = path.stat().st_size
+        await sync_to_async(self._finish)(size)
+        logger.info(f"Выгрузка {job} ({job.pk}) готова: {size / (1 << 20):.1f} MB.")
@@ -1,4 +1,5 @@
 from django import forms
+from django.conf import settings
 
 from recorder.models import Stream
 
@@ -12,6 +13,40 @@ class ArchivePeriodForm(forms.Form):
         label="Конец",
         widget=forms.DateTimeInput(attrs={"type": "datetime-local", "class": "form-control"})
     )
+    format = forms.ChoiceField(
+        label="Формат",
+        choices=(
+            ('raw', f"Как записано (.{settings.SEGMENT_FORMAT})"),
+            ('mp4', "MP4 (фрагментированный, удобнее перематывать)"),
+        ),
+        initial='raw',
+        widget=forms.Select(attrs={"class": "form-select"})
+    )
+
+
+class ArchiveExportForm(forms.Form):
+    streams = forms.ModelMultipleChoiceField(
+        label="Камеры",
+        queryset=Stream.objects.select_related('group').order_by('group__name', 'host'),
+        widget=forms.CheckboxSelectMultiple(attrs={"class": "form-check-input"})
+    )
+    start = forms.DateTimeField(
+        label="Начало",
+        widget=forms.DateTimeInput(attrs={"type": "datetime-local", "class": "form-control"})
+    )
+    end = forms.DateTimeField(
+        label="Конец",
+        widget=forms.DateTimeInput(attrs={"type": "datetime-local", "class": "form-control"})
+    )
+    format = forms.ChoiceField(
+        label="Формат",
+        choices=(
+            ('zip', "ZIP (без сжатия)"),
+            ('tar', "TAR"),
+        ),
+        initial='zip',
+        widget=forms.Select(attrs={"class": "form-select"})
+    )
 
 
 class StreamActionForm(forms.Form):
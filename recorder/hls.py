@@ -0,0 +1,107 @@
+"""HLS VOD поверх архива MPEG-TS: плейлист из диапазонов байт сегментов по ключевым кадрам, без копирования."""
+import math
+import os
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from django.utils import timezone
+
+from .tsindex import TS_PACKET, load_index
+
+HLS_PART_DURATION = 6  # секунд: части плейлиста набираются из ключевых кадров до этой длины
+HLS_VERSION = 6  # EXT-X-MAP в обычном плейлисте требует версии 6
+
+SegmentRow = Tuple[int, str, int, datetime, Optional[datetime]]  # pk, путь, размер, начало, конец
+
+
+class Part:
+    """Часть плейлиста: диапазон байт файла сегмента, начало (секунды от начала сегмента) и длительность."""
+    __slots__ = ('offset', 'length', 'time', 'duration')
+
+    def __init__(self, offset: int, length: int, time: float, duration: float):
+        self.offset = offset
+        self.length = length
+        self.time = time
+        self.duration = duration
+
+
+def _segment_parts(path: str, size: int, duration: Optional[float], head: float, tail: Optional[float]):
+    """Части одного сегмента между ключевыми кадрами около head и tail и диапазон его PAT/PMT.
+
+    Записываемый сегмент (duration — None) отдаётся до последнего ключевого кадра:
+    дальше кадр ещё не дописан. Без индекса сегмент — одна часть целиком.
+    """
+    index = load_index(path)
+    if index is None:
+        return None, []
+    times, offsets = index.key_times, index.key_offsets
+    if not offsets:
+        if duration is None:
+            return None, []
+        return None, [Part(0, size, 0, duration)]
+    first = max(bisect_right(times, head) - 1, 0)
+    if tail is not None and (last := bisect_left(times, tail)) < len(times):
+        end_offset, end_time = offsets[last], times[last]
+    elif duration is not None:
+        last, end_offset, end_time = len(times), size, duration
+    else:
+        last = len(times) - 1
+        end_offset, end_time = offsets[last], times[last]
+    parts = []
+    i = first
+    while i < last:
+        j = i + 1
+        while j < last and times[j] - times[i] < HLS_PART_DURATION:
+            j += 1
+        part_end, part_end_time = (offsets[j], times[j]) if j < last else (end_offset, end_time)
+        if part_end > offsets[i]:
+            parts.append(Part(offsets[i], part_end - offsets[i], times[i], max(part_end_time - times[i], 0.001)))
+        i = j
+    tables = None
+    if index.tables:
+        tables = (min(index.tables), max(index.tables) + TS_PACKET - min(index.tables))
+    return tables, parts
+
+
+def build_playlist(segments: Iterable[SegmentRow], start: datetime, end: datetime,
+                   segment_url: Callable[[int], str]) -> Optional[str]:
+    """Плейлист VOD за период. Каждый файл сегмента начинается с EXT-X-DISCONTINUITY
+    (метки времени ffmpeg сбрасывает на каждом сегменте), EXT-X-MAP с его PAT/PMT
+    и EXT-X-PROGRAM-DATE-TIME. None — за период нечего показать."""
+    body: List[str] = []
+    longest = 0.0
+    for pk, path, size, segment_start, segment_end in segments:
+        if segment_end is None:
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                continue
+        duration = (segment_end - segment_start).total_seconds() if segment_end else None
+        head = max((start - segment_start).total_seconds(), 0)
+        tail = (end - segment_start).total_seconds() if segment_end is None or segment_end > end else None
+        tables, parts = _segment_parts(path, size, duration, head, tail)
+        if not parts:
+            continue
+        uri = segment_url(pk)
+        if body:
+            body.append('#EXT-X-DISCONTINUITY')
+        if tables:
+            body.append(f'#EXT-X-MAP:URI="{uri}",BYTERANGE="{tables[1]}@{tables[0]}"')
+        program_time = timezone.localtime(segment_start) + timedelta(seconds=parts[0].time)
+        body.append(f'#EXT-X-PROGRAM-DATE-TIME:{program_time.isoformat(timespec="milliseconds")}')
+        for part in parts:
+            longest = max(longest, part.duration)
+            body.append(f'#EXTINF:{part.duration:.3f},')
+            body.append(f'#EXT-X-BYTERANGE:{part.length}@{part.offset}')
+            body.append(uri)
+    if not body:
+        return None
+    header = [
+        '#EXTM3U',
+        f'#EXT-X-VERSION:{HLS_VERSION}',
+        f'#EXT-X-TARGETDURATION:{math.ceil(longest)}',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+        '#EXT-X-MEDIA-SEQUENCE:0',
+    ]
+    return '\n'.join(header + body + ['#EXT-X-ENDLIST', ''])
@@ -0,0 +1,76 @@
+"""Минимальная обёртка над inotify(7) через ctypes (только Linux)."""
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+from typing import List, Tuple
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+_READ_SIZE = 64 * 1024
+
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        _libc.inotify_init1, _libc.inotify_add_watch, _libc.inotify_rm_watch  # noqa
+    except (OSError, AttributeError):
+        _libc = None
+
+
+class Inotify:
+    """Неблокирующий дескриптор inotify, пригодный для ``loop.add_reader``."""
+    __slots__ = ('fd',)
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError("inotify недоступен на этой платформе.")
+        self.fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    @staticmethod
+    def available() -> bool:
+        return _libc is not None
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def add_watch(self, path, mask: int) -> int:
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), str(path))
+        return wd
+
+    def rm_watch(self, wd: int):
+        _libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> List[Tuple[int, int, str]]:
+        """Возвращает накопившиеся события как (wd, mask, имя файла)."""
+        try:
+            data = os.read(self.fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
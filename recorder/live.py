@@ -0,0 +1,46 @@
+"""Живой просмотр: второй выход того же ffmpeg, что пишет архив, — короткий HLS в каталоге в памяти.
+
+Камера отдаёт один поток на запись и на всех зрителей; части плейлиста живут в LIVE_DIR
+(tmpfs) кольцом из LIVE_LIST_SIZE файлов, старые ffmpeg удаляет сам.
+"""
+import re
+import shutil
+from pathlib import Path
+from typing import List
+
+from django.conf import settings
+
+LIVE_DIR: Path = settings.LIVE_DIR
+LIVE_PLAYLIST = 'index.m3u8'
+LIVE_SEGMENT_TIME = 1  # секунд на часть; ffmpeg режет по ключевым кадрам, поэтому фактически — по GOP камеры
+LIVE_LIST_SIZE = 6  # частей в плейлисте
+LIVE_SEGMENT_NAME = re.compile(r'\d+\.ts')
+
+
+def live_dir(stream_pk: int) -> Path:
+    return LIVE_DIR / str(stream_pk)
+
+
+def live_output_args(stream_pk: int) -> List[str]:
+    """Аргументы второго выхода ffmpeg: HLS без перекодирования с кольцом частей в каталоге потока."""
+    out_dir = live_dir(stream_pk)
+    return [
+        "-c", "copy",
+        "-f", "hls",
+        "-hls_time", str(LIVE_SEGMENT_TIME),
+        "-hls_list_size", str(LIVE_LIST_SIZE),
+        "-hls_delete_threshold", "1",
+        "-hls_flags", "delete_segments+omit_endlist+temp_file+program_date_time+independent_segments",
+        "-hls_segment_filename", str(out_dir / '%d.ts'),
+        str(out_dir / LIVE_PLAYLIST),
+    ]
+
+
+def reset_live_dir(stream_pk: int):
+    """Пустой каталог перед запуском ffmpeg: части прошлого запуска плееру не нужны."""
+    remove_live_dir(stream_pk)
+    live_dir(stream_pk).mkdir(parents=True, exist_ok=True)
+
+
+def remove_live_dir(stream_pk: int):
+    shutil.rmtree(live_dir(stream_pk), ignore_errors=True)
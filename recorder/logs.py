@@ -0,0 +1,278 @@
+"""Логи службы записи: ротация логов ffmpeg и системного лога, кольцевой буфер в памяти."""
+import copy
+import gzip
+import logging
+import os
+import re
+import shutil
+import time
+from collections import deque
+from logging.handlers import QueueHandler, RotatingFileHandler
+from pathlib import Path
+from typing import List, Optional
+
+import ujson as json
+
+from django.conf import settings
+
+from .status import write_atomic
+
+LOG_NAME = 'ffmpeg.log'
+RING_LINES = 2000  # строк лога в памяти в режиме кольцевого буфера
+RING_DIR: Path = settings.RUN_DIR / 'logs'  # сюда служба сбрасывает буферы для веб-интерфейса
+
+# ffmpeg с -loglevel level+... помечает каждую строку уровнем: "[h264 @ 0x..] [error] ..."
+_LEVEL = re.compile(rb'\[(panic|fatal|error|warning|info|verbose|debug|trace)] ')
+WARNING_LEVELS = frozenset({b'panic', b'fatal', b'error', b'warning'})
+_BACKUP_SUFFIX = re.compile(r'\.\d+(\.gz)?')  # ротированные копии: ffmpeg.log.1, ffmpeg.log.2.gz, ...
+
+
+def line_level(line: bytes) -> Optional[bytes]:
+    match = _LEVEL.search(line)
+    return match[1] if match else None
+
+
+def ring_path(stream_pk: int) -> Path:
+    """Файл, в который служба сбрасывает кольцевой буфер лога потока."""
+    return RING_DIR / f'{stream_pk}.log'
+
+
+class RotatingLog:
+    """Файл лога с ротацией по размеру: ffmpeg.log, ffmpeg.log.1[.gz], ... ffmpeg.log.N[.gz]."""
+    __slots__ = ('path', 'max_bytes', 'backup_count', 'compress', 'file', 'size')
+
+    def __init__(self, path: Path, max_bytes: int = 0, backup_count: int = 0, compress: bool = False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.file = open(path, 'ab')
+        self.size = self.file.tell()
+
+    def _append(self, data: bytes) -> bool:
+        self.file.write(data)
+        self.size += len(data)
+        if not self.max_bytes or self.size < self.max_bytes:
+            return False
+        # Лог могли очистить из веб-интерфейса: файл открыт на дозапись, поэтому верен только его размер
+        self.file.flush()
+        self.size = os.fstat(self.file.fileno()).st_size
+        return self.size >= self.max_bytes
+
+    def write(self, data: bytes) -> bool:
+        """Дописывает данные. True — файл превысил предел и его пора ротировать."""
+        rotate = self._append(data)
+        self.file.flush()
+        return rotate
+
+    def write_lines(self, lines: List[bytes]):
+        """Дописывает пачку строк с ротацией и одним сбросом буфера (блокирующая операция)."""
+        for line in lines:
+            if self._append(line):
+                self.rotate()
+        self.file.flush()
+
+    def _backup(self, index: int) -> Path:
+        return self.path.with_name(f'{self.path.name}.{index}{".gz" if self.compress else ""}')
+
+    def rotate(self):
+        """Сдвигает старые файлы и начинает новый (блокирующая операция, выполняется в отдельном потоке)."""
+        self.file.close()
+        if self.backup_count:
+            self._backup(self.backup_count).unlink(missing_ok=True)
+            for index in range(self.backup_count - 1, 0, -1):
+                if self._backup(index).exists():
+                    os.replace(self._backup(index), self._backup(index + 1))
+            if self.compress:
+                with open(self.path, 'rb') as src, gzip.open(self._backup(1), 'wb', compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst)
+                self.path.unlink()
+            else:
+                os.replace(self.path, self._backup(1))
+        # На дозапись, как при открытии: после очистки из веб-интерфейса запись продолжается с начала файла
+        self.file = open(self.path, 'ab')
+        self.file.truncate(0)  # без копий файл начинается заново
+        self.size = 0
+
+    def close(self):
+        self.file.close()
+
+
+class LogRing:
+    """Лог в памяти: последние строки хранятся в буфере, на диск пишутся только предупреждения и ошибки."""
+    __slots__ = ('lines', 'disk', 'dirty', 'dumped')
+
+    def __init__(self, disk: RotatingLog, size: int = RING_LINES):
+        self.lines = deque(maxlen=size)
+        self.disk = disk
+        self.dirty = False
+        self.dumped = 0  # байт в файле веб-интерфейса после последнего сброса
+
+    def write(self, data: bytes) -> bool:
+        self.lines.append(data)
+        self.dirty = True
+        if line_level(data) in WARNING_LEVELS:
+            return self.disk.write(data)
+        return False
+
+    def write_lines(self, lines: List[bytes]):
+        self.lines.extend(lines)
+        self.dirty = True
+        self.disk.write_lines([line for line in lines if line_level(line) in WARNING_LEVELS])
+
+    def rotate(self):
+        self.disk.rotate()
+
+    def snapshot(self) -> bytes:
+        """Содержимое буфера для сброса в файл веб-интерфейса."""
+        self.dirty = False
+        return b''.join(self.lines)
+
+    def dump(self, path: Path, force: bool = False):
+        """Сбрасывает буфер в файл веб-интерфейса, если он изменился (блокирующая операция).
+
+        Файл, укороченный после прошлого сброса, очищен из веб-интерфейса — тогда очищается и буфер.
+        """
+        try:
+            cleared = os.stat(path).st_size < self.dumped
+        except FileNotFoundError:
+            cleared = bool(self.dumped)
+        if cleared:
+            self.lines.clear()
+            self.dumped = 0
+        if self.dirty or force:
+            data = self.snapshot()
+            write_atomic(path, data)
+            self.dumped = len(data)
+
+    def close(self):
+        self.disk.close()
+
+
+def clear_log(path: Path):
+    """Очищает лог и удаляет его ротированные копии.
+
+    Файл укорачивается, а не удаляется: пишущий процесс держит его открытым на дозапись
+    и продолжает писать в тот же файл, сверяя с ним свой счётчик размера перед ротацией.
+    """
+    path.open('wb').close()
+    for backup in path.parent.glob(f'{path.name}.*'):
+        if _BACKUP_SUFFIX.fullmatch(backup.name[len(path.name):]):
+            backup.unlink(missing_ok=True)
+
+
+def open_stream_log(stream, out_dir: Path):
+    """Создаёт приёмник лога ffmpeg по настройкам потока."""
+    disk = RotatingLog(out_dir / LOG_NAME, stream.log_max_size_mb << 20, stream.log_backup_count,
+                       stream.log_compress)
+    return LogRing(disk) if stream.log_mode == 'ring' else disk
+
+
+class SizeTimeRotatingFileHandler(RotatingFileHandler):
+    """Ротация по размеру и по времени: файл сменяется, что бы ни наступило раньше."""
+
+    def __init__(self, filename, max_bytes: int = 0, backup_count: int = 0, interval: float = 0,
+                 encoding: str = 'UTF-8'):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding)
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+
+    def shouldRollover(self, record) -> bool:
+        if self.interval and time.time() >= self.rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, escape_forward_slashes=False)
+
+
+class LogQueueHandler(QueueHandler):
+    """Кладёт записи в очередь, не форматируя их: исключение остаётся в exc_info для форматтера приёмника.
+
+    Стандартный QueueHandler.prepare склеивает трассировку с сообщением и очищает exc_info,
+    и JsonFormatter уже не может вынести её в поле exc.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # Аргументы подставляются сразу: изменяемые объекты могут поменяться до вывода в потоке приёмника
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+
+# --- Чтение логов для веб-интерфейса ---
+
+TAIL_BLOCK = 64 << 10  # байт за одно чтение с конца файла
+TAIL_MAX_BYTES = 4 << 20  # больше за один запрос с конца не читаем
+
+
+def read_tail(path: Path, lines: int = 200, before: Optional[int] = None,
+              max_bytes: int = TAIL_MAX_BYTES) -> dict:
+    """Последние lines строк файла, заканчивающиеся перед смещением before (по умолчанию — конец файла).
+
+    Файл читается с конца блоками, не больше max_bytes, поэтому стоимость не зависит
+    от размера лога. Возвращает текст и его смещения для постраничной загрузки назад.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        end = size if before is None else min(max(before, 0), size)
+        pos, chunks, newlines = end, [], 0
+        while pos > 0 and newlines <= lines and end - pos < max_bytes:
+            step = min(TAIL_BLOCK, pos, max_bytes - (end - pos))
+            pos -= step
+            f.seek(pos)
+            chunk = f.read(step)
+            chunks.append(chunk)
+            newlines += chunk.count(b'\n')
+    data = b''.join(reversed(chunks))
+    index = len(data) - 1 if data.endswith(b'\n') else len(data)
+    for _ in range(lines):
+        index = data.rfind(b'\n', 0, index)
+        if index < 0:
+            break
+    if index >= 0:
+        start = index + 1
+    elif pos > 0:
+        # Прочитан не весь файл: неполную первую строку отбрасываем
+        start = data.find(b'\n') + 1
+    else:
+        start = 0
+    return {'text': data[start:].decode('UTF-8', 'replace'), 'start': pos + start, 'end': end, 'size': size}
+
+
+def read_new(path: Path, offset: int, inode: Optional[int], limit: int = TAIL_MAX_BYTES):
+    """Полные строки, дописанные начиная с offset: (данные, смещение их начала, inode файла).
+
+    Если файл заменён (ротация, сброс буфера) или укорочен, чтение начинается с нуля —
+    вызывающий узнаёт об этом по смещению, отличному от переданного.
+    """
+    with open(path, 'rb') as f:
+        stat_result = os.fstat(f.fileno())
+        if stat_result.st_ino != inode or stat_result.st_size < offset:
+            offset = 0
+        f.seek(offset)
+        data = f.read(min(limit, stat_result.st_size - offset))
+    cut = data.rfind(b'\n') + 1
+    if cut:
+        data = data[:cut]  # неполная последняя строка придёт в следующий раз
+    elif len(data) < limit:
+        data = b''
+    return data, offset, stat_result.st_ino
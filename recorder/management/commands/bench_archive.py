@@ -0,0 +1,71 @@
+import asyncio
+import os
+import time
+from pathlib import Path
+from typing import List
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recorder.archive import ARCHIVE_CHUNK, ARCHIVE_READ_AHEAD, read_files
+from recorder.models import Stream
+
+MB_DIVIDER = 1 << 20
+LEGACY_CHUNK = 8192  # прежняя отдача: 8 KB на каждый переход в поток
+
+
+async def _legacy(files: List[Path]):
+    for file_path in files:
+        with await asyncio.to_thread(open, file_path, 'rb') as f:
+            while chunk := await asyncio.to_thread(f.read, LEGACY_CHUNK):
+                yield chunk
+
+
+async def _consume(body) -> int:
+    total = 0
+    async for chunk in body:
+        total += len(chunk)
+    return total
+
+
+class Command(BaseCommand):
+    help = ("Замеряет скорость отдачи архива: крупные блоки с упреждением против прежнего чтения по 8 KB. "
+            "Для замера с диска, а не из кэша, сбросьте кэш страниц перед запуском "
+            "(sync; echo 3 > /proc/sys/vm/drop_caches).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="Файлы или каталоги сегментов")
+        parser.add_argument('--stream', type=int, help="Взять все сегменты потока из индекса")
+        parser.add_argument('--chunk', type=int, default=ARCHIVE_CHUNK, help="Размер блока, байт")
+        parser.add_argument('--read-ahead', type=int, default=ARCHIVE_READ_AHEAD, help="Блоков читать наперёд")
+        parser.add_argument('--legacy', action='store_true', help="Также замерить прежнее чтение по 8 KB")
+
+    def handle(self, *args, **options):
+        files = self._collect(options)
+        if not files:
+            raise CommandError("Нет файлов для замера.")
+        size = sum(f.stat().st_size for f in files)
+        self.stdout.write(f"Файлов: {len(files)}, объём: {size / MB_DIVIDER:.1f} MB")
+        runs = [(
+            f"Блоки {options['chunk'] // 1024} KB, упреждение {options['read_ahead']}",
+            lambda: read_files(files, chunk_size=options['chunk'], read_ahead=options['read_ahead'])
+        )]
+        if options['legacy']:
+            runs.append(("Прежнее чтение по 8 KB", lambda: _legacy(files)))
+        for label, body in runs:
+            started = time.perf_counter()
+            total = asyncio.run(_consume(body()))
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"{label}: {total / MB_DIVIDER / elapsed:.0f} MB/s ({elapsed:.2f} с)")
+
+    @staticmethod
+    def _collect(options) -> List[Path]:
+        if options['stream']:
+            stream = Stream.objects.filter(pk=options['stream']).first()
+            if stream is None:
+                raise CommandError(f"Поток {options['stream']} не найден.")
+            return [Path(path) for path in stream.segments.order_by('start').values_list('path', flat=True)
+                    if os.path.exists(path)]
+        files = []
+        for path in map(Path, options['paths']):
+            files.extend(sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path])
+        return files
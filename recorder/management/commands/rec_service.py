@@ -1,66 +1,221 @@
+import asyncio
+import csv
+import os
+import random
+import signal
 import time
 import subprocess
 import shutil
 import logging
+from contextlib import suppress
+from logging.handlers import QueueListener
+from queue import SimpleQueue
+from datetime import datetime, timedelta, timezone as dt_timezone
 from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
 
+from asgiref.sync import sync_to_async
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
-from recorder.models import Stream, System
+from recorder import inotify
+from recorder.exports import Export, evict
+from recorder.models import ExportJob, Segment, StorageTask, Stream, System
+from recorder.live import live_output_args, remove_live_dir, reset_live_dir
+from recorder.logs import (JsonFormatter, LogQueueHandler, LogRing, SizeTimeRotatingFileHandler, open_stream_log,
+                          ring_path)
+from recorder.relay import RelayHub, pump
+from recorder.retention import RetentionEngine
+from recorder.status import IngestStats, STATUS_FILE, write_status
+from recorder.storage import Deletion, Relocation
+from recorder.tsindex import write_sidecar
 
 GB_DIVIDER = 1 << 30
 SEGMENT_FORMAT = settings.SEGMENT_FORMAT
+SEGMENT_INDEX_INTERVAL = 30  # секунд между проверками новых сегментов (без inotify)
+FLAG_POLL_INTERVAL = 2  # секунд между проверками флагов (без inotify)
+DISK_CHECK_INTERVAL = 10  # секунд между проверками свободного места
+RETENTION_INTERVAL = 60  # секунд между проверками сроков хранения и квот потоков
+EMERGENCY_FREE_GB = 1  # запись останавливается, только если удалять нечего и места меньше этого
+RESTART_BACKOFF_BASE = 1  # секунд до первого автоматического перезапуска ffmpeg
+RESTART_BACKOFF_MAX = 60  # предел задержки между перезапусками
+RESTART_STABLE_TIME = 60  # после стольких секунд работы счётчик неудач сбрасывается
+STALL_CHECK_INTERVAL = 5  # секунд между проверками зависших ffmpeg
+STATUS_INTERVAL = 2  # секунд между обновлениями снимка состояния для веб-интерфейса
+LOG_FLUSH_INTERVAL = 1  # секунд: дольше строки лога ffmpeg в памяти не задерживаются
+LOG_FLUSH_BYTES = 64 << 10  # накопленный вывод ffmpeg такого объёма пишется, не дожидаясь интервала
+CONTROL_FLAGS = frozenset({'stop.flag', 'restart.flag', 'export.flag'})
+STORAGE_JOBS = {'mv': Relocation, 'rm': Deletion}
+CONTROL_MASK = inotify.IN_CLOSE_WRITE | inotify.IN_ATTRIB | inotify.IN_MOVED_TO
+SEGMENT_MASK = inotify.IN_CREATE | inotify.IN_MOVED_TO
 logger = logging.getLogger(__name__)
 
 
-def setup_logging(logfile_path: Path):
-    """Настраивает глобальное логирование в консоль и в файл."""
+def setup_logging(logfile_path: Path) -> QueueListener:
+    """Настраивает логирование в консоль и в файл с ротацией.
+
+    Логгеры только кладут записи в очередь, а вывод выполняет отдельный поток
+    QueueListener: цикл событий не ждёт диск, на котором идёт запись видео.
+    """
     log_dir = logfile_path.parent
     log_dir.mkdir(parents=True, exist_ok=True)
 
     # Определяем формат сообщений
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-
-    # Очищаем предыдущие обработчики, чтобы избежать дублирования логов
-    logger.handlers.clear()
-    logger.setLevel(logging.INFO)
+    formatter = JsonFormatter() if settings.LOG_JSON else logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
     # Обработчик для вывода в консоль
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
 
-    # Обработчик для записи в файл
-    file_handler = logging.FileHandler(logfile_path, encoding='UTF-8')
+    # Обработчик для записи в файл: ротация по размеру и по времени
+    file_handler = SizeTimeRotatingFileHandler(
+        logfile_path, settings.LOG_MAX_SIZE_MB << 20, settings.LOG_BACKUP_COUNT, settings.LOG_ROTATE_HOURS * 3600)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+
+    # Настраиваем логгер всего приложения, чтобы в лог попадали и вспомогательные модули
+    app_logger = logging.getLogger('recorder')
+    # Очищаем предыдущие обработчики, чтобы избежать дублирования логов
+    app_logger.handlers.clear()
+    app_logger.setLevel(logging.INFO)
+    log_queue = SimpleQueue()
+    app_logger.addHandler(LogQueueHandler(log_queue))
+    listener = QueueListener(log_queue, console_handler, file_handler)
+    listener.start()
 
     logger.info(f"Логирование включено. Вывод в консоль и в файл: {logfile_path}")
+    return listener
+
+
+def _restart_delay(failures: int) -> float:
+    """Экспоненциальная задержка с джиттером, чтобы камеры не перезапускались синхронно."""
+    delay = min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_BASE * (1 << min(failures, 16)))
+    return random.uniform(delay / 2, delay)
+
+
+async def _pipe_reader(fd: int) -> asyncio.StreamReader:
+    """Неблокирующее чтение из файлового дескриптора канала в цикле событий."""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0))
+    return reader
+
+
+def _segment_end(stat_result: os.stat_result) -> datetime:
+    """Реальный конец сегмента — время последней записи в файл."""
+    return datetime.fromtimestamp(stat_result.st_mtime, tz=dt_timezone.utc)
 
 
 class StreamRecorder:
-    __slots__ = ('stream', 'process', 'logfile')
+    __slots__ = ('stream', 'process', 'log', 'log_config', 'out_dir', 'last_segment_name', 'watcher',
+                 'lister', 'meter', 'log_reader', 'wd', 'restarts', 'failures', 'started_at', 'on_segment_closed',
+                 'progress', 'progress_at', 'stats', 'bytes_written', 'last_segment_end', 'relay', 'relay_reader')
 
-    def __init__(self, stream: Stream):
+    def __init__(self, stream: Stream, records_dir: Path, on_segment_closed: Callable[[int, str, int], None] = None,
+                 relay: RelayHub = None):
         self.stream = stream
-        self.process = self.logfile = None
+        self.on_segment_closed = on_segment_closed
+        self.relay = relay
+        self.process = self.watcher = self.lister = self.meter = self.log_reader = self.wd = None
+        self.relay_reader = None
+        self.log = self.log_config = None
+        self.stats = IngestStats()
+        self.bytes_written = 0
+        self.last_segment_end = None
+        self.out_dir = stream.get_record_path(records_dir)
+        self.last_segment_name = ''
+        self.restarts = self.failures = 0
+        self.started_at = self.progress_at = 0.0
+        self.progress = None
+
+    @property
+    def fingerprint(self) -> tuple:
+        """Всё, от чего зависит команда ffmpeg: при изменении запись нужно перезапустить."""
+        stream = self.stream
+        return (stream.full_url(), stream.segment_duration, stream.loglevel, stream.live_preview,
+                self.relays, str(self.out_dir))
+
+    @property
+    def relays(self) -> bool:
+        """Отдаёт ли ffmpeg копию потока в ретрансляцию (включена в службе и у потока)."""
+        return self.relay is not None and self.stream.relay_enabled
+
+    @property
+    def is_running(self) -> bool:
+        return self.watcher is not None and not self.watcher.done()
+
+    def prepare(self):
+        """Создаёт каталог потока и дополняет индекс сегментов (синхронно, работает с БД)."""
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        if self.stream.live_preview:
+            reset_live_dir(self.stream.pk)
+        else:
+            remove_live_dir(self.stream.pk)
+        self.configure_log()
+        self.index_segments()
+        self.close_open_segments()  # остались от прошлого запуска ffmpeg
+
+    def configure_log(self):
+        """Открывает приёмник лога ffmpeg; при изменении настроек лога заменяет его без перезапуска записи."""
+        stream = self.stream
+        config = (stream.log_mode, stream.log_max_size_mb, stream.log_backup_count, stream.log_compress)
+        if self.log is not None and config == self.log_config:
+            return
+        if self.log is not None:
+            self.log.close()
+        self.log, self.log_config = open_stream_log(stream, self.out_dir), config
 
-    def start(self) -> bool:
-        out_dir = self.stream.record_path
-        out_dir.mkdir(parents=True, exist_ok=True)
-        self.close()
-        output_template = str(out_dir / f"%Y-%m-%d_%H-%M-%S.{SEGMENT_FORMAT}")
-        self.logfile = (out_dir / 'ffmpeg.log').open('w', encoding='UTF-8')
+    async def start(self) -> bool:
+        await sync_to_async(self.prepare)()
+        if not await self._spawn():
+            return False
+        self.watcher = asyncio.create_task(self._watch())
+        logger.info(f"Запись запущена: {self.stream} -> {self.out_dir}")
+        return True
+
+    async def _spawn(self) -> bool:
+        output_template = str(self.out_dir / f"%Y-%m-%d_%H-%M-%S.{SEGMENT_FORMAT}")
         url = self.stream.full_url()
         if not shutil.which('ffmpeg'):
             logger.critical('FFmpeg не найден.')
             return False
-        self.process = subprocess.Popen([
+        # Отдельный канал для -progress: stdout занят списком сегментов, stderr — логом
+        progress_r, progress_w = os.pipe()
+        # И ещё один — для копии потока в ретрансляцию
+        relay_r, relay_w = os.pipe() if self.relays else (None, None)
+        pass_fds = (progress_w,) if relay_w is None else (progress_w, relay_w)
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *self._ffmpeg_args(url, output_template, progress_w, relay_w),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=pass_fds
+            )
+        except BaseException:
+            os.close(progress_r)
+            if relay_r is not None:
+                os.close(relay_r)
+            raise
+        finally:
+            for fd in pass_fds:
+                os.close(fd)
+        self.stats = IngestStats()
+        self.meter = asyncio.create_task(self._read_progress(await _pipe_reader(progress_r)))
+        if relay_r is not None:
+            channel = self.relay.channel(self.stream.pk)
+            self.relay_reader = asyncio.create_task(pump(await _pipe_reader(relay_r), channel))
+        self.lister = asyncio.create_task(self._read_segment_list(self.process.stdout))
+        self.log_reader = asyncio.create_task(self._read_log(self.process.stderr))
+        self.started_at = self.progress_at = time.monotonic()
+        self.progress = None
+        return True
+
+    def _ffmpeg_args(self, url: str, output_template: str, progress_fd: int,
+                     relay_fd: Optional[int] = None) -> List[str]:
+        return [
             "ffmpeg",
             "-hide_banner",
-            "-loglevel", self.stream.loglevel,
+            # level+ помечает строки уровнем: по нему буфер в памяти отбирает, что писать на диск
+            "-loglevel", f"level+{self.stream.loglevel}",
             "-nostats",
+            "-progress", f"pipe:{progress_fd}",
             "-rtsp_transport", "tcp",
             "-i", url,
             "-c", "copy",
@@ -68,32 +223,265 @@ class StreamRecorder:
             "-segment_time", str(self.stream.segment_duration),
             "-reset_timestamps", "1",
             "-strftime", "1",
-            output_template, '-y'
-        ], stderr=self.logfile)
-        logger.info(f"Запись запущена: {self.stream} -> {out_dir}")
-        return True
+            # Закрытые сегменты с точной длительностью: имя,начало,конец (секунды потока)
+            "-segment_list", "pipe:1",
+            "-segment_list_type", "csv",
+            output_template,
+            # Тот же входной поток — во второй выход для живого просмотра
+            *(live_output_args(self.stream.pk) if self.stream.live_preview else ()),
+            # И в канал ретрансляции: клиенты получают поток без своих подключений к камере
+            *(("-c", "copy", "-f", "mpegts", f"pipe:{relay_fd}") if relay_fd is not None else ()),
+            '-y',
+        ]
+
+    async def _read_progress(self, reader: asyncio.StreamReader):
+        """Разбирает поток -progress ffmpeg в self.stats."""
+        stats = self.stats
+        async for line in reader:
+            stats.feed(line)
+
+    async def _read_log(self, stderr: asyncio.StreamReader):
+        """Передаёт вывод ffmpeg в приёмник лога пачками: запись и ротация выполняются в отдельном потоке."""
+        lines, size, deadline = [], 0, None
+        while True:
+            try:
+                if deadline is None:
+                    line = await stderr.readline()
+                else:
+                    line = await asyncio.wait_for(stderr.readline(), max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                line = None  # ffmpeg замолчал: накопленное пишется сразу, строка дочитается позже
+            if line:
+                lines.append(line)
+                size += len(line)
+                if deadline is None:
+                    deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+                if size < LOG_FLUSH_BYTES and time.monotonic() < deadline:
+                    continue
+            if lines:
+                try:
+                    await asyncio.to_thread(self.log.write_lines, lines)
+                except (OSError, ValueError):
+                    logger.error(f"Ошибка записи лога ffmpeg {self.stream}", exc_info=True)
+                lines, size, deadline = [], 0, None
+            if line == b'':
+                return
+
+    def status(self) -> dict:
+        """Состояние потока для снимка службы."""
+        process = self.process
+        return {
+            'name': str(self.stream),
+            'running': process is not None and process.returncode is None,
+            'pid': process.pid if process else None,
+            'uptime': time.monotonic() - self.started_at if process else 0,
+            'restarts': self.restarts,
+            'failures': self.failures,
+            'bytes_written': self.bytes_written,
+            'last_segment_end': self.last_segment_end,
+            'live': self.stream.live_preview,
+            'relay_clients': self.relay.clients(self.stream.pk) if self.relays else None,
+            'stats': self.stats.as_dict(),
+        }
+
+    async def _read_segment_list(self, stdout: asyncio.StreamReader):
+        """Читает список сегментов ffmpeg по мере закрытия файлов и фиксирует их в индексе."""
+        async for line in stdout:
+            for row in csv.reader((line.decode('UTF-8', 'replace'),)):
+                if len(row) < 3:
+                    continue
+                try:
+                    duration = float(row[2]) - float(row[1])
+                except ValueError:
+                    continue
+                try:
+                    await sync_to_async(self.finish_segment)(row[0], duration)
+                except Exception:
+                    logger.error(f"Ошибка записи сегмента {row[0]} в индекс {self.stream}", exc_info=True)
+
+    async def _drain_readers(self):
+        """Дожидается последних строк списка сегментов и лога завершившегося ffmpeg."""
+        readers = [task for task in (self.lister, self.log_reader) if task]
+        self.lister = self.log_reader = None
+        for task in readers:
+            with suppress(asyncio.CancelledError):
+                await task
+
+    async def _watch(self):
+        """Следит за своим ffmpeg и перезапускает только этот поток с нарастающей задержкой."""
+        while (process := self.process) is not None:
+            returncode = await process.wait()
+            if self.process is not process:
+                return  # остановлен намеренно
+            self.process = None
+            await self._drain_readers()
+            if time.monotonic() - self.started_at >= RESTART_STABLE_TIME:
+                self.failures = 0
+            delay = _restart_delay(self.failures)
+            self.failures += 1
+            logger.error(
+                f"FFmpeg для {self.stream} неожиданно завершился с кодом {returncode}. "
+                f"Перезапуск через {delay:.1f} с (подряд: {self.failures}, всего: {self.restarts + 1}).")
+            await sync_to_async(self.close_open_segments)()
+            await asyncio.sleep(delay)
+            self.restarts += 1
+            if not await self._spawn():
+                return
+
+    def _progress_marker(self):
+        """Метка прогресса записи: меняется, только пока ffmpeg записывает новые данные."""
+        stats = self.stats
+        if stats.updated:
+            # Блоки -progress приходят и при замёрзшем входе, поэтому важен не сам факт блока,
+            # а рост записанного объёма и времени выхода
+            return stats.total_size, stats.out_time
+        # Пока ffmpeg не прислал ни одного блока -progress — по размеру последнего сегмента
+        try:
+            return self.last_segment_name, os.stat(self.out_dir / self.last_segment_name).st_size
+        except (OSError, ValueError):
+            return self.last_segment_name, None
+
+    def is_stalled(self, timeout: float) -> bool:
+        """True, если работающий ffmpeg не записал ничего за последние timeout секунд."""
+        process = self.process
+        if process is None or process.returncode is not None:
+            return False
+        marker = self._progress_marker()
+        now = time.monotonic()
+        if marker != self.progress:
+            self.progress, self.progress_at = marker, now
+            return False
+        return now - self.progress_at >= timeout
 
-    def close(self):
-        """close logfile"""
-        if self.logfile and not self.logfile.closed:
-            self.logfile.close()
-            self.logfile = None
+    async def restart_stalled(self):
+        """Завершает зависший ffmpeg; перезапуск с задержкой выполнит _watch."""
+        process = self.process
+        if process is None or process.returncode is not None:
+            return
+        logger.warning(
+            f"FFmpeg для {self.stream} не записывает данные {time.monotonic() - self.progress_at:.0f} с. "
+            f"Перезапускаю запись потока.")
+        process.terminate()
+        try:
+            await asyncio.wait_for(asyncio.shield(process.wait()), timeout=5)
+        except asyncio.TimeoutError:
+            process.kill()
 
-    def stop(self):
-        self.close()
-        if self.process and self.process.poll() is None:
-            self.process.terminate()
+    def close(self):
+        """close log"""
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    async def stop(self):
+        process, self.process = self.process, None
+        if self.watcher:
+            self.watcher.cancel()
+            self.watcher = None
+        if process and process.returncode is None:
+            process.terminate()
             try:
-                self.process.wait(timeout=5)
+                await asyncio.wait_for(process.wait(), timeout=5)
                 logger.info(f"Запись остановлена: {self.stream}")
-            except subprocess.TimeoutExpired:
-                self.process.kill()
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
                 logger.warning(
                     f"Процесс записи для {self.stream} не ответил и был принудительно завершен.")
-            self.process = None
+        if self.meter:
+            self.meter.cancel()
+            self.meter = None
+        if self.relay_reader:
+            self.relay_reader.cancel()
+            self.relay_reader = None
+        await self._drain_readers()
+        if isinstance(self.log, LogRing):
+            await asyncio.to_thread(self.log.dump, ring_path(self.stream.pk), True)
+        self.close()
+        if self.stream.live_preview:
+            await asyncio.to_thread(remove_live_dir, self.stream.pk)
+        await sync_to_async(self.close_open_segments)()
 
-    def __del__(self):
-        self.stop()
+    def index_segments(self):
+        """Добавляет в индекс сегменты, появившиеся с прошлой проверки, обходя каталог потока."""
+        suffix = f'.{SEGMENT_FORMAT}'
+        try:
+            with os.scandir(self.out_dir) as it:
+                names = [e.name for e in it if e.name.endswith(suffix)]
+        except FileNotFoundError:
+            return
+        self.add_segments(names)
+
+    def add_segments(self, names: Iterable[str]):
+        """Добавляет в индекс новые файлы сегментов.
+
+        Пока ffmpeg работает, новые файлы регистрируются как записываемые: точные
+        конец и размер придут из списка сегментов. Файлы, появившиеся без
+        работающего ffmpeg (например, пока служба была остановлена), закрываются по stat.
+        """
+        if not self.last_segment_name:
+            last = self.stream.segments.order_by('-start').first()
+            if last:
+                self.last_segment_name = last.name
+        # Только имена сегментов: посторонний файл с «большим» именем остановил бы индексацию следующих
+        starts = {name: start for name in names
+                  if name > self.last_segment_name and (start := Segment.parse_start(name)) is not None}
+        if not starts:
+            return
+        new_names = sorted(starts)
+        listed = self.process is not None
+        new_segments = []
+        for name in new_names:
+            segment = Segment(stream=self.stream, start=starts[name], path=str(self.out_dir / name))
+            if not listed:
+                try:
+                    stat_result = os.stat(segment.path)
+                except FileNotFoundError:
+                    continue
+                segment.size, segment.end = stat_result.st_size, _segment_end(stat_result)
+            new_segments.append(segment)
+        self.last_segment_name = new_names[-1]
+        Segment.objects.bulk_create(new_segments, ignore_conflicts=True)
+        for segment in new_segments:
+            if segment.end is not None:
+                self._segment_closed(segment.path, segment.size, segment.end)
+
+    def finish_segment(self, name: str, duration: float):
+        """Фиксирует сегмент из списка ffmpeg: начало из имени файла, конец по длительности, размер одним stat."""
+        start = Segment.parse_start(name)
+        if start is None:
+            return
+        path = str(self.out_dir / name)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return
+        end = start + timedelta(seconds=max(duration, 0))
+        if not Segment.objects.filter(path=path, end__isnull=True).update(end=end, size=size):
+            # Строка списка пришла раньше события о создании файла
+            _segment, created = Segment.objects.get_or_create(
+                path=path, defaults={'stream': self.stream, 'start': start, 'end': end, 'size': size})
+            if not created:
+                return
+        self._segment_closed(path, size, end)
+
+    def close_open_segments(self):
+        """Закрывает по stat сегменты, которых нет в списке ffmpeg (процесс упал или был остановлен)."""
+        for segment in self.stream.segments.filter(end__isnull=True):
+            try:
+                stat_result = os.stat(segment.path)
+            except FileNotFoundError:
+                segment.delete()
+                continue
+            segment.size, segment.end = stat_result.st_size, _segment_end(stat_result)
+            segment.save(update_fields=['size', 'end'])
+            self._segment_closed(segment.path, segment.size, segment.end)
+
+    def _segment_closed(self, path: str, size: int, end: datetime):
+        self.bytes_written += size
+        self.last_segment_end = max(self.last_segment_end or 0, end.timestamp())
+        if self.on_segment_closed:
+            self.on_segment_closed(self.stream.pk, path, size)
 
 
 class Command(BaseCommand):
@@ -101,12 +489,27 @@ class Command(BaseCommand):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.recorders = []
+        self.recorders: Dict[int, StreamRecorder] = {}
+        self.streams: List[Stream] = []
         self._first_run = True
+        self._shutdown = False
+        self._wakeup: Optional[asyncio.Event] = None
+        self._inotify: Optional[inotify.Inotify] = None
+        self._watches: Dict[int, Callable[[int, str], None]] = {}
+        self._records_wd = None
+        self._background = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.index_queue: Optional[asyncio.Queue] = None
+        self.retention = RetentionEngine()
+        self.relay: Optional[RelayHub] = RelayHub() if settings.RELAY_PORT else None
+        self.storage_jobs: Dict[int, asyncio.Task] = {}
+        self.export_jobs: Dict[int, asyncio.Task] = {}
+        self._export_slots: Optional[asyncio.Semaphore] = None
         self.system_settings = None
         self.records_dir = None
         self.stop_flag_file = None
         self.restart_flag_file = None
+        self.export_flag_file = None
 
     def update_paths(self):
         """Получает актуальные настройки из БД и обновляет пути."""
@@ -114,144 +517,382 @@ class Command(BaseCommand):
         self.records_dir = Path(self.system_settings.records_dir)
         self.stop_flag_file = self.records_dir / 'stop.flag'
         self.restart_flag_file = self.records_dir / 'restart.flag'
+        self.export_flag_file = self.records_dir / 'export.flag'
         self.records_dir.mkdir(parents=True, exist_ok=True)
 
+    async def reload_settings(self):
+        """Перечитывает системные настройки и переносит наблюдение на новую директорию записей."""
+        old_records_dir = self.records_dir
+        await sync_to_async(self.update_paths)()
+        if old_records_dir == self.records_dir and self._records_wd is not None:
+            return
+        if old_records_dir and old_records_dir != self.records_dir:
+            (old_records_dir / 'restart.flag').unlink(missing_ok=True)
+            self.retention.reset()
+        self._unwatch(self._records_wd)
+        self._records_wd = self._watch(self.records_dir, CONTROL_MASK, self._on_control_event)
+        self._wakeup.set()  # флаги в новой директории (mv/rm) могли появиться до наблюдения
+
     def is_stopped(self):
         return self.stop_flag_file and self.stop_flag_file.exists()
 
-    def restart(self):
-        self.stop()
-        started = 0
+    # --- События ---
+
+    def _spawn(self, coro):
+        """Запускает фоновую задачу, удерживая ссылку на неё до завершения."""
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    def _watch(self, path: Path, mask: int, callback: Callable[[int, str], None]) -> Optional[int]:
+        if self._inotify is None:
+            return None
+        try:
+            wd = self._inotify.add_watch(path, mask)
+        except OSError as e:
+            logger.error(f"Не удалось наблюдать за '{path}': {e}")
+            return None
+        self._watches[wd] = callback
+        return wd
+
+    def _unwatch(self, wd: Optional[int]):
+        if wd is not None and self._watches.pop(wd, None) is not None:
+            self._inotify.rm_watch(wd)
+
+    def _on_inotify_readable(self):
+        for wd, mask, name in self._inotify.read_events():
+            if mask & inotify.IN_Q_OVERFLOW:
+                logger.warning("Переполнение очереди inotify, выполняю полную проверку.")
+                self._wakeup.set()
+                self._spawn(sync_to_async(self.index_segments)())
+            elif callback := self._watches.get(wd):
+                callback(mask, name)
+
+    def _on_control_event(self, mask: int, name: str):
+        if name in CONTROL_FLAGS:
+            self._wakeup.set()
+
+    def _on_segment_event(self, recorder: StreamRecorder) -> Callable[[int, str], None]:
+        def callback(mask: int, name: str):
+            if name.endswith(f'.{SEGMENT_FORMAT}'):
+                self._spawn(sync_to_async(recorder.add_segments)((name,)))
+        return callback
+
+    def _on_segment_closed(self, stream_pk: int, path: str, size: int):
+        """Закрытый сегмент: учёт в счётчиках очистки и очередь на построение индекса кадров.
+
+        Вызывается из потока sync_to_async, поэтому в очередь цикла событий — через call_soon_threadsafe.
+        """
+        self.retention.account(stream_pk, size)
+        if self.index_queue is not None:
+            self._loop.call_soon_threadsafe(self.index_queue.put_nowait, path)
+
+    def request_shutdown(self):
+        logger.info("Получен сигнал завершения. Останавливаю запись...")
+        self._shutdown = True
+        self._wakeup.set()
+
+    async def poll_fallback(self):
+        """Без inotify периодически проверяет флаги и новые сегменты."""
+        last_index_time = time.monotonic()
+        while True:
+            await asyncio.sleep(FLAG_POLL_INTERVAL)
+            self._wakeup.set()
+            if time.monotonic() - last_index_time >= SEGMENT_INDEX_INTERVAL:
+                await sync_to_async(self.index_segments)()
+                last_index_time = time.monotonic()
+
+    async def disk_watchdog(self):
+        """Таймер проверки свободного места."""
+        while True:
+            try:
+                await self.cleanup_old_files()
+            except Exception:
+                logger.error("Ошибка при проверке свободного места", exc_info=True)
+            await asyncio.sleep(DISK_CHECK_INTERVAL)
+
+    async def stall_watchdog(self):
+        """Перезапускает потоки, чей ffmpeg жив, но ничего не пишет (например, зависла RTSP-сессия)."""
+        while True:
+            await asyncio.sleep(STALL_CHECK_INTERVAL)
+            timeout = self.system_settings.stall_timeout
+            if not timeout:
+                continue
+            recorders = list(self.recorders.values())
+            try:
+                stalled = await asyncio.to_thread(lambda: [r for r in recorders if r.is_stalled(timeout)])
+            except Exception:
+                logger.error("Ошибка при проверке зависания записи", exc_info=True)
+                continue
+            for recorder in stalled:
+                self._spawn(recorder.restart_stalled())
+
+    def status(self) -> dict:
+        """Снимок состояния службы для веб-интерфейса и метрик."""
+        retention = self.retention
+        streams = {}
+        for pk, recorder in self.recorders.items():
+            streams[pk] = recorder.status()
+            streams[pk]['stored_bytes'] = retention.usage.get(pk, 0)
+        return {
+            'updated': time.time(),
+            'pid': os.getpid(),
+            'stopped': bool(self.is_stopped()),
+            'records_dir': str(self.records_dir),
+            'retention': {'deleted_files': retention.deleted_files, 'deleted_bytes': retention.deleted_bytes},
+            'streams': streams,
+        }
+
+    async def status_writer(self):
+        """Периодически сохраняет снимок состояния: веб-процесс читает его, не обращаясь к службе."""
+        while True:
+            try:
+                await asyncio.to_thread(write_status, self.status())
+                for pk, recorder in list(self.recorders.items()):
+                    if isinstance(recorder.log, LogRing):
+                        await asyncio.to_thread(recorder.log.dump, ring_path(pk))
+            except Exception:
+                logger.error("Ошибка записи снимка состояния", exc_info=True)
+            await asyncio.sleep(STATUS_INTERVAL)
+
+    async def segment_indexer(self):
+        """Строит файлы-спутники .idx закрытых сегментов по одному, чтобы не отнимать диск у записи."""
+        while True:
+            path = await self.index_queue.get()
+            try:
+                frames = await asyncio.to_thread(write_sidecar, path)
+            except Exception:
+                logger.error(f"Не удалось построить индекс кадров {path}", exc_info=True)
+                continue
+            if frames is not None:
+                logger.debug(f"Индекс кадров {path}: {frames} кадров.")
+
+    async def retention_scheduler(self):
+        """Таймер сроков хранения и квот потоков."""
+        while True:
+            await asyncio.sleep(RETENTION_INTERVAL)
+            try:
+                await self.retention.enforce_policies(self.streams)
+            except Exception:
+                logger.error("Ошибка при применении сроков хранения", exc_info=True)
+
+    # --- Управление записью ---
+
+    async def restart(self):
+        """Сверяет запущенные записи с потоками в БД.
+
+        Запускаются только новые потоки, останавливаются удалённые,
+        перезапускаются изменившиеся (и упавшие) — остальные пишут без перерыва.
+        """
+        await self.reload_settings()
         logger.info(
-            f"Запуск/перезапуск записей. "
+            f"Синхронизация записей. "
             f"Директория: {self.records_dir}. "
             f"Мин. свободного места: {self.system_settings.min_free_gb} GB."
         )
-        for stream in Stream.objects.all():
-            self.recorders.append(r := StreamRecorder(stream))
-            started += r.start()
-        logger.info(f"Запущено {started} записей.")
+        self.streams = await sync_to_async(list)(Stream.objects.select_related('group'))
+        desired = {
+            stream.pk: StreamRecorder(stream, self.records_dir, self._on_segment_closed, self.relay)
+            for stream in self.streams
+        }
+        removed = [pk for pk in self.recorders if pk not in desired]
+        changed = [
+            pk for pk, recorder in self.recorders.items()
+            if pk in desired and (recorder.fingerprint != desired[pk].fingerprint or not recorder.is_running)
+        ]
+        added = [pk for pk in desired if pk not in self.recorders]
+        for pk, recorder in self.recorders.items():
+            if pk in desired:
+                recorder.stream = desired[pk].stream  # свежие сроки хранения, группа и настройки лога
+                recorder.configure_log()
+        await asyncio.gather(*(self._stop_recorder(pk) for pk in removed + changed))
+        started = await asyncio.gather(*(self._start_recorder(desired[pk]) for pk in added + changed))
+        logger.info(
+            f"Запущено {sum(started)} записей: новых {len(added)}, перезапущено {len(changed)}, "
+            f"остановлено {len(removed)}, без изменений {len(desired) - len(added) - len(changed)}."
+        )
         self.stop_flag_file.unlink(missing_ok=True)
         self.restart_flag_file.unlink(missing_ok=True)
 
-    def stop(self):
-        for recorder in self.recorders:
-            recorder.stop()
-        if self.recorders:
+    async def _start_recorder(self, recorder: StreamRecorder) -> bool:
+        self.recorders[recorder.stream.pk] = recorder
+        if not await recorder.start():
+            return False
+        recorder.wd = self._watch(recorder.out_dir, SEGMENT_MASK, self._on_segment_event(recorder))
+        return True
+
+    async def _stop_recorder(self, pk: int):
+        recorder = self.recorders.pop(pk)
+        self._unwatch(recorder.wd)
+        await recorder.stop()
+        if self.relay is not None:
+            self.relay.close_channel(pk)  # клиенты переподключатся к перезапущенной записи
+
+    async def stop(self):
+        had_recorders = bool(self.recorders)
+        await asyncio.gather(*(self._stop_recorder(pk) for pk in list(self.recorders)))
+        if had_recorders:
             logger.info("Все активные записи остановлены.")
-        self.recorders.clear()
-
-    def handle_dir_change_tasks(self):
-        """Проверяет и выполняет задачи по перемещению/удалению директорий."""
-        move_flag = self.records_dir / 'mv.flag'
-        delete_flag = self.records_dir / 'rm.flag'
-        if move_flag.exists():
-            old_path_str = move_flag.read_text().strip()
-            old_path = Path(old_path_str)
-            if old_path.exists() and old_path.is_dir():
-                logger.warning(
-                    f"Обнаружена задача перемещения из '{old_path}' в '{self.records_dir}'. Останавливаю запись...")
-                self.stop()
-                try:
-                    # Перемещаем содержимое
-                    for item in old_path.iterdir():
-                        dest_item = self.records_dir / item.name
-                        logger.info(f"Перемещение: {item} -> {dest_item}")
-                        shutil.move(str(item), str(dest_item))
-                    logger.info(f"Перемещение из '{old_path}' успешно завершено.")
-                    # Пытаемся удалить старую пустую папку
-                    shutil.rmtree(old_path, ignore_errors=True)
-                except Exception as e:
-                    logger.error(f"Ошибка при перемещении файлов из '{old_path}': {e}", exc_info=True)
-                move_flag.unlink()  # Удаляем флаг после выполнения
-                # После перемещения нужен перезапуск, чтобы подхватить новые файлы
-                self._first_run = True
-            else:
-                logger.warning(f"Старый путь '{old_path_str}' из move.flag не найден. Удаляю флаг.")
-                move_flag.unlink()
-        if delete_flag.exists():
-            old_path_str = delete_flag.read_text().strip()
-            old_path = Path(old_path_str)
-            if old_path.exists() and old_path.is_dir():
-                logger.warning(f"!!! ОБНАРУЖЕНА ЗАДАЧА УДАЛЕНИЯ ДАННЫХ В '{old_path}'. Останавливаю запись...")
-                self.stop()
-                for _ in range(2):
-                    try:
-                        shutil.rmtree(old_path)
-                        logger.info(f"Директория '{old_path}' и все ее содержимое были успешно удалены.")
-                    except PermissionError as e:
-                        logger.warning(f"'{old_path}': {e}, пробуем немного позже.")
-                        time.sleep(5)
-                    except Exception as e:
-                        logger.error(f"Ошибка при удалении директории '{old_path}': {e}", exc_info=True)
-                delete_flag.unlink()
-            else:
-                logger.warning(f"Старый путь '{old_path_str}' из delete.flag не найден. Удаляю флаг.")
-                delete_flag.unlink()
+
+    def index_segments(self):
+        for recorder in list(self.recorders.values()):
+            try:
+                recorder.index_segments()
+            except Exception:
+                logger.error(f"Ошибка индексации сегментов {recorder.stream}", exc_info=True)
+
+    async def handle_control_files(self):
+        if self.is_stopped():
+            await self.stop()
+
+        if self._first_run or (self.restart_flag_file and self.restart_flag_file.exists()):
+            await self.restart()
+            self._first_run = False
+            await self.start_storage_tasks()
+            await self.start_export_jobs()
+        elif self.export_flag_file and self.export_flag_file.exists():
+            await self.start_export_jobs()
+
+    async def start_storage_tasks(self):
+        """Запускает (или продолжает после сбоя) фоновые переносы и удаления архива."""
+        tasks = await sync_to_async(list)(StorageTask.objects.filter(
+            status__in=StorageTask.ACTIVE_STATUSES).order_by('created_at'))
+        for task in tasks:
+            if task.pk not in self.storage_jobs:
+                self.storage_jobs[task.pk] = self._spawn(self._run_storage_task(
+                    STORAGE_JOBS[task.kind](task, retention=self.retention)))
+
+    async def _run_storage_task(self, job):
+        task = job.task
+        try:
+            source = Path(task.source).resolve()
+            if source == self.records_dir.resolve() or source in self.records_dir.resolve().parents:
+                # Директорию снова выбрали для записи — трогать её нельзя
+                logger.warning(f"'{task.source}' снова используется для записи. Задача {task} отменена.")
+                task.status, task.error = 'failed', "Директория снова используется для записи."
+                await sync_to_async(task.save)()
+                return
+            if not await asyncio.to_thread(os.path.isdir, task.source):
+                logger.warning(f"Старый путь '{task.source}' не найден. Задача {task} завершена.")
+                task.status = 'done'
+                await sync_to_async(task.save)()
+                return
+            await job.run()
+        except asyncio.CancelledError:
+            raise  # при завершении службы задача остаётся активной и продолжится при следующем запуске
+        except Exception as e:
+            logger.error(f"Ошибка фоновой задачи {task}: {e}", exc_info=True)
+            task.status, task.error = 'failed', str(e)
+            await sync_to_async(task.save)()
+        finally:
+            self.storage_jobs.pop(task.pk, None)
+
+    async def start_export_jobs(self):
+        """Ставит новые выгрузки (и прерванные остановкой службы) в очередь пула EXPORT_WORKERS."""
+        self.export_flag_file.unlink(missing_ok=True)
+        jobs = await sync_to_async(list)(ExportJob.objects.filter(
+            status__in=ExportJob.ACTIVE_STATUSES).order_by('created_at'))
+        for job in jobs:
+            if job.pk not in self.export_jobs:
+                self.export_jobs[job.pk] = self._spawn(self._run_export(Export(job)))
+
+    async def _run_export(self, export: Export):
+        job = export.job
+        try:
+            async with self._export_slots:  # очередь по порядку постановки
+                await export.run()
+            files, freed = await sync_to_async(evict)(int(settings.EXPORT_CACHE_GB * GB_DIVIDER), (job.pk,))
+            if files:
+                logger.info(f"Кэш выгрузок: удалено {files} давно не запрашивавшихся файлов, "
+                            f"{freed / GB_DIVIDER:.2f} GB.")
+        except asyncio.CancelledError:
+            raise  # при завершении службы выгрузка остаётся в очереди и выполнится при следующем запуске
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки {job} ({job.pk}): {e}", exc_info=True)
+            job.status, job.error = 'failed', str(e)
+            await sync_to_async(job.save)(update_fields=['status', 'error', 'updated_at'])
+        finally:
+            self.export_jobs.pop(job.pk, None)
+
+    async def run(self):
+        """Событийный цикл супервизора: флаги управления, завершение ffmpeg и таймер диска."""
+        loop = self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._export_slots = asyncio.Semaphore(max(settings.EXPORT_WORKERS, 1))
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            with suppress(NotImplementedError, AttributeError):
+                loop.add_signal_handler(sig, self.request_shutdown)
+        if inotify.Inotify.available():
+            self._inotify = inotify.Inotify()
+            loop.add_reader(self._inotify.fileno(), self._on_inotify_readable)
+        else:
+            logger.warning("inotify недоступен, флаги управления проверяются периодически.")
+            self._spawn(self.poll_fallback())
+
+        await self.reload_settings()
+        await sync_to_async(self.retention.load_usage)()
+        self._spawn(self.disk_watchdog())
+        self._spawn(self.retention_scheduler())
+        self._spawn(self.stall_watchdog())
+        self._spawn(self.status_writer())
+        if SEGMENT_FORMAT == 'ts':
+            self.index_queue = asyncio.Queue()
+            self._spawn(self.segment_indexer())
+        if self.relay is not None:
+            try:
+                await self.relay.start(settings.RELAY_HOST, settings.RELAY_PORT)
+            except OSError as e:
+                logger.error(f"Ретрансляция недоступна: не удалось слушать "
+                             f"{settings.RELAY_HOST}:{settings.RELAY_PORT}: {e}")
+                self.relay = None
+        try:
+            while not self._shutdown:
+                await self.handle_control_files()
+                await self._wakeup.wait()
+                self._wakeup.clear()
+        finally:
+            for task in list(self._background):
+                task.cancel()
+            await self.stop()
+            if self.relay is not None:
+                await self.relay.stop()
+            STATUS_FILE.unlink(missing_ok=True)
+            if self._inotify:
+                loop.remove_reader(self._inotify.fileno())
+                self._inotify.close()
+                self._inotify = None
 
     def handle(self, *args, **options):
-        setup_logging(settings.LOGFILE)
+        listener = setup_logging(settings.LOGFILE)
         logger.info("Запуск службы записи всех камер...")
-
         try:
-            while True:
-                # В начале каждой итерации получаем актуальные настройки
-                self.update_paths()
-
-                # Выполняем задачи по смене директории ДО всего остального
-                self.handle_dir_change_tasks()
-
-                self.cleanup_old_files()
-
-                if self.is_stopped():
-                    self.stop()
-
-                if self._first_run or (self.restart_flag_file and self.restart_flag_file.exists()):
-                    self.restart()
-                    self._first_run = False
-
-                time.sleep(1)
+            asyncio.run(self.run())
         except KeyboardInterrupt:
-            logger.info("\nПолучен сигнал прерывания (Ctrl+C). Завершение...")
-            self.stop()
+            pass
+        finally:
+            logger.info("Служба записи завершена.")
+            listener.stop()  # дописывает оставшиеся в очереди записи
 
-    def cleanup_old_files(self):
+    async def cleanup_old_files(self):
+        """Фоновая очистка по границам свободного места; запись при этом продолжается."""
         min_free_gb = self.system_settings.min_free_gb
         if min_free_gb <= 0:
             return
-
-        total, used, free = shutil.disk_usage(str(self.records_dir))
+        target_free_gb = max(self.system_settings.target_free_gb, min_free_gb)
+        free, deleted = await self.retention.enforce(
+            str(self.records_dir), min_free_gb * GB_DIVIDER, target_free_gb * GB_DIVIDER
+        )
         free_gb = free / GB_DIVIDER
         if free_gb >= min_free_gb:
+            if deleted:
+                logger.info(
+                    f"Достигнут необходимый объем свободного места ({free_gb:.2f} GB). Удалено файлов: {deleted}.")
             return
-
-        logger.warning(
-            f"Недостаточно места ({free_gb:.2f} GB из необходимых {min_free_gb} GB). Начинаю удаление старых файлов...")
-
-        try:
-            files = sorted(self.records_dir.rglob(f"*.{SEGMENT_FORMAT}"), key=lambda p: p.stat().st_mtime)
-        except FileNotFoundError:
-            logger.warning(f"Каталог записей {self.records_dir} не найден. Пропускаю очистку.")
-            return
-
-        if files:
-            self.stop()  # Останавливаем запись перед удалением, чтобы избежать проблем
-
-        files_deleted = 0
-        for file in files:
-            try:
-                file.unlink(missing_ok=True)
-                files_deleted += 1
-                free = shutil.disk_usage(str(self.records_dir)).free
-                free_gb = free / GB_DIVIDER
-                logger.info(f"Удалён: {file.name}. Свободно: {free_gb:.2f} GB.")
-                if free_gb >= min_free_gb:
-                    logger.info(f"Достигнут необходимый объем свободного места. Удалено файлов: {files_deleted}.")
-                    break
-            except Exception:
-                logger.error(f"Не удалось удалить файл {file}", exc_info=True)
-        else:
-            if not files:
-                logger.warning("Старых файлов для удаления не найдено, но места все еще недостаточно.")
-            logger.warning("Места не достаточно, останавливаем запись, необходим ручной перезапуск/переконфигурация.")
+        if not deleted:
+            logger.warning("Старых файлов для удаления не найдено, но места все еще недостаточно.")
+        if free_gb < EMERGENCY_FREE_GB and self.recorders:
+            # Крайняя мера: удалять больше нечего, а диск вот-вот заполнится
+            logger.critical(
+                "Места не достаточно, останавливаем запись, необходим ручной перезапуск/переконфигурация.")
             self.stop_flag_file.touch(exist_ok=True)
@@ -0,0 +1,219 @@
+"""Метрики в текстовом формате Prometheus: состояние записи, хранилища и задержки архивных представлений."""
+import re
+import shutil
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .models import System
+from .status import read_status
+
+METRICS_CACHE_TTL = 5  # секунд: снимок службы, диск и /proc/mdstat перечитываются не чаще
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+MDSTAT_PATH = Path('/proc/mdstat')
+
+Sample = Tuple[Dict[str, Any], Optional[float]]
+
+_MD_LEVEL = re.compile(r'^(raid\d+|linear|multipath|faulty)$')
+_MD_DISKS = re.compile(r'\[(\d+)/(\d+)]')
+_MD_SYNC = re.compile(r'(resync|recovery|reshape|check|repair)\s*=\s*([\d.]+)%')
+
+
+class Histogram:
+    """Гистограмма задержек с фиксированными границами, потокобезопасная."""
+    __slots__ = ('buckets', 'series', 'lock')
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.series: Dict[Tuple[str, ...], list] = {}  # метки -> [счётчики корзин..., сумма, количество]
+        self.lock = threading.Lock()
+
+    def observe(self, labels: Tuple[str, ...], value: float):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self, name: str, help_text: str, label_names: Tuple[str, ...]) -> List[str]:
+        with self.lock:
+            items = [(labels, list(series)) for labels, series in self.series.items()]
+        if not items:
+            return []
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for labels, series in sorted(items):
+            base = dict(zip(label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels({**base, "le": _value(bound)})} {cumulative}')
+            lines.append(f'{name}_sum{_labels(base)} {_value(series[-2])}')
+            lines.append(f'{name}_count{_labels(base)} {series[-1]}')
+        return lines
+
+
+REQUEST_LATENCY = Histogram()
+
+
+def timed(view_name: str):
+    """Декоратор представления: время до ответа попадает в гистограмму задержек."""
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await view(request, *args, **kwargs)
+                finally:
+                    REQUEST_LATENCY.observe((view_name, request.method), time.perf_counter() - started)
+            return markcoroutinefunction(wrapper)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                REQUEST_LATENCY.observe((view_name, request.method), time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def parse_mdstat(text: str) -> List[Dict[str, Any]]:
+    """Разбирает /proc/mdstat: состояние, уровень, диски и ход синхронизации каждого массива."""
+    arrays, current = [], None
+    for line in text.splitlines():
+        if line.startswith('md') and ' : ' in line:
+            parts = line.split()
+            devices = [part for part in parts[3:] if '[' in part]
+            current = {
+                'device': parts[0], 'state': parts[2],
+                'level': next((part for part in parts[3:] if _MD_LEVEL.match(part)), ''),
+                'disks_total': len(devices), 'disks_active': None,
+                'disks_failed': sum(part.endswith('(F)') for part in devices),
+                'action': None, 'progress': None,
+            }
+            arrays.append(current)
+        elif current is not None:
+            if match := _MD_DISKS.search(line):
+                current['disks_total'], current['disks_active'] = int(match[1]), int(match[2])
+            if match := _MD_SYNC.search(line):
+                current['action'], current['progress'] = match[1], float(match[2]) / 100
+    return arrays
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+def _family(lines: List[str], name: str, kind: str, help_text: str, samples: Iterable[Sample]):
+    samples = [(labels, value) for labels, value in samples if value is not None]
+    if not samples:
+        return
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} {kind}')
+    lines.extend(f'{name}{_labels(labels)} {_value(value)}' for labels, value in samples)
+
+
+def collect() -> List[str]:
+    """Собирает метрики из снимка службы записи, диска и /proc/mdstat."""
+    lines: List[str] = []
+    status = read_status()
+    now = time.time()
+    _family(lines, 'camrec_service_up', 'gauge', 'Служба записи работает и обновляет снимок состояния.',
+            [({}, 1 if status else 0)])
+    if status:
+        _family(lines, 'camrec_service_stopped', 'gauge', 'Запись остановлена флагом stop.flag.',
+                [({}, 1 if status.get('stopped') else 0)])
+    streams = [({'stream': pk, 'name': info.get('name', '')}, info) for pk, info in status.get('streams', {}).items()]
+    for name, kind, help_text, getter in (
+            ('camrec_stream_up', 'gauge', 'ffmpeg потока запущен.', lambda s: 1 if s.get('running') else 0),
+            ('camrec_stream_restarts_total', 'counter', 'Автоматические перезапуски ffmpeg.',
+             lambda s: s.get('restarts')),
+            ('camrec_stream_bytes_written_total', 'counter', 'Байт в закрытых сегментах с запуска службы.',
+             lambda s: s.get('bytes_written')),
+            ('camrec_stream_stored_bytes', 'gauge', 'Объём записей потока в архиве.', lambda s: s.get('stored_bytes')),
+            ('camrec_stream_last_segment_age_seconds', 'gauge', 'Секунд с конца последнего закрытого сегмента.',
+             lambda s: now - s['last_segment_end'] if s.get('last_segment_end') else None),
+            ('camrec_stream_bitrate_kbps', 'gauge', 'Битрейт по -progress ffmpeg.',
+             lambda s: s.get('stats', {}).get('bitrate')),
+            ('camrec_stream_fps', 'gauge', 'Кадров в секунду по -progress ffmpeg.', lambda s: s.get('stats', {}).get('fps')),
+            ('camrec_stream_speed', 'gauge', 'Скорость обработки относительно реального времени.',
+             lambda s: s.get('stats', {}).get('speed')),
+            ('camrec_stream_dropped_frames', 'gauge', 'Потерянные кадры текущего процесса ffmpeg.',
+             lambda s: s.get('stats', {}).get('drop_frames')),
+            ('camrec_stream_duplicated_frames', 'gauge', 'Дублированные кадры текущего процесса ffmpeg.',
+             lambda s: s.get('stats', {}).get('dup_frames')),
+            ('camrec_stream_relay_clients', 'gauge', 'Клиенты ретрансляции потока.', lambda s: s.get('relay_clients')),
+    ):
+        _family(lines, name, kind, help_text, ((labels, getter(info)) for labels, info in streams))
+    retention = status.get('retention', {})
+    _family(lines, 'camrec_retention_deleted_files_total', 'counter', 'Файлов удалено очисткой с запуска службы.',
+            [({}, retention.get('deleted_files'))])
+    _family(lines, 'camrec_retention_deleted_bytes_total', 'counter', 'Байт удалено очисткой с запуска службы.',
+            [({}, retention.get('deleted_bytes'))])
+
+    records_dir = System.get().records_dir
+    try:
+        usage = shutil.disk_usage(records_dir)
+    except OSError:
+        usage = None
+    if usage:
+        _family(lines, 'camrec_disk_free_bytes', 'gauge', 'Свободно на томе записей.', [({'path': records_dir}, usage.free)])
+        _family(lines, 'camrec_disk_total_bytes', 'gauge', 'Размер тома записей.', [({'path': records_dir}, usage.total)])
+
+    try:
+        arrays = parse_mdstat(MDSTAT_PATH.read_text(encoding='UTF-8'))
+    except OSError:
+        arrays = []
+    md = [({'device': array['device'], 'level': array['level']}, array) for array in arrays]
+    for name, help_text, getter in (
+            ('camrec_md_active', 'Массив в состоянии active.', lambda a: 1 if a['state'] == 'active' else 0),
+            ('camrec_md_disks', 'Дисков в массиве.', lambda a: a['disks_total']),
+            ('camrec_md_disks_active', 'Рабочих дисков в массиве.', lambda a: a['disks_active']),
+            ('camrec_md_disks_failed', 'Дисков, отмеченных сбойными.', lambda a: a['disks_failed']),
+            ('camrec_md_degraded', 'Рабочих дисков меньше, чем должно быть.',
+             lambda a: None if a['disks_active'] is None else int(a['disks_active'] < a['disks_total'])),
+    ):
+        _family(lines, name, 'gauge', help_text, ((labels, getter(array)) for labels, array in md))
+    _family(lines, 'camrec_md_sync_progress_ratio', 'gauge', 'Ход resync/recovery/check массива.',
+            (({**labels, 'action': array['action']}, array['progress']) for labels, array in md))
+    return lines
+
+
+_cache = (0.0, [])
+_cache_lock = threading.Lock()
+
+
+def render() -> str:
+    """Текст для /metrics. Тяжёлая часть кэшируется на METRICS_CACHE_TTL, задержки — всегда свежие."""
+    global _cache
+    with _cache_lock:
+        if time.monotonic() >= _cache[0]:
+            _cache = (time.monotonic() + METRICS_CACHE_TTL, collect())
+        lines = _cache[1]
+    latency = REQUEST_LATENCY.render(
+        'camrec_http_request_duration_seconds', 'Время ответа архивных представлений.', ('view', 'method'))
+    return '\n'.join(lines + latency) + '\n'
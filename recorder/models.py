@@ -1,12 +1,18 @@
 import datetime
 import os
 from pathlib import Path
+from typing import Optional
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone
 from django_cryptography.fields import encrypt
 
+SEGMENT_NAME_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
 
 def trigger_restart():
     system_settings = System.get()
@@ -14,6 +20,11 @@ def trigger_restart():
     (records_dir / 'restart.flag').touch(exist_ok=True)
 
 
+def trigger_exports():
+    """Будит службу записи: в очереди новые выгрузки."""
+    (Path(System.get().records_dir) / 'export.flag').touch(exist_ok=True)
+
+
 class System(models.Model):
     ACTION_CHOICES = [
         ('mv', 'Переместить все файлы в новую директорию'),
@@ -21,7 +32,18 @@ class System(models.Model):
     ]
     min_free_gb = models.PositiveSmallIntegerField(
         default=50,
-        verbose_name="Минимум свободного места (GB)"
+        verbose_name="Минимум свободного места (GB)",
+        help_text="Нижняя граница: когда свободного места меньше, начинается удаление старых записей."
+    )
+    target_free_gb = models.PositiveSmallIntegerField(
+        default=60,
+        verbose_name="Освобождать до (GB)",
+        help_text="Верхняя граница: удаление старых записей продолжается, пока свободного места меньше."
+    )
+    stall_timeout = models.PositiveSmallIntegerField(
+        default=30,
+        verbose_name="Таймаут зависания записи (сек)",
+        help_text="Если ffmpeg столько секунд ничего не записывает, запись потока перезапускается. 0 — не отслеживать."
     )
     storage_pool_name = models.CharField(
         max_length=255,
@@ -40,13 +62,17 @@ class System(models.Model):
         choices=ACTION_CHOICES,
         default='mv',
         verbose_name="Действие при смене директории записей",
-        help_text="Внимание: 'Переместить' или 'Удалить' может занять много времени и остановит запись на этот период."
+        help_text="Перемещение или удаление выполняется в фоне, запись сразу продолжается в новой директории."
     )
 
     class Meta:
         verbose_name = "Системная настройка"
         verbose_name_plural = "Системные настройки"
 
+    def clean(self):
+        if self.min_free_gb and self.target_free_gb < self.min_free_gb:
+            raise ValidationError({'target_free_gb': "Должно быть не меньше минимума свободного места."})
+
     def save(self, *args, **kwargs):
         # Получаем старый путь до сохранения
         old_instance = None
@@ -62,12 +88,11 @@ class System(models.Model):
         new_records_dir.mkdir(parents=True, exist_ok=True)
         if old_instance and old_instance.records_dir != self.records_dir:
             old_records_dir = Path(old_instance.records_dir)
-            if self.on_dir_change_action == 'rm':
-                delete_flag = new_records_dir / 'rm.flag'
-                delete_flag.write_text(str(old_records_dir))
-            else:
-                move_flag = new_records_dir / 'mv.flag'
-                move_flag.write_text(str(old_records_dir))
+            StorageTask.objects.create(
+                kind=self.on_dir_change_action, source=str(old_records_dir), target=str(new_records_dir))
+            if old_records_dir.is_dir():
+                # Служба записи следит за флагами в текущей (старой) директории
+                (old_records_dir / 'restart.flag').touch(exist_ok=True)
         trigger_restart()
 
     @classmethod
@@ -83,6 +108,131 @@ class System(models.Model):
         return 'Основные настройки'
 
 
+class StorageTask(models.Model):
+    """Фоновая задача над архивом; прогресс сохраняется, чтобы после сбоя продолжить."""
+    STATUS_CHOICES = [
+        ('pending', 'В очереди'),
+        ('running', 'Выполняется'),
+        ('done', 'Завершена'),
+        ('failed', 'Ошибка'),
+    ]
+    kind = models.CharField(max_length=2, choices=System.ACTION_CHOICES, verbose_name="Действие")
+    source = models.CharField(max_length=255, verbose_name="Исходная директория")
+    target = models.CharField(max_length=255, blank=True, default='', verbose_name="Целевая директория")
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default='pending', verbose_name="Статус")
+    files_total = models.PositiveBigIntegerField(default=0, verbose_name="Файлов всего")
+    bytes_total = models.PositiveBigIntegerField(default=0, verbose_name="Байт всего")
+    files_done = models.PositiveBigIntegerField(default=0, verbose_name="Файлов обработано")
+    bytes_done = models.PositiveBigIntegerField(default=0, verbose_name="Байт обработано")
+    error = models.TextField(blank=True, default='', verbose_name="Ошибка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создана")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлена")
+
+    ACTIVE_STATUSES = ('pending', 'running')
+
+    class Meta:
+        verbose_name = "Задача хранилища"
+        verbose_name_plural = "Задачи хранилища"
+        ordering = ('-created_at',)
+
+    @property
+    def percent(self) -> float:
+        if not self.bytes_total:
+            return 100.0 if self.status == 'done' else 0.0
+        return min(100.0, self.bytes_done * 100 / self.bytes_total)
+
+    def __str__(self):
+        return f'{self.get_kind_display()}: {self.source}'
+
+
+class ExportJob(models.Model):
+    """Фоновая выгрузка архива; готовый файл — запись кэша, общая для одинаковых запросов."""
+    STATUS_CHOICES = StorageTask.STATUS_CHOICES + [
+        ('expired', 'Удалена из кэша'),
+    ]
+    FORMAT_CHOICES = [
+        ('raw', 'Как записано'),
+        ('mp4', 'MP4'),
+        ('zip', 'ZIP'),
+        ('tar', 'TAR'),
+    ]
+    key = models.CharField(max_length=64, db_index=True, verbose_name="Ключ кэша")
+    streams = models.ManyToManyField('Stream', related_name='export_jobs', verbose_name="Потоки")
+    start = models.DateTimeField(verbose_name="Начало периода")
+    end = models.DateTimeField(verbose_name="Конец периода")
+    format = models.CharField(max_length=3, choices=FORMAT_CHOICES, verbose_name="Формат")
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default='pending', verbose_name="Статус")
+    bytes_total = models.PositiveBigIntegerField(default=0, verbose_name="Байт всего")
+    bytes_done = models.PositiveBigIntegerField(default=0, verbose_name="Байт обработано")
+    size = models.PositiveBigIntegerField(default=0, verbose_name="Размер результата")
+    error = models.TextField(blank=True, default='', verbose_name="Ошибка")
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL,
+                                   related_name='+', verbose_name="Запросил")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создана")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлена")
+    accessed_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name="Последний запрос")
+
+    ACTIVE_STATUSES = StorageTask.ACTIVE_STATUSES
+
+    class Meta:
+        verbose_name = "Выгрузка архива"
+        verbose_name_plural = "Выгрузки архива"
+        ordering = ('-created_at',)
+
+    @property
+    def percent(self) -> float:
+        if not self.bytes_total:
+            return 100.0 if self.status == 'done' else 0.0
+        return min(100.0, self.bytes_done * 100 / self.bytes_total)
+
+    @property
+    def extension(self) -> str:
+        return settings.SEGMENT_FORMAT if self.format == 'raw' else self.format
+
+    @property
+    def result_path(self) -> Path:
+        """Файл результата: свой у каждой задачи, поэтому задачи с одинаковым ключом не затирают и не удаляют
+        файлы друг друга."""
+        return settings.EXPORT_DIR / f'{self.key}-{self.pk}.{self.extension}'
+
+    @property
+    def filename(self) -> str:
+        start, end = timezone.localtime(self.start), timezone.localtime(self.end)
+        return f"archive_{start:%Y%m%d-%H%M}_{end:%Y%m%d-%H%M}.{self.extension}"
+
+    def get_absolute_url(self):
+        return reverse('export-job', kwargs={'pk': self.pk})
+
+    def __str__(self):
+        start, end = timezone.localtime(self.start), timezone.localtime(self.end)
+        return f'{self.get_format_display()}: {start:%Y-%m-%d %H:%M} — {end:%Y-%m-%d %H:%M}'
+
+
+class StreamGroup(models.Model):
+    name = models.CharField(max_length=128, unique=True, verbose_name="Название")
+    max_age_days = models.PositiveIntegerField(
+        default=0,
+        verbose_name="Хранить дней",
+        help_text="Для потоков группы без собственного ограничения. 0 — без ограничения."
+    )
+    max_size_gb = models.PositiveIntegerField(
+        default=0,
+        verbose_name="Квота группы (GB)",
+        help_text="Общий объём записей всех потоков группы. 0 — без ограничения."
+    )
+
+    class Meta:
+        verbose_name = "Группа потоков"
+        verbose_name_plural = "Группы потоков"
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        trigger_restart()
+
+    def __str__(self):
+        return self.name
+
+
 class Stream(models.Model):
     LOGLEVEL_CHOICES = [
         ("quiet", "Quiet"),
@@ -95,6 +245,10 @@ class Stream(models.Model):
         ("debug", "Debug"),
         ("trace", "Trace"),
     ]
+    LOG_MODE_CHOICES = [
+        ('file', 'Файл с ротацией'),
+        ('ring', 'Буфер в памяти (на диск — только предупреждения и ошибки)'),
+    ]
     host = models.CharField(max_length=255, verbose_name="Хост", help_text="IP-адрес или hostname")
     port = models.PositiveSmallIntegerField(default=554, verbose_name="Порт")
     login = models.CharField(max_length=64, default='admin', verbose_name="Логин")
@@ -112,6 +266,51 @@ class Stream(models.Model):
         default="info",
         verbose_name="Уровень логирования"
     )
+    live_preview = models.BooleanField(
+        default=False,
+        verbose_name="Живой просмотр",
+        help_text="ffmpeg записи дополнительно отдаёт короткий HLS для просмотра в браузере "
+                  "(без второго подключения к камере)."
+    )
+    relay_enabled = models.BooleanField(
+        default=False,
+        verbose_name="Ретрансляция",
+        help_text="Служба записи раздаёт поток камеры локальным клиентам (VLC, аналитика) "
+                  "по HTTP, не открывая новых подключений к камере."
+    )
+    log_mode = models.CharField(
+        max_length=4,
+        choices=LOG_MODE_CHOICES,
+        default='file',
+        verbose_name="Режим лога ffmpeg"
+    )
+    log_max_size_mb = models.PositiveIntegerField(
+        default=10,
+        verbose_name="Размер лога (MB)",
+        help_text="При превышении лог ротируется. 0 — без ограничения."
+    )
+    log_backup_count = models.PositiveSmallIntegerField(
+        default=3,
+        verbose_name="Старых логов хранить"
+    )
+    log_compress = models.BooleanField(
+        default=True,
+        verbose_name="Сжимать старые логи (gzip)"
+    )
+    group = models.ForeignKey(
+        StreamGroup, null=True, blank=True, on_delete=models.SET_NULL,
+        related_name='streams', verbose_name="Группа"
+    )
+    max_age_days = models.PositiveIntegerField(
+        default=0,
+        verbose_name="Хранить дней",
+        help_text="Записи старше удаляются. 0 — как у группы (или без ограничения)."
+    )
+    max_size_gb = models.PositiveIntegerField(
+        default=0,
+        verbose_name="Квота (GB)",
+        help_text="Предельный объём записей потока. 0 — без ограничения."
+    )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
 
     class Meta:
@@ -124,8 +323,11 @@ class Stream(models.Model):
         """Получает путь для записи этого потока из настроек в БД."""
         if not self.pk:
             raise ValueError("Stream instance must be saved before accessing record_path.")
-        records_dir = Path(System.get().records_dir)
-        return records_dir / str(self.pk)
+        return self.get_record_path(System.get().records_dir)
+
+    def get_record_path(self, records_dir) -> Path:
+        """Путь для записи потока внутри заданной директории записей."""
+        return Path(records_dir) / str(self.pk)
 
     def __str__(self):
         return f'{self.protocol}://{self.login}@{self.host}:{self.port}{self.path}'
@@ -133,6 +335,15 @@ class Stream(models.Model):
     def full_url(self):
         return f'{self.protocol}://{self.login}:{self.password}@{self.host}:{self.port}{self.path}'
 
+    def relay_url(self, host: str = None) -> Optional[str]:
+        """Адрес ретрансляции потока (None — выключена). host — для службы, слушающей все адреса."""
+        if not self.relay_enabled or not settings.RELAY_PORT:
+            return None
+        if settings.RELAY_HOST not in ('', '0.0.0.0', '::'):
+            host = settings.RELAY_HOST
+        token = f'?token={settings.RELAY_TOKEN}' if settings.RELAY_TOKEN else ''
+        return f'http://{host or "127.0.0.1"}:{settings.RELAY_PORT}/{self.pk}.ts{token}'
+
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         self.record_path.mkdir(parents=True, exist_ok=True)
@@ -141,18 +352,63 @@ class Stream(models.Model):
     def get_absolute_url(self):
         return reverse('stream-archive', kwargs={'pk': self.pk})
 
+    @property
+    def effective_max_age_days(self) -> int:
+        """Срок хранения потока: собственный или группы."""
+        if self.max_age_days or not self.group:
+            return self.max_age_days
+        return self.group.max_age_days
+
+    def segments_in_range(self, start_dt, end_dt):
+        """Сегменты, пересекающиеся с периодом, по порядку."""
+        return self.segments.filter(
+            models.Q(end__gt=start_dt) | models.Q(end__isnull=True), start__lt=end_dt
+        ).order_by('start')
+
     def find_files_in_range(self, start_dt, end_dt):
-        if not self.record_path.exists():
-            return []
-        files_in_range = []
-        for f in self.record_path.glob(f'*.{settings.SEGMENT_FORMAT}'):
-            try:
-                timestamp_str = f.stem
-                file_dt = datetime.datetime.strptime(timestamp_str, '%Y-%m-%d_%H-%M-%S')
-                file_dt_aware = timezone.make_aware(file_dt, timezone.get_current_timezone())
-                file_end_dt = file_dt_aware + datetime.timedelta(seconds=self.segment_duration)
-                if file_dt_aware < end_dt and file_end_dt > start_dt:
-                    files_in_range.append(f)
-            except ValueError:
-                continue
-        return sorted(files_in_range, key=lambda p: p.name)
+        """Возвращает файлы сегментов, пересекающихся с периодом, по индексу сегментов."""
+        return [Path(path) for path in self.segments_in_range(start_dt, end_dt).values_list('path', flat=True)]
+
+
+@receiver(post_delete, sender=Stream)
+def _stream_deleted(sender, instance, **kwargs):
+    """Удалённый поток должен перестать записываться."""
+    trigger_restart()
+
+
+class Segment(models.Model):
+    """Запись индекса сегментов: один видео-файл потока."""
+    stream = models.ForeignKey(Stream, on_delete=models.CASCADE, related_name='segments', verbose_name="Поток")
+    start = models.DateTimeField(verbose_name="Начало")
+    end = models.DateTimeField(null=True, blank=True, verbose_name="Конец",
+                               help_text='Пусто, пока сегмент записывается')
+    size = models.PositiveBigIntegerField(default=0, verbose_name="Размер (байт)")
+    path = models.CharField(max_length=1024, unique=True, verbose_name="Путь к файлу")
+
+    class Meta:
+        verbose_name = "Сегмент"
+        verbose_name_plural = "Сегменты"
+        indexes = [
+            models.Index(fields=['stream', 'start']),
+            models.Index(fields=['start']),
+        ]
+
+    @property
+    def name(self) -> str:
+        return Path(self.path).name
+
+    @property
+    def duration(self) -> Optional[datetime.timedelta]:
+        return self.end - self.start if self.end else None
+
+    @staticmethod
+    def parse_start(file_name: str) -> Optional[datetime.datetime]:
+        """Время начала сегмента из имени файла (шаблон strftime ffmpeg)."""
+        try:
+            file_dt = datetime.datetime.strptime(Path(file_name).stem, SEGMENT_NAME_FORMAT)
+        except ValueError:
+            return None
+        return timezone.make_aware(file_dt, timezone.get_current_timezone())
+
+    def __str__(self):
+        return self.path
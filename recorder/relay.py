@@ -0,0 +1,158 @@
+"""Ретрансляция потоков: один ffmpeg на камеру, сколько угодно локальных зрителей по HTTP (MPEG-TS).
+
+ffmpeg записи отдаёт копию входного потока в канал; служба раздаёт её клиентам
+по адресу http://<RELAY_HOST>:<RELAY_PORT>/<pk>.ts. Медленный клиент отключается,
+когда его очередь переполняется, — запись и остальные клиенты его не ждут.
+"""
+import asyncio
+import hmac
+import logging
+import re
+from contextlib import suppress
+from typing import Dict, Optional, Set
+from urllib.parse import parse_qs, urlsplit
+
+from django.conf import settings
+
+from .tsindex import TS_PACKET
+
+logger = logging.getLogger(__name__)
+
+RELAY_CHUNK = TS_PACKET * 348  # ~64 KB, кратно пакету: клиенты всегда получают целые пакеты
+RELAY_CLIENT_QUEUE = 256  # блоков в очереди клиента (~16 MB) до его отключения
+RELAY_HEADER_LIMIT = 8192  # байт заголовков запроса
+RELAY_HEADER_TIMEOUT = 10  # секунд на получение заголовков
+_PATH = re.compile(r'/(\d+)\.ts')
+
+
+def _end(queue: asyncio.Queue):
+    """Признак конца в очередь клиента; если она полна, вытесняет самый старый блок."""
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(None)
+
+
+class RelayChannel:
+    """Клиенты одного потока: у каждого своя ограниченная очередь блоков."""
+    __slots__ = ('clients',)
+
+    def __init__(self):
+        self.clients: Set[asyncio.Queue] = set()
+
+    def publish(self, data: bytes):
+        for queue in list(self.clients):
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                self.clients.discard(queue)  # отстал — отключаем
+                _end(queue)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(RELAY_CLIENT_QUEUE)
+        self.clients.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.clients.discard(queue)
+
+    def close(self):
+        for queue in self.clients:
+            _end(queue)
+        self.clients.clear()
+
+
+class RelayHub:
+    """Каналы всех ретранслируемых потоков и HTTP-сервер для клиентов."""
+    __slots__ = ('channels', 'server')
+
+    def __init__(self):
+        self.channels: Dict[int, RelayChannel] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def channel(self, stream_pk: int) -> RelayChannel:
+        channel = self.channels.get(stream_pk)
+        if channel is None:
+            channel = self.channels[stream_pk] = RelayChannel()
+        return channel
+
+    def close_channel(self, stream_pk: int):
+        channel = self.channels.pop(stream_pk, None)
+        if channel is not None:
+            channel.close()
+
+    def clients(self, stream_pk: int) -> int:
+        channel = self.channels.get(stream_pk)
+        return len(channel.clients) if channel else 0
+
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"Ретрансляция потоков: http://{host}:{port}/<id>.ts")
+
+    async def stop(self):
+        for stream_pk in list(self.channels):
+            self.close_channel(stream_pk)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: str, body: str = ''):
+        writer.write(f'HTTP/1.0 {status}\r\nContent-Type: text/plain; charset=utf-8\r\n'
+                     f'Connection: close\r\n\r\n{body}'.encode())
+        await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info('peername')
+        queue = channel = None
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), RELAY_HEADER_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            if len(head) > RELAY_HEADER_LIMIT:
+                return
+            method, _, rest = head.decode('latin-1').partition(' ')
+            target = urlsplit(rest.partition(' ')[0])
+            if method not in ('GET', 'HEAD'):
+                await self._respond(writer, '405 Method Not Allowed')
+                return
+            if settings.RELAY_TOKEN and not hmac.compare_digest(
+                    parse_qs(target.query).get('token', [''])[0], settings.RELAY_TOKEN):
+                await self._respond(writer, '403 Forbidden')
+                return
+            match = _PATH.fullmatch(target.path)
+            channel = self.channels.get(int(match[1])) if match else None
+            if channel is None:
+                await self._respond(writer, '404 Not Found', "Поток не ретранслируется.")
+                return
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: video/mp2t\r\nCache-Control: no-cache\r\n'
+                         b'Connection: close\r\n\r\n')
+            await writer.drain()
+            if method == 'HEAD':
+                return
+            queue = channel.subscribe()
+            logger.info(f"Клиент ретрансляции {peer} подключён к потоку {match[1]}.")
+            while (data := await queue.get()) is not None:
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if queue is not None:
+                channel.unsubscribe(queue)
+                logger.info(f"Клиент ретрансляции {peer} отключён.")
+            writer.close()
+            with suppress(ConnectionError, OSError):
+                await writer.wait_closed()
+
+
+async def pump(reader: asyncio.StreamReader, channel: RelayChannel):
+    """Читает вывод ffmpeg и раздаёт клиентам блоками, выровненными по 188-байтным пакетам."""
+    pending = b''
+    while data := await reader.read(RELAY_CHUNK):
+        pending += data
+        cut = len(pending) - len(pending) % TS_PACKET
+        if cut:
+            channel.publish(pending[:cut])
+            pending = pending[cut:]
@@ -0,0 +1,208 @@
+"""Удаление старых записей по индексу сегментов без остановки записи."""
+import asyncio
+import logging
+import os
+import shutil
+from collections import defaultdict, deque
+from contextlib import suppress
+from datetime import timedelta
+from typing import Collection, Deque, Dict, Iterable, List, Set, Tuple
+
+from asgiref.sync import sync_to_async
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import Segment, Stream
+from .tsindex import sidecar_path
+
+logger = logging.getLogger(__name__)
+
+GB_DIVIDER = 1 << 30
+QUEUE_REFILL_SIZE = 1000  # сколько старейших сегментов подгружать из индекса за раз
+BATCH_MAX_FILES = 100  # больше файлов за одну пачку не удаляем, чтобы чаще сверяться с диском
+
+SegmentEntry = Tuple[int, int, str, int]  # pk, поток, путь, размер
+SEGMENT_ENTRY_FIELDS = ('pk', 'stream_id', 'path', 'size')
+
+
+class RetentionEngine:
+    """Освобождает место и соблюдает сроки/квоты хранения потоков.
+
+    Держит очередь старейших закрытых сегментов с известными размерами и
+    удаляет их пачками, рассчитанными по этим размерам: ``shutil.disk_usage``
+    вызывается один раз на пачку, а не на каждый файл. Объём записей каждого
+    потока ведётся счётчиком, поэтому проверка квот не обходит ни диск, ни индекс.
+    """
+    __slots__ = ('queue', 'usage', 'deleted_files', 'deleted_bytes')
+
+    def __init__(self):
+        self.queue: Deque[SegmentEntry] = deque()
+        self.usage: Dict[int, int] = defaultdict(int)
+        self.deleted_files = self.deleted_bytes = 0
+
+    def load_usage(self):
+        """Начальные значения счётчиков объёма потоков — один агрегирующий запрос к индексу."""
+        self.usage.clear()
+        for stream_id, total in Segment.objects.values_list('stream_id').annotate(total=Sum('size')):
+            self.usage[stream_id] = total or 0
+
+    def account(self, stream_id: int, size: int):
+        """Учитывает закрытый сегмент потока."""
+        self.usage[stream_id] += size
+
+    def forget(self, usage: Dict[int, int]):
+        """Вычитает объём сегментов, убранных из индекса помимо очистки (удаление старой директории)."""
+        for stream_id, size in usage.items():
+            self.usage[stream_id] -= size
+        self.queue.clear()  # в очереди могли остаться убранные сегменты
+
+    def _take_batch(self, need_bytes: int, skip: Collection[int] = ()) -> List[SegmentEntry]:
+        """Берёт из очереди старейшие сегменты, суммарно покрывающие need_bytes; сегменты skip не подгружаются."""
+        batch, planned = [], 0
+        while planned < need_bytes and len(batch) < BATCH_MAX_FILES:
+            if not self.queue:
+                taken = {entry[0] for entry in batch}.union(skip)
+                self.queue.extend(
+                    entry for entry in Segment.objects.filter(end__isnull=False)
+                    .order_by('start').values_list(*SEGMENT_ENTRY_FIELDS)[:QUEUE_REFILL_SIZE + len(taken)]
+                    if entry[0] not in taken
+                )
+                if not self.queue:
+                    break
+            batch.append(entry := self.queue.popleft())
+            planned += entry[3]
+        return batch
+
+    @staticmethod
+    def _unlink(batch: Iterable[SegmentEntry]) -> List[SegmentEntry]:
+        deleted = []
+        for entry in batch:
+            try:
+                os.unlink(entry[2])
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logger.error(f"Не удалось удалить файл {entry[2]}", exc_info=True)
+                continue
+            with suppress(OSError):
+                os.unlink(sidecar_path(entry[2]))
+            deleted.append(entry)
+        return deleted
+
+    @staticmethod
+    def _forget(batch: List[SegmentEntry]) -> List[SegmentEntry]:
+        """Убирает сегменты из индекса, если их путь не изменился (файл не перенесён в другую директорию)."""
+        current = dict(Segment.objects.filter(pk__in=[entry[0] for entry in batch]).values_list('pk', 'path'))
+        forgotten = [entry for entry in batch if current.get(entry[0]) == entry[2]]
+        Segment.objects.filter(pk__in=[entry[0] for entry in forgotten]).delete()
+        return forgotten
+
+    async def _delete(self, batch: List[SegmentEntry]) -> List[SegmentEntry]:
+        """Удаляет файлы в отдельном потоке и убирает их из индекса и счётчиков."""
+        deleted = await asyncio.to_thread(self._unlink, batch)
+        if deleted:
+            deleted = await sync_to_async(self._forget)(deleted)
+        for _pk, stream_id, _path, size in deleted:
+            self.usage[stream_id] -= size
+            self.deleted_bytes += size
+        self.deleted_files += len(deleted)
+        return deleted
+
+    @staticmethod
+    def _kept(batch: List[SegmentEntry], deleted: List[SegmentEntry]) -> Set[int]:
+        """Сегменты пачки, оставшиеся в индексе (файл не удалился) или убранные из него не этой очисткой."""
+        return {entry[0] for entry in batch}.difference(entry[0] for entry in deleted)
+
+    def reset(self):
+        """Сбрасывает очередь, например после смены директории записей."""
+        self.queue.clear()
+
+    async def enforce(self, records_dir, low_bytes: int, high_bytes: int) -> Tuple[int, int]:
+        """Удаляет старейшие сегменты, если свободно меньше low_bytes, пока не станет high_bytes.
+
+        Пачка, из которой ничего не удалилось, очистку не прерывает: её сегменты пропускаются до конца
+        вызова, а очистка останавливается, только когда удалять больше нечего.
+        Возвращает свободное место после очистки и число удалённых файлов.
+        """
+        free = (await asyncio.to_thread(shutil.disk_usage, records_dir)).free
+        if free >= low_bytes:
+            return free, 0
+        logger.warning(
+            f"Недостаточно места ({free / GB_DIVIDER:.2f} GB из необходимых {low_bytes / GB_DIVIDER:.0f} GB). "
+            f"Удаляю старые файлы до {high_bytes / GB_DIVIDER:.0f} GB...")
+        files, skipped = 0, set()
+        while free < high_bytes:
+            batch = await sync_to_async(self._take_batch)(high_bytes - free, skipped)
+            if not batch:
+                break
+            deleted = await self._delete(batch)
+            skipped |= self._kept(batch, deleted)
+            if not deleted:
+                continue
+            files += len(deleted)
+            free = (await asyncio.to_thread(shutil.disk_usage, records_dir)).free
+            logger.info(f"Удалено файлов: {len(deleted)}. Свободно: {free / GB_DIVIDER:.2f} GB.")
+        return free, files
+
+    # --- Сроки и квоты потоков ---
+
+    @staticmethod
+    def _expired(stream_ids: List[int], max_age_days: int, skip: Collection[int] = ()) -> List[SegmentEntry]:
+        cutoff = timezone.now() - timedelta(days=max_age_days)
+        # Диапазон по (stream, start) отсекает всё, что моложе срока: стоимость — O(удаляемых)
+        segments = (Segment.objects.filter(stream_id__in=stream_ids, start__lt=cutoff, end__lt=cutoff)
+                    .order_by('start').values_list(*SEGMENT_ENTRY_FIELDS))
+        return [entry for entry in segments[:QUEUE_REFILL_SIZE + len(skip)] if entry[0] not in skip]
+
+    @staticmethod
+    def _oldest(stream_ids: List[int], excess: int, skip: Collection[int] = ()) -> List[SegmentEntry]:
+        batch, planned = [], 0
+        segments = (Segment.objects.filter(stream_id__in=stream_ids, end__isnull=False)
+                    .order_by('start').values_list(*SEGMENT_ENTRY_FIELDS))
+        for entry in segments[:BATCH_MAX_FILES + len(skip)]:
+            if planned >= excess:
+                break
+            if entry[0] in skip:
+                continue
+            batch.append(entry)
+            planned += entry[3]
+        return batch
+
+    async def _delete_while(self, label: str, fetch) -> int:
+        """Удаляет пачки, которые возвращает fetch(skip), пока они не кончатся.
+
+        В skip — сегменты прошлых пачек, которые удалить не удалось: они не мешают дойти до следующих.
+        """
+        files, skipped = 0, set()
+        while batch := await sync_to_async(fetch)(skipped):
+            deleted = await self._delete(batch)
+            skipped |= self._kept(batch, deleted)
+            files += len(deleted)
+        if files:
+            logger.info(f"{label}: удалено файлов: {files}.")
+        return files
+
+    async def enforce_policies(self, streams: Iterable[Stream]) -> int:
+        """Применяет сроки хранения и квоты потоков и групп. Возвращает число удалённых файлов."""
+        files = 0
+        groups = {}
+        for stream in streams:
+            if max_age_days := stream.effective_max_age_days:
+                files += await self._delete_while(
+                    f"Срок хранения {stream} ({max_age_days} дн.)",
+                    lambda skip: self._expired([stream.pk], max_age_days, skip)
+                )
+            if max_bytes := stream.max_size_gb * GB_DIVIDER:
+                files += await self._delete_while(
+                    f"Квота {stream} ({stream.max_size_gb} GB)",
+                    lambda skip: self._oldest([stream.pk], self.usage[stream.pk] - max_bytes, skip)
+                )
+            if stream.group and stream.group.max_size_gb:
+                groups.setdefault(stream.group, []).append(stream.pk)
+        for group, stream_ids in groups.items():
+            max_bytes = group.max_size_gb * GB_DIVIDER
+            files += await self._delete_while(
+                f"Квота группы {group} ({group.max_size_gb} GB)",
+                lambda skip: self._oldest(stream_ids, sum(self.usage[pk] for pk in stream_ids) - max_bytes, skip)
+            )
+        return files
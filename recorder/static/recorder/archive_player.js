@@ -0,0 +1,53 @@
+// Просмотр архива и прямого эфира: встроенный HLS (Safari) или hls.js; по EXT-X-PROGRAM-DATE-TIME показывается время записи.
+document.addEventListener('DOMContentLoaded', () => {
+    const video = document.getElementById('archive-video');
+    if (video) initArchivePlayer(video);
+});
+
+function initArchivePlayer(video) {
+    const clock = document.getElementById('archive-clock');
+    const error = document.getElementById('archive-error');
+    const src = video.dataset.src;
+    const showError = (text) => {
+        error.textContent = text;
+        error.classList.remove('d-none');
+    };
+
+    if (window.Hls && Hls.isSupported()) {
+        // Живой просмотр держится в двух частях от края, архив буферизуется вперёд
+        const hls = new Hls(video.dataset.live ? {liveSyncDurationCount: 2, liveMaxLatencyDurationCount: 5}
+                                               : {maxBufferLength: 30});
+        let fragment = null;
+        hls.on(Hls.Events.FRAG_CHANGED, (_event, data) => { fragment = data.frag; });
+        hls.on(Hls.Events.ERROR, (_event, data) => {
+            if (!data.fatal) return;
+            if (data.response && data.response.code === 404) {
+                showError(video.dataset.live ? 'Живой просмотр недоступен: поток не записывается или просмотр выключен.'
+                                             : 'За указанный период записи не найдены.');
+                hls.destroy();
+            } else if (data.type === Hls.ErrorTypes.MEDIA_ERROR) {
+                hls.recoverMediaError();
+            } else {
+                showError('Ошибка воспроизведения: ' + data.details);
+            }
+        });
+        video.addEventListener('timeupdate', () => {
+            if (!fragment || !fragment.programDateTime) return;
+            const offset = video.currentTime - fragment.start;
+            clock.textContent = new Date(fragment.programDateTime + offset * 1000).toLocaleString();
+        });
+        hls.loadSource(src);
+        hls.attachMedia(video);
+    } else if (video.canPlayType('application/vnd.apple.mpegurl')) {
+        video.src = src;
+        video.addEventListener('timeupdate', () => {
+            const start = video.getStartDate && video.getStartDate();
+            if (start && !isNaN(start.getTime())) {
+                clock.textContent = new Date(start.getTime() + video.currentTime * 1000).toLocaleString();
+            }
+        });
+        video.addEventListener('error', () => showError('Ошибка воспроизведения.'));
+    } else {
+        showError('Браузер не поддерживает воспроизведение HLS.');
+    }
+}
@@ -0,0 +1,59 @@
+// Ленивая загрузка логов: последние строки, подгрузка более ранних и слежение через Server-Sent Events.
+document.addEventListener('DOMContentLoaded', () => {
+    document.querySelectorAll('.log-viewer').forEach(initLogViewer);
+});
+
+function initLogViewer(root) {
+    const output = root.querySelector('[data-log-output]');
+    const earlier = root.querySelector('[data-log-earlier]');
+    const follow = root.querySelector('[data-log-follow]');
+    let start = 0, end = null, source = null;
+
+    const load = (before) => {
+        const url = new URL(root.dataset.tailUrl, window.location.href);
+        if (before !== undefined) url.searchParams.set('before', before);
+        return fetch(url).then(response => response.json());
+    };
+    const isAtBottom = () => output.scrollHeight - output.scrollTop - output.clientHeight < 20;
+
+    load().then(data => {
+        output.textContent = data.missing ? 'Лог-файл не найден.' : data.text;
+        start = data.start;
+        end = data.end;
+        earlier.disabled = start <= 0;
+        output.scrollTop = output.scrollHeight;
+    });
+
+    earlier.addEventListener('click', () => {
+        earlier.disabled = true;
+        load(start).then(data => {
+            const height = output.scrollHeight;
+            output.textContent = data.text + output.textContent;
+            output.scrollTop += output.scrollHeight - height;
+            start = data.start;
+            earlier.disabled = start <= 0;
+        });
+    });
+
+    follow.addEventListener('change', () => {
+        if (source) {
+            source.close();
+            source = null;
+        }
+        if (!follow.checked) return;
+        const url = new URL(root.dataset.followUrl, window.location.href);
+        if (end !== null) url.searchParams.set('from', end);
+        source = new EventSource(url);
+        source.onmessage = event => {
+            const stick = isAtBottom();
+            output.textContent += event.data + '\n';
+            end = Number(event.lastEventId);
+            if (stick) output.scrollTop = output.scrollHeight;
+        };
+        source.addEventListener('rotate', () => {
+            output.textContent = '';
+            start = end = 0;
+            earlier.disabled = true;
+        });
+    });
+}
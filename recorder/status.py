@@ -0,0 +1,96 @@
+"""Живые метрики записи: разбор ``ffmpeg -progress`` и снимок состояния службы для веб-процесса."""
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import ujson as json
+from django.conf import settings
+
+STATUS_FILE: Path = settings.RUN_DIR / 'status.json'
+STATUS_STALE_AFTER = 15  # секунд: более старый снимок значит, что служба записи не работает
+
+
+def _number(raw: str, suffix: str = '') -> Optional[float]:
+    """Число из значения -progress ('N/A' и пустые значения — None)."""
+    try:
+        return float(raw.removesuffix(suffix))
+    except ValueError:
+        return None
+
+
+class IngestStats:
+    """Последние значения ``-progress`` одного ffmpeg. Обновляется построчно, без выделения словарей."""
+    __slots__ = ('frame', 'fps', 'bitrate', 'total_size', 'out_time', 'drop_frames', 'dup_frames', 'speed',
+                 'updated')
+
+    def __init__(self):
+        self.frame = self.total_size = self.drop_frames = self.dup_frames = 0
+        self.fps = self.bitrate = self.out_time = self.speed = None
+        self.updated = 0.0
+
+    def feed(self, line: bytes):
+        """Учитывает одну строку ``ключ=значение``; блок завершается строкой ``progress=...``."""
+        key, sep, value = line.strip().partition(b'=')
+        if not sep:
+            return
+        value = value.decode('ascii', 'replace').strip()
+        if key == b'frame':
+            self.frame = int(_number(value) or 0)
+        elif key == b'fps':
+            self.fps = _number(value)
+        elif key == b'bitrate':
+            self.bitrate = _number(value, 'kbits/s')
+        elif key == b'total_size':
+            self.total_size = int(_number(value) or 0)
+        elif key == b'out_time_us':
+            out_time = _number(value)
+            self.out_time = None if out_time is None else out_time / 1e6
+        elif key == b'drop_frames':
+            self.drop_frames = int(_number(value) or 0)
+        elif key == b'dup_frames':
+            self.dup_frames = int(_number(value) or 0)
+        elif key == b'speed':
+            self.speed = _number(value, 'x')
+        elif key == b'progress':
+            self.updated = time.time()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def write_atomic(path: Path, data: bytes):
+    """Атомарно заменяет файл: читатель видит либо старое, либо новое содержимое целиком."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'.{path.name}.tmp')
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def write_status(status: Dict[str, Any], path: Path = STATUS_FILE):
+    write_atomic(path, json.dumps(status).encode())
+
+
+_cache = (None, {})
+
+
+def read_status(path: Path = STATUS_FILE) -> Dict[str, Any]:
+    """Последний снимок службы записи (разбирается заново только после изменения файла).
+
+    Возвращает пустой словарь, если служба не запущена или давно не обновляла снимок.
+    """
+    global _cache
+    try:
+        stat_result = path.stat()
+    except FileNotFoundError:
+        return {}
+    key = (stat_result.st_mtime_ns, stat_result.st_size)
+    if _cache[0] != key:
+        try:
+            _cache = (key, json.loads(path.read_text(encoding='UTF-8')))
+        except (OSError, ValueError):
+            return {}
+    status = _cache[1]
+    if time.time() - status.get('updated', 0) > STATUS_STALE_AFTER:
+        return {}
+    return status
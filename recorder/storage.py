@@ -0,0 +1,369 @@
+"""Фоновые задачи над архивом: перенос записей в новую директорию и удаление старой."""
+import asyncio
+import errno
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from .models import Segment, StorageTask
+from .retention import RetentionEngine
+
+logger = logging.getLogger(__name__)
+
+RELOCATION_WORKERS = 4  # параллельных переносов файлов
+DELETION_WORKERS = 4  # параллельных удалений файлов
+DELETION_MAX_FILES_PER_SEC = 200  # бюджет IOPS на удаление, чтобы не мешать записи ffmpeg
+DELETION_MAX_BYTES_PER_SEC = 4 << 30  # бюджет освобождаемого объёма в секунду
+CHECKPOINT_INTERVAL = 1  # секунд между сохранениями прогресса удаления
+COPY_CHUNK = 64 << 20  # байт за один вызов copy_file_range/sendfile
+SKIP_FILES = frozenset({'stop.flag', 'restart.flag', 'export.flag'})
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+
+def walk_entries(root: Path) -> Iterator[os.DirEntry]:
+    """Обходит дерево через os.scandir: тип файла берётся из readdir, без лишних stat."""
+    stack = [str(root)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        yield entry
+        except FileNotFoundError:
+            continue
+
+
+class Throttle:
+    """Ограничитель скорости по операциям и байтам в секунду (виртуальные часы)."""
+    __slots__ = ('ops_per_sec', 'bytes_per_sec', 'burst', '_next')
+
+    def __init__(self, ops_per_sec: float = 0, bytes_per_sec: float = 0, burst: float = 0.5):
+        self.ops_per_sec = ops_per_sec
+        self.bytes_per_sec = bytes_per_sec
+        self.burst = burst
+        self._next = 0.0
+
+    async def acquire(self, ops: int = 1, nbytes: int = 0):
+        """Ждёт, пока бюджет позволит выполнить ops операций над nbytes байт."""
+        now = time.monotonic()
+        self._next = max(self._next, now - self.burst)
+        self._next += max(
+            ops / self.ops_per_sec if self.ops_per_sec else 0,
+            nbytes / self.bytes_per_sec if self.bytes_per_sec else 0,
+        )
+        if (delay := self._next - now) > 0:
+            await asyncio.sleep(delay)
+
+
+def remove_empty_dirs(root: Path):
+    """Удаляет опустевшие каталоги снизу вверх, включая сам root."""
+    for dirpath, _dirnames, _filenames in os.walk(root, topdown=False):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            pass
+
+
+def _kernel_copy(infd: int, outfd: int, size: int) -> bool:
+    """Копирует данные внутри ядра: copy_file_range, затем sendfile. False — если ни один не поддержан."""
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range:
+        copied = 0
+        try:
+            while copied < size and (n := copy_file_range(infd, outfd, min(COPY_CHUNK, size - copied))):
+                copied += n
+            return True
+        except OSError as e:
+            if copied or e.errno not in _FALLBACK_ERRNOS:
+                raise
+    if hasattr(os, 'sendfile'):
+        copied = 0
+        try:
+            while copied < size and (n := os.sendfile(outfd, infd, copied, min(COPY_CHUNK, size - copied))):
+                copied += n
+            return True
+        except OSError as e:
+            if copied or e.errno not in _FALLBACK_ERRNOS:
+                raise
+    return False
+
+
+def copy_file(src: str, dst: str):
+    """Копирует файл через временный .part, чтобы прерванная копия не выглядела готовой."""
+    tmp = dst + '.part'
+    with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        if not _kernel_copy(fsrc.fileno(), fdst.fileno(), size):
+            shutil.copyfileobj(fsrc, fdst, COPY_CHUNK)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+
+
+def move_file(src: str, dst: str) -> Optional[int]:
+    """Переносит файл: rename на той же ФС, иначе копирование ядром и удаление исходника.
+
+    Возвращает размер или None, если исходный файл уже исчез (например, удалён очисткой).
+    """
+    try:
+        size = os.stat(src).st_size
+    except FileNotFoundError:
+        return None
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.rename(src, dst)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_file(src, dst)
+        os.unlink(src)
+    return size
+
+
+class StorageJob:
+    """Общая часть фоновых задач: прогресс в БД, чтобы после сбоя продолжить."""
+    __slots__ = ('task', 'workers', 'retention')
+
+    def __init__(self, task: StorageTask, workers: int, retention: RetentionEngine = None):
+        self.task = task
+        self.workers = workers
+        self.retention = retention
+
+    def _begin(self):
+        task = self.task
+        if task.status == 'pending':
+            totals = Segment.objects.filter(path__startswith=os.path.join(task.source, '')).aggregate(
+                files=Count('pk'), size=Sum('size'))
+            task.files_total, task.bytes_total = totals['files'], totals['size'] or 0
+        task.status = 'running'
+        task.save()
+
+    def _progress(self, files: int, size: int):
+        task = self.task
+        task.files_done += files
+        task.bytes_done += size
+        task.save(update_fields=['files_done', 'bytes_done', 'updated_at'])
+
+    def _finish(self, error: str = ''):
+        task = self.task
+        task.status, task.error = ('failed', error) if error else ('done', '')
+        task.save(update_fields=['status', 'error', 'updated_at'])
+
+    async def run(self):
+        raise NotImplementedError
+
+
+class Relocation(StorageJob):
+    """Перенос архива из старой директории записей в новую.
+
+    Работает в фоне на ограниченном пуле потоков, пока запись уже идёт в новую
+    директорию. После каждой пачки прогресс и пути в индексе сегментов
+    сохраняются в БД, поэтому после сбоя задача продолжается с того же места:
+    перенесённых файлов в старой директории уже нет. При остановке службы пачка
+    дожидается начатых переносов и сохраняет их; после аварийного завершения пути
+    файлов прерванной пачки восстанавливаются при продолжении.
+    """
+    __slots__ = ()
+
+    def __init__(self, task: StorageTask, workers: int = RELOCATION_WORKERS, retention: RetentionEngine = None):
+        super().__init__(task, workers, retention)
+
+    def _begin(self):
+        resumed = self.task.status == 'running'
+        super()._begin()
+        if resumed:
+            self._repoint()
+
+    def _repoint(self):
+        """После аварийного завершения: файлы прерванной пачки уже в целевой директории,
+        а в индексе остались старые пути — находим их по тому же относительному пути."""
+        task = self.task
+        moved = []
+        segments = Segment.objects.filter(path__startswith=os.path.join(task.source, ''))
+        for path, size in segments.values_list('path', 'size').iterator():
+            if os.path.exists(path):
+                continue
+            dst = os.path.join(task.target, os.path.relpath(path, task.source))
+            if os.path.exists(dst):
+                moved.append((path, dst, size))
+        if moved:
+            self._checkpoint(moved)
+            logger.warning(f"Перенос из '{task.source}': восстановлены пути {len(moved)} файлов прерванной пачки.")
+
+    @staticmethod
+    def _walk(source: Path) -> Tuple[List[str], int, int]:
+        """Файлы к переносу, а также число и объём тех из них, что войдут в прогресс (без флагов службы)."""
+        files, counted, size = [], 0, 0
+        for entry in walk_entries(source):
+            files.append(entry.path)
+            if entry.name in SKIP_FILES:
+                continue
+            try:
+                size += entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                continue
+            counted += 1
+        return files, counted, size
+
+    def _set_totals(self, files: int, size: int):
+        """Итог по тому же обходу, по которому считается прогресс; при продолжении — вместе с уже перенесённым."""
+        task = self.task
+        task.files_total, task.bytes_total = task.files_done + files, task.bytes_done + size
+        task.save(update_fields=['files_total', 'bytes_total', 'updated_at'])
+
+    def _checkpoint(self, moved: List[Tuple[str, str, int]]):
+        with transaction.atomic():
+            for src, dst, size in moved:
+                Segment.objects.filter(path=src).update(path=dst)
+            self._progress(len(moved), sum(size for _src, _dst, size in moved))
+
+    def _move(self, src: str) -> Optional[Tuple[str, str, int]]:
+        if os.path.basename(src) in SKIP_FILES:
+            os.unlink(src)
+            return None
+        dst = os.path.join(self.task.target, os.path.relpath(src, self.task.source))
+        # Не затираем файлы, которые уже пишутся в новой директории (например, ffmpeg.log)
+        base, n = dst, 0
+        while os.path.exists(dst):
+            n += 1
+            dst = f'{base}.old{n if n > 1 else ""}'
+        size = move_file(src, dst)
+        return None if size is None else (src, dst, size)
+
+    async def run(self):
+        task = self.task
+        source = Path(task.source)
+        await sync_to_async(self._begin)()
+        logger.warning(f"Перенос записей из '{source}' в '{task.target}' выполняется в фоне.")
+        files, counted, size = await asyncio.to_thread(self._walk, source)
+        await sync_to_async(self._set_totals)(counted, size)
+        loop = asyncio.get_running_loop()
+        failed = 0
+        chunk = self.workers * 4
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='relocate') as pool:
+            for i in range(0, len(files), chunk):
+                moving = asyncio.gather(
+                    *(loop.run_in_executor(pool, self._move, src) for src in files[i:i + chunk]),
+                    return_exceptions=True
+                )
+                try:
+                    results = await asyncio.shield(moving)
+                except asyncio.CancelledError:
+                    # Начатые переносы всё равно завершатся в потоках: сохраняем их пути до выхода
+                    results = await moving
+                    moved = [result for result in results if result and not isinstance(result, BaseException)]
+                    if moved:
+                        await sync_to_async(self._checkpoint)(moved)
+                    raise
+                moved = []
+                for src, result in zip(files[i:i + chunk], results):
+                    if isinstance(result, BaseException):
+                        failed += 1
+                        logger.error(f"Не удалось перенести '{src}': {result}")
+                    elif result:
+                        moved.append(result)
+                if moved:
+                    await sync_to_async(self._checkpoint)(moved)
+        if failed:
+            await sync_to_async(self._finish)(f"Не перенесено файлов: {failed}.")
+            logger.error(f"Перенос из '{source}' завершён с ошибками: не перенесено файлов: {failed}.")
+            return
+        await asyncio.to_thread(remove_empty_dirs, source)
+        await sync_to_async(self._finish)()
+        logger.info(
+            f"Перенос из '{source}' успешно завершён: {task.files_done} файлов, "
+            f"{task.bytes_done / (1 << 30):.2f} GB.")
+
+
+class Deletion(StorageJob):
+    """Удаление старой директории записей.
+
+    Обходит дерево через os.scandir и удаляет файлы на пуле потоков в пределах
+    бюджета операций и байт в секунду, чтобы не отнимать диск у записи.
+    Записи индекса удаляются сразу: эти файлы больше не выдаются в архиве,
+    а их объём сразу вычитается из счётчиков квот потоков.
+    """
+    __slots__ = ('throttle', 'forgotten')
+
+    def __init__(self, task: StorageTask, workers: int = DELETION_WORKERS, throttle: Throttle = None,
+                 retention: RetentionEngine = None):
+        super().__init__(task, workers, retention)
+        self.throttle = throttle or Throttle(DELETION_MAX_FILES_PER_SEC, DELETION_MAX_BYTES_PER_SEC)
+        self.forgotten: Dict[int, int] = {}
+
+    def _begin(self):
+        super()._begin()
+        segments = Segment.objects.filter(path__startswith=os.path.join(self.task.source, ''))
+        self.forgotten = dict(segments.values_list('stream_id').annotate(total=Sum('size')))
+        segments.delete()
+
+    @staticmethod
+    def _next_batch(entries: Iterator[os.DirEntry], count: int) -> List[Tuple[os.DirEntry, int]]:
+        batch = []
+        for entry in islice(entries, count):
+            try:
+                batch.append((entry, entry.stat(follow_symlinks=False).st_size))
+            except FileNotFoundError:
+                continue
+        return batch
+
+    @staticmethod
+    def _unlink(entry: os.DirEntry, size: int) -> int:
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            return 0
+        return size
+
+    async def run(self):
+        task = self.task
+        source = Path(task.source)
+        await sync_to_async(self._begin)()
+        if self.retention is not None:
+            self.retention.forget(self.forgotten)
+        logger.warning(f"Удаление записей в '{source}' выполняется в фоне.")
+        loop = asyncio.get_running_loop()
+        entries = walk_entries(source)
+        chunk = self.workers * 4
+        failed = files = size = 0
+        last_checkpoint = time.monotonic()
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='delete') as pool:
+            while batch := await asyncio.to_thread(self._next_batch, entries, chunk):
+                futures = []
+                for entry, entry_size in batch:
+                    await self.throttle.acquire(1, entry_size)
+                    futures.append(loop.run_in_executor(pool, self._unlink, entry, entry_size))
+                for (entry, _size), result in zip(batch, await asyncio.gather(*futures, return_exceptions=True)):
+                    if isinstance(result, BaseException):
+                        failed += 1
+                        logger.error(f"Не удалось удалить '{entry.path}': {result}")
+                    else:
+                        files += 1
+                        size += result
+                if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                    await sync_to_async(self._progress)(files, size)
+                    files = size = 0
+                    last_checkpoint = time.monotonic()
+        await sync_to_async(self._progress)(files, size)
+        if failed:
+            await sync_to_async(self._finish)(f"Не удалено файлов: {failed}.")
+            logger.error(f"Удаление '{source}' завершено с ошибками: не удалено файлов: {failed}.")
+            return
+        await asyncio.to_thread(remove_empty_dirs, source)
+        await sync_to_async(self._finish)()
+        logger.info(
+            f"Директория '{source}' удалена: {task.files_done} файлов, {task.bytes_done / (1 << 30):.2f} GB.")
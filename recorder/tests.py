@@ -1,3 +1,1087 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import logging
+import tarfile
+import tempfile
+import zipfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from logging.handlers import QueueListener
+from pathlib import Path
+from queue import SimpleQueue
+from typing import List, Optional
+from unittest import mock, skipIf
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import retention, tsindex, views
+from .archive import ArchiveLayout, _read_tail, _trim, parse_range, read_parts, read_parts_padded
+from .bundle import TarBundle, ZipBundle, entries_from_segments
+from .exports import Export, evict, export_key, request_export
+from .hls import build_playlist
+from .logs import JsonFormatter, LogQueueHandler, LogRing, RotatingLog, clear_log, read_new, read_tail
+from .management.commands.rec_service import RESTART_BACKOFF_MAX, Command, StreamRecorder, _restart_delay
+from .metrics import Histogram, parse_mdstat
+from .models import ExportJob, Segment, StorageTask, Stream, StreamGroup, System
+from .retention import RetentionEngine
+from .status import IngestStats
+from .storage import Deletion, Relocation
+from .tsindex import PTS_WRAP, TS_PACKET, load_index, scan, sidecar_path, write_sidecar
+
+T0 = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def collect(chunks) -> bytes:
+    """Тело асинхронного потока блоков целиком."""
+    async def read():
+        return b''.join([data async for data in chunks])
+    return asyncio.run(read())
+
+
+def ts_packet(pid: int, payload: bytes, unit_start: bool = False, random_access: bool = False) -> bytes:
+    """Пакет MPEG-TS; до 184 байт дополняется адаптационным полем."""
+    stuffing = TS_PACKET - 4 - 2 - len(payload)
+    adaptation = bytes([1 + stuffing, 0x40 if random_access else 0]) + b'\xff' * stuffing
+    return bytes([0x47, (0x40 if unit_start else 0) | pid >> 8, pid & 0xff, 0x30]) + adaptation + payload
+
+
+def ts_section(table_id: int, body: bytes) -> bytes:
+    """PSI-секция с pointer_field; CRC сканер не проверяет."""
+    return bytes([0, table_id, 0xb0 | (len(body) + 4) >> 8, (len(body) + 4) & 0xff]) + body + bytes(4)
+
+
+def ts_pts(value: int) -> bytes:
+    return bytes([0x21 | (value >> 29) & 0x0e, (value >> 22) & 0xff, (value >> 14) & 0xfe | 1,
+                  (value >> 7) & 0xff, (value << 1) & 0xfe | 1])
+
+
+def make_ts(frames: int = 100, gop: int = 25, first_pts: int = 126000, filler: int = 2) -> bytes:
+    """Сегмент с PAT, PMT (видео H.264 на PID 0x100, звук на 0x101) и кадрами по 25 в секунду."""
+    data = bytearray(ts_packet(0, ts_section(0x00, bytes([0, 1, 0xc1, 0, 0, 0, 1, 0xf0, 0x00])), True))
+    streams = bytes([0x1b, 0xe1, 0x00, 0xf0, 0x00, 0x0f, 0xe1, 0x01, 0xf0, 0x00])
+    data += ts_packet(0x1000, ts_section(0x02, bytes([0, 1, 0xc1, 0, 0, 0xe1, 0x00, 0xf0, 0x00]) + streams), True)
+    for frame in range(frames):
+        pts = (first_pts + frame * 3600) % PTS_WRAP
+        data += ts_packet(0x100, b'\x00\x00\x01\xe0\x00\x00\x80\x80\x05' + ts_pts(pts), True, frame % gop == 0)
+        for _ in range(filler):
+            data += ts_packet(0x100, b'\xaa' * 182)
+        data += ts_packet(0x101, b'\x00\x00\x01\xc0\x00\x00\x80\x80\x05' + ts_pts(pts), True)
+    return bytes(data)
+
+
+class TempDirMixin:
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_forms(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 100))
+        self.assertEqual(parse_range('bytes=500-', 1000), (500, 1000))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 1000))
+        self.assertEqual(parse_range('bytes=-5000', 1000), (0, 1000))
+        self.assertEqual(parse_range('bytes=900-5000', 1000), (900, 1000))
+
+    def test_unsupported(self):
+        for header in ('bytes=0-1,5-6', 'items=0-1', 'bytes=a-b', 'bytes=-', 'bytes=5'):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range(header, 1000))
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=1000-', 'bytes=5-4', 'bytes=-0'):
+            with self.subTest(header=header), self.assertRaises(ValueError):
+                parse_range(header, 1000)
+        with self.assertRaises(ValueError):
+            parse_range('bytes=-10', 0)
+
+
+class ArchiveLayoutTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.paths = []
+        for name, data in (('a.ts', b'a' * 10), ('b.ts', b'b' * 20), ('c.ts', b'c' * 5)):
+            path = self.dir / name
+            path.write_bytes(data)
+            self.paths.append(str(path))
+        self.layout = ArchiveLayout([(self.paths[0], 0, 10), (self.paths[1], 0, 20), (self.paths[2], 0, 5)])
+
+    def test_parts(self):
+        self.assertEqual(self.layout.length, 35)
+        self.assertEqual(self.layout.parts(), [(self.paths[0], 0, 10), (self.paths[1], 0, 20), (self.paths[2], 0, 5)])
+        self.assertEqual(self.layout.parts(5, 32), [(self.paths[0], 5, 5), (self.paths[1], 0, 20),
+                                                    (self.paths[2], 0, 2)])
+        self.assertEqual(self.layout.parts(10, 30), [(self.paths[1], 0, 20)])
+        self.assertEqual(self.layout.parts(12, 100), [(self.paths[1], 2, 18), (self.paths[2], 0, 5)])
+        self.assertEqual(self.layout.parts(35), [])
+
+    def test_ranges_match_body(self):
+        body = collect(read_parts(self.layout.parts()))
+        self.assertEqual(body, b'a' * 10 + b'b' * 20 + b'c' * 5)
+        for start, end in ((0, 1), (9, 11), (3, 33), (30, 35)):
+            with self.subTest(start=start, end=end):
+                self.assertEqual(collect(read_parts(self.layout.parts(start, end), chunk_size=4)), body[start:end])
+
+    def test_trim_without_index_keeps_segment(self):
+        path = str(self.dir / 'gone.ts')
+        self.assertEqual(_trim(path, 100, 1.0, None), [(path, 0, 100)])
+
+    def test_padded_body_keeps_length(self):
+        Path(self.paths[0]).unlink()  # удалён очисткой во время отдачи
+        Path(self.paths[1]).write_bytes(b'b' * 15)  # укорочен
+        with self.assertLogs('recorder.archive', 'WARNING') as logs:
+            body = collect(read_parts_padded(self.layout.parts(5, 35), chunk_size=4))
+        self.assertEqual(body, bytes(5) + b'b' * 15 + bytes(5) + b'c' * 5)
+        self.assertEqual(len(logs.output), 2)
+
+    def test_from_segments(self):
+        segments = [
+            (self.paths[0], 10, T0, T0 + timedelta(minutes=1)),
+            (str(self.dir / 'missing.ts'), 0, T0 + timedelta(minutes=1), None),  # удалён до открытия
+            (self.paths[1], 0, T0 + timedelta(minutes=2), None),  # ещё пишется: размер с диска
+        ]
+        layout = ArchiveLayout.from_segments(segments)
+        self.assertEqual(layout.files, [(self.paths[0], 0, 10), (self.paths[1], 0, 20)])
+        self.assertEqual(layout.etag, ArchiveLayout.from_segments(segments).etag)
+        self.assertNotEqual(layout.etag, self.layout.etag)
+
+
+class TsIndexTests(TempDirMixin, SimpleTestCase):
+    FRAME_PACKETS = 4  # видео с PES-заголовком, два продолжения, звук
+
+    def frame_offset(self, frame: int) -> int:
+        return (2 + frame * self.FRAME_PACKETS) * TS_PACKET
+
+    def test_scan(self):
+        index = scan(make_ts())
+        self.assertEqual(len(index), 100)
+        self.assertEqual(index.tables, (0, TS_PACKET))
+        self.assertEqual([int(offset) for offset in index.offsets[:2]], [self.frame_offset(0), self.frame_offset(1)])
+        self.assertEqual(index.key_times, [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(index.key_offsets, [self.frame_offset(frame) for frame in (0, 25, 50, 75)])
+        self.assertEqual(index.offset_before(1.5), self.frame_offset(25))
+        self.assertEqual(index.offset_after(1.5), self.frame_offset(50))
+        self.assertIsNone(index.offset_after(3.5))
+
+    def test_sync_offset_and_pts_wrap(self):
+        index = scan(b'\x00' * 100 + make_ts(first_pts=PTS_WRAP - 90000))  # мусор перед сеткой, PTS через 0
+        self.assertEqual(index.tables, (100, 100 + TS_PACKET))
+        self.assertEqual(index.key_times, [0.0, 1.0, 2.0, 3.0])
+
+    @skipIf(tsindex.np is None, "NumPy не установлен")
+    def test_python_and_numpy_agree(self):
+        data = b'\x00' * 100 + make_ts(first_pts=PTS_WRAP - 90000)  # мусор перед сеткой и переход PTS через 0
+        base = tsindex._sync_offset(data)
+        count = (len(data) - base) // TS_PACKET
+        fast, slow = tsindex._scan_numpy(data, base, count), tsindex._scan_python(data, base, count)
+        self.assertEqual(base, 100)
+        self.assertEqual(fast.offsets.tolist(), slow.offsets)
+        self.assertEqual(fast.pts.tolist(), slow.pts)
+        self.assertEqual(fast.keys.tolist(), slow.keys)
+        self.assertEqual(fast.tables, slow.tables)
+        self.assertEqual(fast.key_times, [0.0, 1.0, 2.0, 3.0])
+
+    def test_growing_segment_scans_only_appended(self):
+        data = b'\x00' * 100 + make_ts()
+        full = scan(data)
+        for numpy in {tsindex.np, None}:
+            path = self.dir / f'growing_{numpy is not None}.ts'
+            with self.subTest(numpy=numpy is not None), mock.patch.object(tsindex, 'np', numpy), \
+                    mock.patch.object(tsindex, 'scan_file', wraps=tsindex.scan_file) as scan_file:
+                for size in (1000, 5001, 5001 + TS_PACKET // 2, len(data)):  # пакеты дописываются не целиком
+                    path.write_bytes(data[:size])
+                    index = load_index(str(path))
+                self.assertEqual(scan_file.call_count, 1)
+                self.assertEqual([int(offset) for offset in index.offsets], [int(offset) for offset in full.offsets])
+                self.assertEqual(index.key_times, full.key_times)
+                self.assertEqual(index.tables, full.tables)
+
+                path.write_bytes(data[:3000])  # файл перезаписан короче: сканируется заново
+                self.assertEqual(len(load_index(str(path))), len(scan(data[:3000])))
+                self.assertEqual(scan_file.call_count, 2)
+
+    def test_not_ts(self):
+        self.assertEqual(len(scan(b'')), 0)
+        self.assertEqual(len(scan(bytes(1000))), 0)
+
+    def test_trimmed_layout(self):
+        path = self.dir / 'segment.ts'
+        path.write_bytes(data := make_ts())
+        segment = (str(path), len(data), T0, T0 + timedelta(seconds=4))
+        layout = ArchiveLayout.from_segments([segment], T0 + timedelta(seconds=1.5), T0 + timedelta(seconds=2.5))
+        cut_from, cut_to = self.frame_offset(25), self.frame_offset(75)
+        self.assertEqual(layout.files, [(str(path), 0, TS_PACKET), (str(path), TS_PACKET, TS_PACKET),
+                                        (str(path), cut_from, cut_to - cut_from)])
+        body = collect(read_parts(layout.parts()))
+        self.assertEqual(body, data[:2 * TS_PACKET] + data[cut_from:cut_to])
+        self.assertEqual(scan(body).key_times, [0.0, 1.0])
+
+
+class SidecarTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = str(self.dir / 'segment.ts')
+        Path(self.path).write_bytes(make_ts())
+        tsindex._load.cache_clear()
+        self.addCleanup(tsindex._load.cache_clear)
+
+    def assertSameIndex(self, index, expected):
+        self.assertEqual(list(map(int, index.pts)), list(map(int, expected.pts)))
+        self.assertEqual(list(map(int, index.offsets)), list(map(int, expected.offsets)))
+        self.assertEqual(list(map(bool, index.keys)), list(map(bool, expected.keys)))
+        self.assertEqual(index.tables, expected.tables)
+        self.assertEqual(index.key_times, expected.key_times)
+
+    def test_round_trip(self):
+        self.assertEqual(write_sidecar(self.path), 100)
+        with mock.patch.object(tsindex, 'scan_file', side_effect=AssertionError("индекс не из спутника")):
+            index = load_index(self.path)
+        self.assertSameIndex(index, scan(Path(self.path).read_bytes()))
+
+    @skipIf(tsindex.np is None, "NumPy не установлен")
+    def test_python_format_matches_numpy(self):
+        data = Path(self.path).read_bytes()
+        index = scan(data)
+        packed = tsindex._pack(index, len(data))
+        with mock.patch.object(tsindex, 'np', None):
+            self.assertEqual(tsindex._pack(scan(data), len(data)), packed)
+            self.assertSameIndex(tsindex._unpack(packed, len(data)), index)
+
+    def test_stale_sidecar(self):
+        write_sidecar(self.path)
+        with open(self.path, 'ab') as f:
+            f.write(make_ts(frames=25, first_pts=126000 + 100 * 3600)[2 * TS_PACKET:])  # сегмент дописан
+        self.assertIsNone(tsindex._unpack(Path(sidecar_path(self.path)).read_bytes(), Path(self.path).stat().st_size))
+        self.assertEqual(len(load_index(self.path)), 125)
+
+    def test_damaged_or_missing(self):
+        Path(sidecar_path(self.path)).write_bytes(b'TSIX')
+        self.assertEqual(len(load_index(self.path)), 100)
+        self.assertIsNone(load_index(str(self.dir / 'missing.ts')))
+        self.assertIsNone(write_sidecar(str(self.dir / 'missing.ts')))
+
+
+class PlaylistTests(TempDirMixin, SimpleTestCase):
+    KEY_PACKETS = 25 * TsIndexTests.FRAME_PACKETS  # пакетов между ключевыми кадрами (раз в секунду)
+
+    def setUp(self):
+        super().setUp()
+        self.segments = []
+        for pk, first in ((1, T0), (2, T0 + timedelta(seconds=16))):
+            path = self.dir / f'{pk}.ts'
+            path.write_bytes(data := make_ts(frames=400))
+            self.segments.append((pk, str(path), len(data), first, first + timedelta(seconds=16)))
+        tsindex._load.cache_clear()
+        self.addCleanup(tsindex._load.cache_clear)
+
+    def key_offset(self, second: int) -> int:
+        return (2 + second * self.KEY_PACKETS) * TS_PACKET
+
+    def playlist(self, segments, start, end) -> Optional[List[str]]:
+        playlist = build_playlist(segments, start, end, lambda pk: f'/segment/{pk}')
+        return playlist.splitlines() if playlist is not None else None
+
+    def test_whole_segments(self):
+        lines = self.playlist(self.segments, T0, T0 + timedelta(minutes=1))
+        self.assertEqual(lines[:5], ['#EXTM3U', '#EXT-X-VERSION:6', '#EXT-X-TARGETDURATION:6',
+                                     '#EXT-X-PLAYLIST-TYPE:VOD', '#EXT-X-MEDIA-SEQUENCE:0'])
+        self.assertEqual(lines[5], f'#EXT-X-MAP:URI="/segment/1",BYTERANGE="{2 * TS_PACKET}@0"')
+        size = self.segments[0][2]
+        self.assertEqual(lines[7:16], [
+            '#EXTINF:6.000,', f'#EXT-X-BYTERANGE:{self.key_offset(6) - self.key_offset(0)}@{self.key_offset(0)}',
+            '/segment/1',
+            '#EXTINF:6.000,', f'#EXT-X-BYTERANGE:{self.key_offset(12) - self.key_offset(6)}@{self.key_offset(6)}',
+            '/segment/1',
+            '#EXTINF:4.000,', f'#EXT-X-BYTERANGE:{size - self.key_offset(12)}@{self.key_offset(12)}',
+            '/segment/1',
+        ])
+        self.assertEqual(lines[16:18], ['#EXT-X-DISCONTINUITY',
+                                        f'#EXT-X-MAP:URI="/segment/2",BYTERANGE="{2 * TS_PACKET}@0"'])
+        self.assertEqual(lines[-2:], ['/segment/2', '#EXT-X-ENDLIST'])
+        self.assertEqual(sum(line.startswith('#EXTINF') for line in lines), 6)
+
+    def test_period_cut_at_keyframes(self):
+        lines = self.playlist(self.segments[:1], T0 + timedelta(seconds=3.5), T0 + timedelta(seconds=9.5))
+        self.assertIn('#EXT-X-PROGRAM-DATE-TIME:'
+                      f'{timezone.localtime(T0 + timedelta(seconds=3)).isoformat(timespec="milliseconds")}', lines)
+        self.assertEqual([line for line in lines if line.startswith(('#EXTINF', '#EXT-X-BYTERANGE'))], [
+            '#EXTINF:6.000,', f'#EXT-X-BYTERANGE:{self.key_offset(9) - self.key_offset(3)}@{self.key_offset(3)}',
+            '#EXTINF:1.000,', f'#EXT-X-BYTERANGE:{self.key_offset(10) - self.key_offset(9)}@{self.key_offset(9)}',
+        ])
+
+    def test_open_segment_ends_at_last_keyframe(self):
+        pk, path, _size, first, _end = self.segments[0]
+        lines = self.playlist([(pk, path, 0, first, None)], T0, T0 + timedelta(minutes=1))
+        last = self.key_offset(12)
+        self.assertEqual(lines[-3], f'#EXT-X-BYTERANGE:{self.key_offset(15) - last}@{last}')
+
+    def test_nothing_to_play(self):
+        self.assertIsNone(self.playlist([], T0, T0 + timedelta(minutes=1)))
+        missing = (3, str(self.dir / 'missing.ts'), 0, T0, None)
+        self.assertIsNone(self.playlist([missing], T0, T0 + timedelta(minutes=1)))
+
+
+class BundleTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = {}
+        segments = []
+        for minute, size in enumerate((0, 1, 511, 512, 70000)):
+            path = self.dir / f'{minute:02}.ts'
+            path.write_bytes(data := bytes(range(256)) * (size // 256) + b'x' * (size % 256))
+            self.files[f'1_camera_admin/{path.name}'] = data
+            start = T0 + timedelta(minutes=minute)
+            segments.append((str(path), size, start, start + timedelta(minutes=1)))
+        self.entries = entries_from_segments('1_camera_admin', segments)
+
+    def test_empty_files_skipped(self):
+        self.assertEqual([entry.name for entry in self.entries], list(self.files)[1:])
+
+    def test_zip(self):
+        bundle = ZipBundle(self.entries)
+        body = collect(bundle.stream())
+        self.assertEqual(len(body), bundle.length)
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual({name: archive.read(name) for name in archive.namelist()},
+                             dict(list(self.files.items())[1:]))
+            self.assertEqual(archive.getinfo('1_camera_admin/01.ts').date_time[:1], (2024,))
+
+    def test_tar(self):
+        bundle = TarBundle(self.entries)
+        body = collect(bundle.stream())
+        self.assertEqual(len(body), bundle.length)
+        with tarfile.open(fileobj=io.BytesIO(body)) as archive:
+            self.assertEqual({member.name: archive.extractfile(member).read() for member in archive},
+                             dict(list(self.files.items())[1:]))
+
+    def test_long_names(self):
+        entries = entries_from_segments('камера/' + 'x' * 200, [(str(self.dir / '01.ts'), 1, T0, T0)])
+        for bundle_class in (ZipBundle, TarBundle):
+            with self.subTest(bundle=bundle_class.extension):
+                bundle = bundle_class(entries)
+                self.assertEqual(len(collect(bundle.stream())), bundle.length)
+
+    def test_file_shrunk_during_export(self):
+        bundle = ZipBundle(self.entries)
+        (self.dir / '04.ts').write_bytes(b'short')  # очистка или перезапись во время выгрузки
+        with self.assertLogs('recorder.bundle', 'WARNING'):
+            body = collect(bundle.stream())
+        self.assertEqual(len(body), bundle.length)
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertEqual(archive.read('1_camera_admin/04.ts'), b'short' + bytes(70000 - 5))
+
+
+class RecordsMixin(TempDirMixin):
+    """Директория записей во временном каталоге и поток с сегментами в индексе."""
+    def setUp(self):
+        super().setUp()
+        System.objects.create(pk=1, records_dir=str(self.dir / 'video'))
+        self.stream = Stream.objects.create(host='camera', password='secret')
+
+    def add_segments(self, stream: Stream, count: int, first: datetime, size: int = 100,
+                     step: timedelta = timedelta(minutes=1)) -> List[Path]:
+        paths = []
+        for number in range(count):
+            path = self.dir / f'{stream.pk}_{first.timestamp():.0f}_{number}.ts'
+            path.write_bytes(bytes(size))
+            start = first + number * step
+            Segment.objects.create(stream=stream, start=start, end=start + step, size=size, path=str(path))
+            paths.append(path)
+        return paths
+
+    def remaining(self, stream: Stream) -> List[str]:
+        return list(Segment.objects.filter(stream=stream).order_by('start').values_list('path', flat=True))
+
+
+class RetentionEngineTests(RecordsMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.engine = RetentionEngine()
+
+    def enforce(self, low: int, high: int, free: int):
+        """Очистка на «диске», где свободно free плюс всё удалённое движком."""
+        def disk_usage(_path):
+            return mock.Mock(free=free + self.engine.deleted_bytes)
+        with mock.patch.object(retention.shutil, 'disk_usage', disk_usage), self.assertLogs('recorder.retention'):
+            return asyncio.run(self.engine.enforce(self.dir, low, high))
+
+    def test_frees_oldest_up_to_high_watermark(self):
+        paths = self.add_segments(self.stream, 10, T0)
+        self.engine.load_usage()
+        self.assertEqual(self.enforce(300, 500, 100), (500, 4))
+        self.assertEqual(self.remaining(self.stream), [str(path) for path in paths[4:]])
+        self.assertFalse(any(path.exists() for path in paths[:4]))
+        self.assertEqual(self.engine.usage[self.stream.pk], 600)
+
+    def test_enough_space(self):
+        self.add_segments(self.stream, 3, T0)
+        with mock.patch.object(retention.shutil, 'disk_usage', return_value=mock.Mock(free=300)):
+            self.assertEqual(asyncio.run(self.engine.enforce(self.dir, 300, 500)), (300, 0))
+        self.assertEqual(Segment.objects.count(), 3)
+
+    def test_stale_rows_and_open_segments(self):
+        paths = self.add_segments(self.stream, 4, T0)
+        paths[0].unlink()  # файл уже удалён, строка индекса осталась
+        Segment.objects.filter(path=str(paths[3])).update(end=None)  # пишется сейчас
+        self.engine.load_usage()
+        self.assertEqual(self.enforce(1000, 1000, 0)[1], 3)
+        self.assertEqual(self.remaining(self.stream), [str(paths[3])])
+
+    def test_undeletable_batch_does_not_stop_cleanup(self):
+        stuck = self.dir / 'stuck'
+        stuck.mkdir()
+        for number in range(retention.BATCH_MAX_FILES):
+            (stuck / f'{number}.ts').mkdir()  # os.unlink каталога — ошибка, строка остаётся
+            Segment.objects.create(stream=self.stream, start=T0 + timedelta(seconds=number), size=100,
+                                   end=T0 + timedelta(seconds=number + 1), path=str(stuck / f'{number}.ts'))
+        paths = self.add_segments(self.stream, 5, T0 + timedelta(hours=1))
+        self.engine.load_usage()
+        self.assertEqual(self.enforce(300, 300, 0), (300, 3))
+        self.assertEqual(self.remaining(self.stream)[-2:], [str(path) for path in paths[3:]])
+        self.assertEqual(Segment.objects.count(), retention.BATCH_MAX_FILES + 2)
+
+
+class RetentionPolicyTests(RecordsMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.engine = RetentionEngine()
+        patcher = mock.patch.object(retention, 'GB_DIVIDER', 100)  # квоты «в гигабайтах» по 100 байт
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def enforce_policies(self) -> int:
+        self.engine.load_usage()
+        return asyncio.run(self.engine.enforce_policies(list(Stream.objects.select_related('group'))))
+
+    def test_max_age(self):
+        now = timezone.now()
+        old = self.add_segments(self.stream, 3, now - timedelta(days=10))
+        fresh = self.add_segments(self.stream, 2, now - timedelta(days=1))
+        Stream.objects.filter(pk=self.stream.pk).update(max_age_days=7)
+        self.assertEqual(self.enforce_policies(), 3)
+        self.assertEqual(self.remaining(self.stream), [str(path) for path in fresh])
+        self.assertFalse(any(path.exists() for path in old))
+
+    def test_group_max_age_for_streams_without_own(self):
+        group = StreamGroup.objects.create(name='yard', max_age_days=7)
+        Stream.objects.filter(pk=self.stream.pk).update(group=group)
+        own = Stream.objects.create(host='gate', password='secret', group=group, max_age_days=30)
+        now = timezone.now()
+        self.add_segments(self.stream, 2, now - timedelta(days=10))
+        kept = self.add_segments(own, 2, now - timedelta(days=10))
+        self.assertEqual(self.enforce_policies(), 2)
+        self.assertEqual(self.remaining(self.stream), [])
+        self.assertEqual(self.remaining(own), [str(path) for path in kept])
+
+    def test_stream_quota(self):
+        paths = self.add_segments(self.stream, 5, T0)
+        Stream.objects.filter(pk=self.stream.pk).update(max_size_gb=3)
+        self.assertEqual(self.enforce_policies(), 2)
+        self.assertEqual(self.remaining(self.stream), [str(path) for path in paths[2:]])
+        self.assertEqual(self.engine.usage[self.stream.pk], 300)
+        self.assertEqual(self.enforce_policies(), 0)
+
+    def test_group_quota_removes_oldest_across_streams(self):
+        group = StreamGroup.objects.create(name='yard', max_size_gb=4)
+        other = Stream.objects.create(host='gate', password='secret', group=group)
+        Stream.objects.filter(pk=self.stream.pk).update(group=group)
+        first = self.add_segments(self.stream, 3, T0, step=timedelta(minutes=2))
+        second = self.add_segments(other, 3, T0 + timedelta(minutes=1), step=timedelta(minutes=2))
+        self.assertEqual(self.enforce_policies(), 2)
+        self.assertEqual(self.remaining(self.stream), [str(path) for path in first[1:]])
+        self.assertEqual(self.remaining(other), [str(path) for path in second[1:]])
+        self.assertEqual(self.engine.usage[self.stream.pk] + self.engine.usage[other.pk], 400)
+
+    def test_open_segment_over_quota_kept(self):
+        paths = self.add_segments(self.stream, 2, T0, size=300)
+        Segment.objects.filter(path=str(paths[1])).update(end=None)
+        Stream.objects.filter(pk=self.stream.pk).update(max_size_gb=1)
+        self.assertEqual(self.enforce_policies(), 1)
+        self.assertEqual(self.remaining(self.stream), [str(paths[1])])
+
+
+class ExportTests(RecordsMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        override = override_settings(EXPORT_DIR=self.dir / 'exports')
+        override.enable()
+        self.addCleanup(override.disable)
+        self.paths = self.add_segments(self.stream, 3, T0)
+
+    def request(self, fmt: str = 'tar', start: datetime = T0, end: datetime = T0 + timedelta(minutes=3)):
+        return request_export([self.stream], start, end, fmt)
+
+    def finish(self, job: ExportJob, size: int = 10) -> ExportJob:
+        """Задача, выполненная службой: файл результата на месте."""
+        job.result_path.parent.mkdir(parents=True, exist_ok=True)
+        job.result_path.write_bytes(bytes(size))
+        job.status, job.size = 'done', size
+        job.save()
+        return job
+
+    def test_key(self):
+        key = export_key([2, 1, 1], T0, T0 + timedelta(hours=1), 'zip')
+        self.assertEqual(key, export_key([1, 2], T0, T0 + timedelta(hours=1), 'zip'))
+        self.assertNotEqual(key, export_key([1, 2], T0, T0 + timedelta(hours=1), 'tar'))
+        self.assertNotEqual(key, export_key([1], T0, T0 + timedelta(hours=1), 'zip'))
+
+    def test_reuse(self):
+        job, created = self.request()
+        self.assertTrue(created)
+        self.assertEqual(self.request(), (job, False))  # ещё в очереди
+        self.finish(job)
+        self.assertEqual(self.request(), (job, False))  # готовый файл
+        self.assertTrue(self.request('zip')[1])
+
+    def test_no_reuse_without_file_or_for_unfinished_period(self):
+        job = self.finish(self.request()[0])
+        job.result_path.unlink()
+        other, created = self.request()
+        self.assertTrue(created)
+        self.assertNotEqual(other.result_path, job.result_path)
+        live = self.finish(self.request(end=timezone.now() + timedelta(hours=1))[0])
+        self.assertTrue(self.request(end=live.end)[1])  # записи за период ещё появятся
+
+    def test_evict_least_recently_used(self):
+        jobs = [self.finish(self.request(end=T0 + timedelta(minutes=minute))[0], 100) for minute in (1, 2, 3)]
+        for minute, job in zip((3, 1, 2), jobs):
+            ExportJob.objects.filter(pk=job.pk).update(accessed_at=T0 + timedelta(hours=minute))
+        self.assertEqual(evict(150, keep=[jobs[1].pk]), (2, 200))
+        self.assertEqual([ExportJob.objects.get(pk=job.pk).status for job in jobs], ['expired', 'done', 'expired'])
+        self.assertEqual([job.result_path.exists() for job in jobs], [False, True, False])
+        self.assertEqual(evict(150), (0, 0))
+
+    def test_run(self):
+        job = self.request()[0]
+        asyncio.run(Export(job).run())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.bytes_done, job.bytes_total), ('done', job.size, job.size))
+        self.assertFalse(job.result_path.with_name(f'{job.result_path.name}.part').exists())
+        with tarfile.open(job.result_path) as archive:
+            self.assertEqual([member.size for member in archive], [100, 100, 100])
+
+    def test_run_without_records(self):
+        job = self.request(start=T0 + timedelta(days=1), end=T0 + timedelta(days=2))[0]
+        with self.assertRaises(ValueError):
+            asyncio.run(Export(job).run())
+        self.assertFalse(job.result_path.exists())
+
+
+class LogFileTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = self.dir / 'ffmpeg.log'
+
+    def write(self, log, lines: int):
+        for number in range(lines):
+            if log.write(b'[warning] line %03d\n' % number):
+                log.rotate()
+
+    def test_rotation(self):
+        log = RotatingLog(self.path, 100, 2, compress=True)
+        self.addCleanup(log.close)
+        self.write(log, 18)  # строка 18 байт: ротация на каждой шестой
+        self.assertEqual(sorted(path.name for path in self.dir.iterdir()),
+                         ['ffmpeg.log', 'ffmpeg.log.1.gz', 'ffmpeg.log.2.gz'])
+        self.assertEqual(self.path.read_bytes(), b'')
+        self.assertTrue(gzip.decompress((self.dir / 'ffmpeg.log.1.gz').read_bytes()).endswith(b'line 017\n'))
+
+    def test_clear_resets_rotation(self):
+        log = RotatingLog(self.path, 100, 2)
+        self.addCleanup(log.close)
+        self.write(log, 10)
+        (self.dir / 'ffmpeg.log.notes').write_bytes(b'')
+        clear_log(self.path)
+        self.assertEqual(sorted(path.name for path in self.dir.iterdir()), ['ffmpeg.log', 'ffmpeg.log.notes'])
+        self.assertFalse(log.write(b'x' * 99))  # счётчик сверен с очищенным файлом: ротации нет
+        self.assertEqual(self.path.stat().st_size, 99)
+
+    def test_ring_cleared_with_its_dump(self):
+        disk = RotatingLog(self.path)
+        self.addCleanup(disk.close)
+        ring, dump = LogRing(disk, size=3), self.dir / 'ring.log'
+        for line in (b'[info] a\n', b'[error] b\n', b'[info] c\n', b'[info] d\n'):
+            ring.write(line)
+        self.assertEqual(self.path.read_bytes(), b'[error] b\n')
+        ring.dump(dump)
+        self.assertEqual(dump.read_bytes(), b'[error] b\n[info] c\n[info] d\n')
+        clear_log(dump)
+        ring.dump(dump)
+        self.assertEqual(dump.read_bytes(), b'')
+        ring.write(b'[info] e\n')
+        ring.dump(dump)
+        self.assertEqual(dump.read_bytes(), b'[info] e\n')
+
+
+    def test_write_lines(self):
+        log = RotatingLog(self.path, 100, 2)
+        self.addCleanup(log.close)
+        log.write_lines([b'[warning] line %03d\n' % number for number in range(8)])
+        self.assertEqual(sorted(path.name for path in self.dir.iterdir()), ['ffmpeg.log', 'ffmpeg.log.1'])
+        self.assertEqual(self.path.read_bytes(), b'[warning] line 006\n[warning] line 007\n')
+
+        ring = LogRing(RotatingLog(self.dir / 'ring.log'), size=2)
+        self.addCleanup(ring.close)
+        ring.write_lines([b'[info] a\n', b'[error] b\n', b'[info] c\n'])
+        self.assertEqual((self.dir / 'ring.log').read_bytes(), b'[error] b\n')
+        self.assertEqual(ring.snapshot(), b'[error] b\n[info] c\n')
+
+    def test_ffmpeg_stderr_batches(self):
+        recorder = StreamRecorder(Stream(pk=1, host='camera'), self.dir)
+        recorder.log = RotatingLog(self.path)
+        self.addCleanup(recorder.log.close)
+
+        async def run():
+            stderr = asyncio.StreamReader()
+            reader = asyncio.create_task(recorder._read_log(stderr))
+            stderr.feed_data(b'[info] a\n[info] b\n[info] c')  # последняя строка ещё не дописана
+            await asyncio.sleep(0.01)
+            self.assertEqual(self.path.read_bytes(), b'')  # пачка копится в памяти
+            await asyncio.sleep(0.1)
+            self.assertEqual(self.path.read_bytes(), b'[info] a\n[info] b\n')  # сброс по таймеру
+            stderr.feed_data(b'\n[info] d\n')
+            stderr.feed_eof()
+            await reader
+
+        with mock.patch('recorder.management.commands.rec_service.LOG_FLUSH_INTERVAL', 0.05):
+            asyncio.run(run())
+        self.assertEqual(self.path.read_bytes(), b'[info] a\n[info] b\n[info] c\n[info] d\n')
+
+
+    def test_json_exception_through_queue(self):
+        output, log_queue = io.StringIO(), SimpleQueue()
+        handler = logging.StreamHandler(output)
+        handler.setFormatter(JsonFormatter())
+        listener = QueueListener(log_queue, handler)
+        test_logger = logging.getLogger('recorder.tests.queue')
+        test_logger.addHandler(LogQueueHandler(log_queue))
+        test_logger.propagate = False
+        self.addCleanup(test_logger.handlers.clear)
+        listener.start()
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            test_logger.error('Ошибка потока %s', 'cam', exc_info=True)
+        listener.stop()
+        entry = json.loads(output.getvalue())
+        self.assertEqual(entry['message'], 'Ошибка потока cam')
+        self.assertIn('ZeroDivisionError', entry['exc'])
+
+class LogTailTests(TempDirMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = self.dir / 'recording.log'
+        self.path.write_bytes(b''.join(b'line %03d\n' % number for number in range(100)))  # по 9 байт
+
+    def test_tail_and_paging(self):
+        tail = read_tail(self.path, lines=3)
+        self.assertEqual(tail, {'text': 'line 097\nline 098\nline 099\n', 'start': 873, 'end': 900, 'size': 900})
+        page = read_tail(self.path, lines=2, before=tail['start'])
+        self.assertEqual((page['text'], page['start'], page['end']), ('line 095\nline 096\n', 855, 873))
+        self.assertEqual(read_tail(self.path, lines=500)['start'], 0)
+
+    def test_max_bytes_drops_partial_line(self):
+        tail = read_tail(self.path, lines=100, max_bytes=40)
+        self.assertEqual(tail['text'], 'line 096\nline 097\nline 098\nline 099\n')
+
+    def test_read_new(self):
+        data, offset, inode = read_new(self.path, 891, None)
+        self.assertEqual((data, offset), (self.path.read_bytes(), 0))  # другой файл: с начала
+        data, offset, _ = read_new(self.path, 891, inode)
+        self.assertEqual((data, offset), (b'line 099\n', 891))
+        with open(self.path, 'ab') as f:
+            f.write(b'partial')
+        self.assertEqual(read_new(self.path, 900, inode)[0], b'')
+        clear_log(self.path)
+        self.assertEqual(read_new(self.path, 907, inode)[1], 0)  # укорочен — с начала
+
+    def test_view_clamps_bytes(self):
+        user = get_user_model().objects.create_user('admin', password='secret', is_staff=True)
+        self.client.force_login(user)
+        with override_settings(LOGFILE=self.path), mock.patch.object(views, 'LOG_TAIL_MAX_BYTES', 45):
+            # С конца файла читается не больше предела, первая (возможно, неполная) строка отбрасывается
+            for value, lines in (('1000000', 4), ('18', 1), ('0', 200), ('-5', 200)):
+                with self.subTest(bytes=value):
+                    response = self.client.get(reverse('syslog-tail'), {'bytes': value, 'lines': 200})
+                    self.assertEqual(response.json()['text'].count('\n'), min(lines, 100))
+            self.assertEqual(self.client.get(reverse('syslog-tail'), {'bytes': 'x'}).status_code, 400)
+
+
+class RestartDelayTests(SimpleTestCase):
+    def test_backoff_with_jitter(self):
+        with mock.patch('random.uniform', side_effect=lambda low, high: (low, high)):
+            self.assertEqual([_restart_delay(failures) for failures in range(4)], [(0.5, 1), (1, 2), (2, 4), (4, 8)])
+            self.assertEqual(_restart_delay(1000), (RESTART_BACKOFF_MAX / 2, RESTART_BACKOFF_MAX))
+
+
+class IngestStatsTests(SimpleTestCase):
+    def test_progress_block(self):
+        stats = IngestStats()
+        for line in (b'frame=1500\n', b'fps=25.01\n', b'bitrate=4096.0kbits/s\n', b'total_size=N/A\n',
+                     b'out_time_us=60000000\n', b'drop_frames=2\n', b'dup_frames=0\n', b'speed=1.01x\n',
+                     b'garbage\n', b'progress=continue\n'):
+            stats.feed(line)
+        self.assertEqual((stats.frame, stats.fps, stats.bitrate, stats.total_size, stats.out_time, stats.drop_frames,
+                          stats.speed), (1500, 25.01, 4096.0, 0, 60.0, 2, 1.01))
+        self.assertGreater(stats.updated, 0)
+        stats.feed(b'bitrate=N/A\n')
+        self.assertIsNone(stats.bitrate)
+        self.assertEqual(stats.as_dict()['frame'], 1500)
+
+
+MDSTAT = '''Personalities : [raid1] [raid6] [raid5] [raid4]
+md1 : active raid5 sdd1[3] sdc1[1] sdb1[0]
+      3906764800 blocks super 1.2 level 5, 512k chunk, algorithm 2 [3/2] [UU_]
+      [=====>...............]  recovery = 28.3% (553088/1953382400) finish=120.5min speed=150000K/sec
+
+md0 : active raid1 sdb2[0] sda2[1](F)
+      1048512 blocks super 1.2 [2/1] [U_]
+
+unused devices: <none>
+'''
+
+
+class MetricsTests(SimpleTestCase):
+    def test_parse_mdstat(self):
+        md1, md0 = parse_mdstat(MDSTAT)
+        self.assertAlmostEqual(md1.pop('progress'), 0.283)
+        self.assertEqual(md1, {'device': 'md1', 'state': 'active', 'level': 'raid5', 'disks_total': 3,
+                               'disks_active': 2, 'disks_failed': 0, 'action': 'recovery'})
+        self.assertEqual((md0['level'], md0['disks_failed'], md0['disks_active'], md0['action']), ('raid1', 1, 1, None))
+        self.assertEqual(parse_mdstat(''), [])
+
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1))
+        self.assertEqual(histogram.render('latency', 'Задержка', ('view',)), [])
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(('cam "1"',), value)
+        self.assertEqual(histogram.render('latency', 'Задержка', ('view',)), [
+            '# HELP latency Задержка', '# TYPE latency histogram',
+            'latency_bucket{view="cam \\"1\\"",le="0.1"} 2',
+            'latency_bucket{view="cam \\"1\\"",le="1"} 3',
+            'latency_bucket{view="cam \\"1\\"",le="+Inf"} 4',
+            'latency_sum{view="cam \\"1\\""} 3.65',
+            'latency_count{view="cam \\"1\\""} 4',
+        ])
+
+
+class RemuxStderrTests(SimpleTestCase):
+    def test_read_tail_drains_everything(self):
+        async def tail():
+            reader = asyncio.StreamReader()
+            for number in range(1000):
+                reader.feed_data(b'error %04d\n' % number)
+            reader.feed_eof()
+            return await _read_tail(reader, 22), reader.at_eof()
+        self.assertEqual(asyncio.run(tail()), (b'error 0998\nerror 0999\n', True))
+
+
+class RelocationTests(RecordsMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.source, self.target = self.dir / 'old', self.dir / 'new'
+        (self.source / '1').mkdir(parents=True)
+        self.target.mkdir()
+        self.names = []
+        for number in range(5):
+            path = self.source / '1' / f'{number}.ts'
+            path.write_bytes(bytes(100))
+            start = T0 + timedelta(minutes=number)
+            Segment.objects.create(stream=self.stream, start=start, end=start + timedelta(minutes=1), size=100,
+                                   path=str(path))
+            self.names.append(f'1/{number}.ts')
+        (self.source / 'restart.flag').touch()
+        self.task = StorageTask.objects.create(kind='mv', source=str(self.source), target=str(self.target))
+
+    def relocate(self):
+        with self.assertLogs('recorder.storage', 'INFO'):
+            asyncio.run(Relocation(self.task).run())
+        self.task.refresh_from_db()
+
+    def test_run(self):
+        self.relocate()
+        self.assertEqual((self.task.status, self.task.files_done, self.task.bytes_done), ('done', 5, 500))
+        self.assertEqual(self.remaining(self.stream), [str(self.target / name) for name in self.names])
+        self.assertTrue(all((self.target / name).exists() for name in self.names))
+        self.assertFalse(self.source.exists())
+        self.assertFalse((self.target / 'restart.flag').exists())
+
+    def test_progress_counts_every_moved_file(self):
+        (self.source / '1' / 'ffmpeg.log').write_bytes(bytes(30))  # не сегмент, но тоже переносится
+        self.relocate()
+        self.assertEqual((self.task.files_done, self.task.bytes_done), (6, 530))
+        self.assertEqual((self.task.files_total, self.task.bytes_total), (6, 530))
+        self.assertEqual(self.task.percent, 100)
+
+    def test_resume_after_crash_repoints_moved_files(self):
+        self.task.status, self.task.files_total, self.task.bytes_total = 'running', 5, 500
+        self.task.save()
+        (self.target / '1').mkdir()
+        (self.source / self.names[0]).rename(self.target / self.names[0])  # перенесён, индекс не обновлён
+        self.relocate()
+        self.assertEqual((self.task.status, self.task.files_done, self.task.files_total), ('done', 5, 5))
+        self.assertEqual(self.remaining(self.stream), [str(self.target / name) for name in self.names])
+
+
+class DeletionTests(RecordsMixin, TransactionTestCase):
+    def test_run_updates_retention_usage(self):
+        other = Stream.objects.create(host='gate', password='secret')
+        source = self.dir / 'old'
+        for stream, count in ((self.stream, 3), (other, 2)):
+            (source / str(stream.pk)).mkdir(parents=True)
+            for number in range(count):
+                path = source / str(stream.pk) / f'{number}.ts'
+                path.write_bytes(bytes(100))
+                Segment.objects.create(stream=stream, start=T0, end=T0, size=100, path=str(path))
+        kept = self.add_segments(self.stream, 1, T0)
+        engine = RetentionEngine()
+        engine.load_usage()
+        task = StorageTask.objects.create(kind='rm', source=str(source))
+        with self.assertLogs('recorder.storage', 'INFO'):
+            asyncio.run(Deletion(task, retention=engine).run())
+        task.refresh_from_db()
+        self.assertEqual(task.status, 'done')
+        self.assertFalse(source.exists())
+        self.assertEqual(self.remaining(self.stream), [str(path) for path in kept])
+        self.assertEqual((engine.usage[self.stream.pk], engine.usage[other.pk]), (100, 0))
+
+
+class ReconcileTests(RecordsMixin, TransactionTestCase):
+    """Command.restart: запускаются новые потоки, перезапускаются изменившиеся, остальные пишут дальше."""
+    def setUp(self):
+        super().setUp()
+        self.command = Command()
+        self.command._wakeup = asyncio.Event()
+        self.started, self.stopped = [], []
+
+        async def start(recorder: StreamRecorder) -> bool:
+            self.command.recorders[recorder.stream.pk] = recorder
+            recorder.watcher = mock.Mock(done=lambda: False)  # «ffmpeg работает»
+            self.started.append(recorder.stream.pk)
+            return True
+
+        async def stop(pk: int):
+            self.command.recorders.pop(pk)
+            self.stopped.append(pk)
+
+        self.command._start_recorder, self.command._stop_recorder = start, stop
+        patcher = mock.patch.object(StreamRecorder, 'configure_log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def restart(self):
+        self.started.clear()
+        self.stopped.clear()
+        with self.assertLogs('recorder.management.commands.rec_service', 'INFO'):
+            asyncio.run(self.command.restart())
+
+    def test_diff(self):
+        changed, removed = (Stream.objects.create(host=host, password='secret') for host in ('changed', 'removed'))
+        removed_pk = removed.pk
+        self.restart()
+        self.assertEqual(sorted(self.started), sorted([self.stream.pk, changed.pk, removed_pk]))
+        kept = self.command.recorders[self.stream.pk]
+
+        Stream.objects.filter(pk=changed.pk).update(host='changed.local')
+        Stream.objects.filter(pk=self.stream.pk).update(log_mode='ring')  # лог меняется без перезапуска
+        removed.delete()
+        added = Stream.objects.create(host='added', password='secret')
+        self.restart()
+        self.assertEqual(sorted(self.stopped), sorted([changed.pk, removed_pk]))
+        self.assertEqual(sorted(self.started), sorted([changed.pk, added.pk]))
+        self.assertIs(self.command.recorders[self.stream.pk], kept)
+        self.assertEqual(kept.stream.log_mode, 'ring')
+        self.assertEqual(set(self.command.recorders), {self.stream.pk, changed.pk, added.pk})
+
+        self.restart()
+        self.assertEqual((self.started, self.stopped), ([], []))
+
+    def test_dead_recorder_restarted(self):
+        self.restart()
+        self.command.recorders[self.stream.pk].watcher = mock.Mock(done=lambda: True)  # _watch сдался
+        self.restart()
+        self.assertEqual((self.started, self.stopped), ([self.stream.pk], [self.stream.pk]))
+
+
+class SegmentIndexTests(RecordsMixin, TransactionTestCase):
+    """Индекс сегментов записи: список ffmpeg, обход каталога и закрытие после завершения процесса."""
+    def setUp(self):
+        super().setUp()
+        self.closed = []
+        self.recorder = StreamRecorder(self.stream, self.dir / 'video',
+                                       lambda pk, path, size: self.closed.append((Path(path).name, size)))
+
+    def segment(self, name: str, size: int = 100) -> Path:
+        path = self.recorder.out_dir / name
+        path.write_bytes(bytes(size))
+        return path
+
+    def rows(self) -> List[tuple]:
+        return [(Path(path).name, size, end and end - start)
+                for path, size, start, end in self.stream.segments.order_by('start').values_list(
+                    'path', 'size', 'start', 'end')]
+
+    def read_list(self, *lines: bytes):
+        async def read():
+            reader = asyncio.StreamReader()
+            for line in lines:
+                reader.feed_data(line)
+            reader.feed_eof()
+            await self.recorder._read_segment_list(reader)
+        asyncio.run(read())
+
+    def test_segment_list(self):
+        self.segment('2024-01-01_00-00-00.ts', 100)
+        self.segment('2024-01-01_00-01-00.ts', 200)
+        self.read_list(b'2024-01-01_00-00-00.ts,0.000000,60.040000\n',
+                       b'garbage\n', b'2024-01-01_00-00-30.ts,start,end\n',  # не строки списка
+                       b'2024-01-01_00-02-00.ts,120.0,180.0\n',  # файла нет: удалён раньше
+                       b'"2024-01-01_00-01-00.ts",60.040000,119.5\n')
+        self.assertEqual(self.rows(), [('2024-01-01_00-00-00.ts', 100, timedelta(seconds=60.04)),
+                                       ('2024-01-01_00-01-00.ts', 200, timedelta(seconds=59.46))])
+        self.assertEqual(self.closed, [('2024-01-01_00-00-00.ts', 100), ('2024-01-01_00-01-00.ts', 200)])
+
+    def test_finish_after_directory_scan(self):
+        self.recorder.process = mock.Mock()  # ffmpeg работает: новые файлы — записываемые
+        self.segment('2024-01-01_00-00-00.ts')
+        self.recorder.index_segments()
+        self.assertEqual(self.rows(), [('2024-01-01_00-00-00.ts', 0, None)])
+        self.recorder.finish_segment('2024-01-01_00-00-00.ts', 60)
+        self.recorder.finish_segment('2024-01-01_00-00-00.ts', 60)  # повтор строки списка
+        self.recorder.index_segments()
+        self.assertEqual(self.rows(), [('2024-01-01_00-00-00.ts', 100, timedelta(seconds=60))])
+        self.assertEqual(self.closed, [('2024-01-01_00-00-00.ts', 100)])
+
+    def test_scan_without_process_closes_by_stat(self):
+        self.segment('2024-01-01_00-00-00.ts')
+        self.recorder.index_segments()
+        self.recorder.finish_segment('2024-01-01_00-00-00.ts', 60)  # уже закрыт по stat: не учитывается дважды
+        self.assertEqual(len(self.closed), 1)
+        self.assertIsNotNone(self.rows()[0][2])
+
+    def test_only_newer_than_last_segment(self):
+        self.recorder.process = mock.Mock()
+        Segment.objects.create(stream=self.stream, start=T0, end=T0, size=1,
+                               path=str(self.recorder.out_dir / '2024-01-01_00-05-00.ts'))
+        self.recorder.add_segments(['2024-01-01_00-04-00.ts', '2024-01-01_00-06-00.ts', 'notes.ts'])
+        self.assertEqual(self.recorder.last_segment_name, '2024-01-01_00-06-00.ts')  # «notes» не сегмент
+        self.recorder.add_segments(['2024-01-01_00-06-00.ts', '2024-01-01_00-07-00.ts'])
+        names = [row[0] for row in self.rows()]
+        self.assertEqual(names, ['2024-01-01_00-05-00.ts', '2024-01-01_00-06-00.ts', '2024-01-01_00-07-00.ts'])
+
+    def test_close_open_segments_after_exit(self):
+        self.recorder.process = mock.Mock()
+        written = self.segment('2024-01-01_00-00-00.ts', 150)
+        self.recorder.add_segments([written.name, '2024-01-01_00-01-00.ts'])  # второго файла уже нет
+        self.recorder.process = None
+        self.recorder.close_open_segments()
+        self.assertEqual([(name, size) for name, size, _duration in self.rows()], [(written.name, 150)])
+        self.assertIsNotNone(self.rows()[0][2])
+        self.assertEqual(self.closed, [(written.name, 150)])
+
+
+class StallTests(TempDirMixin, SimpleTestCase):
+    """Обнаружение ffmpeg, который жив, но не записывает новых данных."""
+    def setUp(self):
+        super().setUp()
+        self.recorder = StreamRecorder(Stream(pk=1, host='camera'), self.dir)
+        self.recorder.process = mock.Mock(pid=1, returncode=None)
+        self.now = 1000.0
+        patcher = mock.patch('recorder.management.commands.rec_service.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def progress(self, total_size: int, out_time_us: int):
+        for line in (f'total_size={total_size}\n', f'out_time_us={out_time_us}\n', 'progress=continue\n'):
+            self.recorder.stats.feed(line.encode())
+
+    def test_progress_feed_without_data(self):
+        self.progress(4096, 2000000)
+        self.assertFalse(self.recorder.is_stalled(30))
+        for _ in range(4):  # вход замёрз: блоки -progress идут, объём не растёт
+            self.now += 10
+            self.progress(4096, 2000000)
+        self.assertTrue(self.recorder.is_stalled(30))
+        self.progress(8192, 2500000)
+        self.assertFalse(self.recorder.is_stalled(30))
+
+    def test_marker_change_resets_timer(self):
+        self.progress(4096, 2000000)
+        self.assertFalse(self.recorder.is_stalled(30))
+        self.now += 20
+        self.progress(8192, 2500000)
+        self.assertFalse(self.recorder.is_stalled(30))
+        self.now += 20  # 40 с от первой метки, но только 20 с от последней
+        self.assertFalse(self.recorder.is_stalled(30))
+        self.now += 10
+        self.assertTrue(self.recorder.is_stalled(30))
+
+    def test_exited_process_is_not_stalled(self):
+        self.progress(4096, 2000000)
+        self.assertFalse(self.recorder.is_stalled(30))
+        self.now += 60
+        self.recorder.process.returncode = 1
+        self.assertFalse(self.recorder.is_stalled(30))
+        self.recorder.process = None
+        self.assertFalse(self.recorder.is_stalled(30))
+
+    def test_fallback_to_last_segment_size(self):
+        self.recorder.out_dir.mkdir()
+        segment = self.recorder.out_dir / '2024-01-01_00-00-00.ts'
+        segment.write_bytes(bytes(100))
+        self.recorder.last_segment_name = segment.name
+        self.assertFalse(self.recorder.is_stalled(30))
+        self.now += 20
+        segment.write_bytes(bytes(200))
+        self.assertFalse(self.recorder.is_stalled(30))
+        self.now += 30
+        self.assertTrue(self.recorder.is_stalled(30))
+        self.recorder.last_segment_name = '2024-01-01_00-01-00.ts'  # новый файл ещё не создан
+        self.assertFalse(self.recorder.is_stalled(30))
+
+    def test_restart_stalled(self):
+        process = self.recorder.process
+        process.wait = mock.AsyncMock(return_value=-15)
+        with self.assertLogs('recorder.management.commands.rec_service', 'WARNING'):
+            asyncio.run(self.recorder.restart_stalled())
+        process.terminate.assert_called_once_with()
+        process.kill.assert_not_called()
+
+        process.wait = mock.AsyncMock(side_effect=asyncio.TimeoutError)  # не завершился по SIGTERM
+        with self.assertLogs('recorder.management.commands.rec_service', 'WARNING'):
+            asyncio.run(self.recorder.restart_stalled())
+        process.kill.assert_called_once_with()
+
+        process.returncode = 0
+        asyncio.run(self.recorder.restart_stalled())
+        self.assertEqual(process.terminate.call_count, 2)
+
+    def test_watchdog_restarts_only_stalled(self):
+        command = Command()
+        command.system_settings = mock.Mock(stall_timeout=30)
+        command.recorders = {pk: mock.Mock(is_stalled=mock.Mock(return_value=stalled), restart_stalled=mock.AsyncMock())
+                             for pk, stalled in ((1, True), (2, False))}
+        sleeps = []
+
+        async def sleep(delay):
+            sleeps.append(delay)
+            if len(sleeps) > 1:
+                raise asyncio.CancelledError
+
+        async def run():
+            with mock.patch('recorder.management.commands.rec_service.asyncio.sleep', sleep):
+                with self.assertRaises(asyncio.CancelledError):
+                    await command.stall_watchdog()
+            await asyncio.gather(*command._background)
+
+        asyncio.run(run())
+        command.recorders[1].is_stalled.assert_called_once_with(30)
+        command.recorders[1].restart_stalled.assert_awaited_once_with()
+        command.recorders[2].restart_stalled.assert_not_called()
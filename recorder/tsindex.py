@@ -0,0 +1,332 @@
+"""Индекс кадров MPEG-TS: PTS и смещения пакетов видеопотока, файл-спутник .idx рядом с сегментом.
+
+По индексу экспорт обрезается по времени простым копированием байт. Служба записи
+строит его сразу после закрытия сегмента; для сегментов без спутника веб-процесс
+сканирует файл сам, а у записываемого сегмента — только дописанные пакеты. С NumPy сетка 188-байтных пакетов разбирается векторно,
+без него — циклом Python по началам PES.
+"""
+import mmap
+import os
+import re
+import struct
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .status import write_atomic
+
+TS_PACKET = 188
+TS_SYNC = 0x47
+PTS_CLOCK = 90000  # PTS считается в тиках 90 кГц
+PTS_WRAP = 1 << 33
+INDEX_CACHE_SIZE = 64  # индексов файлов в памяти веб-процесса
+SIDECAR_SUFFIX = '.idx'
+
+# Типы видеопотоков в PMT: MPEG-1/2, MPEG-4 Part 2, H.264, H.265
+VIDEO_STREAM_TYPES = frozenset({0x01, 0x02, 0x10, 0x1b, 0x24})
+
+# Файл-спутник: заголовок (метка, версия, размер сегмента, смещения PAT и PMT), затем записи
+SIDECAR_MAGIC = b'TSIX'
+SIDECAR_VERSION = 1
+SIDECAR_HEADER = struct.Struct('<4sB3xqqq')
+SIDECAR_ENTRY = struct.Struct('<qQB')  # PTS, смещение пакета, ключевой кадр
+SIDECAR_DTYPE = np.dtype([('pts', '<i8'), ('offset', '<u8'), ('key', 'u1')]) if np else None
+
+# Второй байт пакета с флагом payload_unit_start_indicator (бит 0x40)
+_UNIT_START = re.compile(rb'[\x40-\x7f\xc0-\xff]')
+
+
+class TsIndex:
+    """Начала кадров видеопотока одного файла.
+
+    pts, offsets, keys — все кадры по порядку; key_times и key_offsets — ключевые
+    кадры, время в секундах от первого из них (с него начинается файл сегмента).
+    tables — смещения пакетов PAT и PMT: их нужно отдать перед данными, начатыми
+    с середины файла, иначе плеер не узнает состав потоков до следующего повтора таблиц.
+    """
+    __slots__ = ('pts', 'offsets', 'keys', 'tables', 'key_times', 'key_offsets')
+
+    def __init__(self, pts, offsets, keys, tables: Tuple[int, ...]):
+        self.pts = pts
+        self.offsets = offsets
+        self.keys = keys
+        self.tables = tables
+        if np is not None and isinstance(keys, np.ndarray):
+            key_pts, self.key_offsets = pts[keys].tolist(), offsets[keys].tolist()
+        else:
+            key_pts = [p for p, key in zip(pts, keys) if key]
+            self.key_offsets = [offset for offset, key in zip(offsets, keys) if key]
+        first = key_pts[0] if key_pts else 0
+        self.key_times = [((p - first) % PTS_WRAP) / PTS_CLOCK for p in key_pts]
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def offset_before(self, seconds: float) -> Optional[int]:
+        """Смещение последнего ключевого кадра не позже seconds (None — такого нет)."""
+        index = bisect_right(self.key_times, seconds) - 1
+        return self.key_offsets[index] if index >= 0 else None
+
+    def offset_after(self, seconds: float) -> Optional[int]:
+        """Смещение первого ключевого кадра не раньше seconds (None — такого нет)."""
+        index = bisect_left(self.key_times, seconds)
+        return self.key_offsets[index] if index < len(self.key_offsets) else None
+
+
+EMPTY_INDEX = TsIndex((), (), (), ())
+
+
+def _sync_offset(data) -> int:
+    """Начало сетки пакетов: первый байт 0x47, за которым через 188 байт снова 0x47."""
+    for offset in range(min(TS_PACKET, len(data))):
+        if data[offset] == TS_SYNC and (offset + TS_PACKET >= len(data) or data[offset + TS_PACKET] == TS_SYNC):
+            return offset
+    return -1
+
+
+def _pid(data, offset: int) -> int:
+    return (data[offset + 1] & 0x1f) << 8 | data[offset + 2]
+
+
+def _payload(data, offset: int) -> Tuple[int, bool]:
+    """Начало полезной нагрузки пакета и флаг random_access_indicator из адаптационного поля."""
+    control = (data[offset + 3] >> 4) & 0x3
+    start = offset + 4
+    random_access = False
+    if control & 0x2:
+        length = data[start]
+        random_access = length > 0 and bool(data[start + 1] & 0x40)
+        start += 1 + length
+    return start, random_access
+
+
+def _section(data, offset: int) -> Tuple[int, int]:
+    """Начало PSI-секции в пакете с payload_unit_start (после pointer_field) и конец её данных без CRC."""
+    start, _ = _payload(data, offset)
+    section = start + 1 + data[start]
+    return section, section + 3 + ((data[section + 1] & 0x0f) << 8 | data[section + 2]) - 4
+
+
+def _pmt_pid(data, offset: int) -> Optional[int]:
+    """PID таблицы PMT первой программы из PAT (нулевой номер программы — сетевая информация)."""
+    section, end = _section(data, offset)
+    for entry in range(section + 8, end, 4):
+        if data[entry] << 8 | data[entry + 1]:
+            return (data[entry + 2] & 0x1f) << 8 | data[entry + 3]
+    return None
+
+
+def _video_pid(data, offset: int) -> Optional[int]:
+    """PID первого видеопотока из PMT."""
+    section, end = _section(data, offset)
+    entry = section + 12 + ((data[section + 10] & 0x0f) << 8 | data[section + 11])
+    while entry + 5 <= end:
+        if data[entry] in VIDEO_STREAM_TYPES:
+            return (data[entry + 1] & 0x1f) << 8 | data[entry + 2]
+        entry += 5 + ((data[entry + 3] & 0x0f) << 8 | data[entry + 4])
+    return None
+
+
+def _pes_pts(data, start: int, packet_end: int) -> Optional[int]:
+    """PTS из заголовка PES, если заголовок целиком в этом пакете."""
+    if start + 14 > packet_end or data[start:start + 3] != b'\x00\x00\x01' or not data[start + 7] & 0x80:
+        return None
+    p = data[start + 9:start + 14]
+    return (((p[0] >> 1) & 0x07) << 30 | p[1] << 22 | (p[2] >> 1) << 15 | p[3] << 7 | p[4] >> 1)
+
+
+def _scan_python(data, base: int, count: int) -> TsIndex:
+    """Просматривает только пакеты с payload_unit_start_indicator: их находит регулярное
+    выражение по срезу вторых байт всех пакетов, поэтому цикл идёт по кадрам, а не по пакетам."""
+    second_bytes = data[base + 1:base + count * TS_PACKET:TS_PACKET]
+    pat = pmt = pmt_pid = video = None
+    pts, offsets, keys = [], [], []
+    for match in _UNIT_START.finditer(second_bytes):
+        offset = base + match.start() * TS_PACKET
+        pid = _pid(data, offset)
+        if pid == 0 and pat is None:
+            pat, pmt_pid = offset, _pmt_pid(data, offset)
+        elif pid == pmt_pid and video is None:
+            pmt, video = offset, _video_pid(data, offset)
+        elif pid == video:
+            start, random_access = _payload(data, offset)
+            value = _pes_pts(data, start, offset + TS_PACKET)
+            if value is not None:
+                pts.append(value)
+                offsets.append(offset)
+                keys.append(random_access)
+    return TsIndex(pts, offsets, keys, (pat, pmt) if video is not None else ())
+
+
+def _scan_numpy(data, base: int, count: int) -> TsIndex:
+    """То же над всей сеткой пакетов сразу: заголовки, адаптационные поля и PTS разбираются векторно."""
+    packets = np.frombuffer(data, np.uint8, count * TS_PACKET, base).reshape(count, TS_PACKET)
+    starts = np.flatnonzero(packets[:, 1] & 0x40)
+    pids = (packets[starts, 1].astype(np.int32) & 0x1f) << 8 | packets[starts, 2]
+    pat_rows = starts[pids == 0]
+    if not len(pat_rows):
+        return EMPTY_INDEX
+    pat = base + int(pat_rows[0]) * TS_PACKET
+    pmt_pid = _pmt_pid(data, pat)
+    pmt_rows = starts[(pids == pmt_pid) & (starts > pat_rows[0])]
+    if pmt_pid is None or not len(pmt_rows):
+        return EMPTY_INDEX
+    pmt = base + int(pmt_rows[0]) * TS_PACKET
+    video = _video_pid(data, pmt)
+    if video is None:
+        return EMPTY_INDEX
+    rows = starts[(pids == video) & (starts > pmt_rows[0])]
+    heads = packets[rows]
+    has_adaptation = (heads[:, 3] & 0x20) != 0
+    keys = has_adaptation & (heads[:, 4] > 0) & ((heads[:, 5] & 0x40) != 0)
+    payload = 4 + np.where(has_adaptation, heads[:, 4].astype(np.int64) + 1, 0)
+    valid = payload + 14 <= TS_PACKET
+    pes = np.take_along_axis(heads, np.minimum(payload, TS_PACKET - 14)[:, None] + np.arange(14), axis=1)
+    pes = pes.astype(np.int64)
+    valid &= (pes[:, 0] == 0) & (pes[:, 1] == 0) & (pes[:, 2] == 1) & ((pes[:, 7] & 0x80) != 0)
+    pts = (((pes[:, 9] >> 1) & 0x07) << 30 | pes[:, 10] << 22 | (pes[:, 11] >> 1) << 15
+           | pes[:, 12] << 7 | pes[:, 13] >> 1)
+    return TsIndex(pts[valid], base + rows[valid].astype(np.int64) * TS_PACKET, keys[valid], (pat, pmt))
+
+
+def scan(data) -> TsIndex:
+    """Индекс по содержимому файла MPEG-TS (bytes или mmap)."""
+    base = _sync_offset(data)
+    if base < 0:
+        return EMPTY_INDEX
+    count = (len(data) - base) // TS_PACKET
+    return (_scan_numpy if np is not None else _scan_python)(data, base, count)
+
+
+def scan_file(path: str, size: int) -> TsIndex:
+    if not size:
+        return EMPTY_INDEX
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+        return scan(data)
+
+
+def sidecar_path(path: str) -> str:
+    return path + SIDECAR_SUFFIX
+
+
+def _pack(index: TsIndex, size: int) -> bytes:
+    pat, pmt = index.tables or (-1, -1)
+    header = SIDECAR_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION, size, pat, pmt)
+    if np is not None:
+        entries = np.empty(len(index), SIDECAR_DTYPE)
+        entries['pts'], entries['offset'], entries['key'] = index.pts, index.offsets, index.keys
+        return header + entries.tobytes()
+    return header + b''.join(SIDECAR_ENTRY.pack(*entry) for entry in zip(index.pts, index.offsets, index.keys))
+
+
+def _unpack(data: bytes, size: int) -> Optional[TsIndex]:
+    """Индекс из файла-спутника; None — спутник от другой версии файла или повреждён."""
+    if len(data) < SIDECAR_HEADER.size:
+        return None
+    magic, version, indexed_size, pat, pmt = SIDECAR_HEADER.unpack_from(data)
+    body = memoryview(data)[SIDECAR_HEADER.size:]
+    if magic != SIDECAR_MAGIC or version != SIDECAR_VERSION or indexed_size != size or len(body) % SIDECAR_ENTRY.size:
+        return None
+    tables = (pat, pmt) if pat >= 0 else ()
+    if np is not None:
+        entries = np.frombuffer(body, SIDECAR_DTYPE)
+        return TsIndex(entries['pts'], entries['offset'], entries['key'].astype(bool), tables)
+    pts, offsets, keys = [], [], []
+    for value, offset, key in SIDECAR_ENTRY.iter_unpack(body):
+        pts.append(value)
+        offsets.append(offset)
+        keys.append(bool(key))
+    return TsIndex(pts, offsets, keys, tables)
+
+
+def write_sidecar(path: str) -> Optional[int]:
+    """Строит индекс закрытого сегмента и сохраняет рядом. Возвращает число кадров, None — файла нет."""
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+    index = scan_file(path, size)
+    write_atomic(Path(sidecar_path(path)), _pack(index, size))
+    return len(index)
+
+
+def _join(first, second):
+    if np is not None and isinstance(first, np.ndarray) and isinstance(second, np.ndarray):
+        return np.concatenate((first, second))
+    return list(first) + list(second)
+
+
+def _scan_appended(path: str, index: TsIndex, start: int, size: int) -> Optional[TsIndex]:
+    """Дополняет индекс кадрами из байт [start, size), дописанных в файл после прошлого сканирования.
+
+    Перед новыми данными подставляются пакеты PAT и PMT из начала файла: так scan() узнаёт
+    видеопоток, не перечитывая файл. None — таблиц в нужном месте нет, файл надо сканировать заново.
+    """
+    pat, pmt = index.tables
+    with open(path, 'rb') as f:
+        f.seek(pat)
+        head = f.read(TS_PACKET)
+        f.seek(pmt)
+        head += f.read(TS_PACKET)
+        f.seek(start)
+        data = f.read(size - start)
+    appended = scan(head + data)
+    if appended.tables != (0, TS_PACKET):
+        return None
+    shift = start - 2 * TS_PACKET
+    offsets = appended.offsets + shift if np is not None and isinstance(appended.offsets, np.ndarray) \
+        else [offset + shift for offset in appended.offsets]
+    return TsIndex(_join(index.pts, appended.pts), _join(index.offsets, offsets), _join(index.keys, appended.keys),
+                   index.tables)
+
+
+# Индексы файлов, которые ещё пишутся: путь -> (конец просканированной сетки пакетов, индекс)
+_growing = {}
+
+
+def _scan_growing(path: str, size: int) -> TsIndex:
+    """Индекс файла без спутника. Открытый сегмент растёт, и при каждом изменении
+    сканируются только дописанные пакеты, а не весь файл заново."""
+    known = _growing.pop(path, None)
+    index = None
+    if known is not None and known[0] <= size:
+        scanned, index = known
+        if size - scanned >= TS_PACKET:
+            index = _scan_appended(path, index, scanned, size)
+    if index is None:
+        index = scan_file(path, size)
+    if index.tables:
+        pat = index.tables[0]
+        _growing[path] = (size - (size - pat) % TS_PACKET, index)
+        while len(_growing) > INDEX_CACHE_SIZE:
+            del _growing[next(iter(_growing))]
+    return index
+
+
+@lru_cache(maxsize=INDEX_CACHE_SIZE)
+def _load(path: str, size: int, mtime_ns: int) -> TsIndex:
+    try:
+        with open(sidecar_path(path), 'rb') as f:
+            index = _unpack(f.read(), size)
+    except FileNotFoundError:
+        index = None
+    if index is not None:
+        _growing.pop(path, None)
+        return index
+    return _scan_growing(path, size)
+
+
+def load_index(path: str) -> Optional[TsIndex]:
+    """Индекс файла: из спутника, если он построен для текущего размера, иначе сканированием.
+    Повторно файл читается только после его изменения. None — файла нет."""
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return _load(path, stat_result.st_size, stat_result.st_mtime_ns)
@@ -1,15 +1,34 @@
 from django.urls import path
 from . import views
+from .metrics import timed
 
 urlpatterns = [
     path('', views.SystemMonitorView.as_view(), name='system-monitor'),
     path('storage-status/', views.storage_status_view, name='storage-status'),
-    path('stream/<int:pk>/', views.StreamArchiveFormView.as_view(), name='stream-archive'),
+    path('stream/<int:pk>/', timed('stream-archive')(views.StreamArchiveFormView.as_view()), name='stream-archive'),
+    path('stream/<int:pk>/download/', timed('stream-archive-download')(views.archive_download),
+         name='stream-archive-download'),
+    path('export/', timed('archive-export')(views.ArchiveExportFormView.as_view()), name='archive-export'),
+    path('export/download/', timed('archive-export-download')(views.archive_export), name='archive-export-download'),
+    path('export/<int:pk>/', views.ExportJobView.as_view(), name='export-job'),
+    path('export/<int:pk>/download/', timed('export-job-download')(views.export_job_download),
+         name='export-job-download'),
+    path('stream/<int:pk>/player/', views.ArchivePlayerView.as_view(), name='stream-archive-player'),
+    path('stream/<int:pk>/live/', views.LivePlayerView.as_view(), name='stream-live'),
+    path('stream/<int:pk>/live/index.m3u8', views.live_playlist, name='live-playlist'),
+    path('stream/<int:pk>/live/<str:name>', views.live_segment, name='live-segment'),
+    path('stream/<int:pk>/hls.m3u8', timed('hls-playlist')(views.hls_playlist), name='hls-playlist'),
+    path('stream/<int:pk>/segment/<int:segment_pk>.ts', timed('hls-segment')(views.hls_segment), name='hls-segment'),
     path('wipe-syslog/', views.wipe_log, name='wipe-syslog'),
     path('stream/<int:pk>/wipe-log/', views.wipe_log, name='wipe-ffmpeg-log'),
+    path('stream/<int:pk>/log/', views.log_tail, name='ffmpeg-log-tail'),
+    path('stream/<int:pk>/log/follow/', views.log_follow, name='ffmpeg-log-follow'),
+    path('log/', views.log_tail, name='syslog-tail'),
+    path('log/follow/', views.log_follow, name='syslog-follow'),
     path('storage/', views.manage_storage, name='manage-storage'),
     path('smart/', views.smart_status_view, name='smart-status'),
     path('stop/', views.stop_recording, name='stop'),
     path('restart/', views.restart_recording, name='restart'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
 handler400 = handler403 = handler404 = handler500 = 'recorder.views.errors'
@@ -1,11 +1,13 @@
 import asyncio
+import hmac
 import os
 import shlex
 import shutil
 import subprocess
 from datetime import datetime, timedelta
+from contextlib import suppress
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 
 import ujson as json
 from django.conf import settings
@@ -18,19 +20,32 @@ from django.http.response import JsonResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse
 from django.utils import timezone
-from django.views.decorators.http import require_POST, require_GET
+from django.utils.http import urlencode
+from django.views.decorators.http import require_POST, require_GET, require_safe
 from django.views.generic import TemplateView, FormView
 
-from .forms import ArchivePeriodForm
-from .models import Stream, System, trigger_restart
+from . import metrics
+from .archive import ArchiveLayout, parse_range, read_parts, read_parts_padded, remux_fmp4
+from .bundle import BUNDLE_FORMATS
+from .exports import EXPORT_CONTENT_TYPES, collect_entries, request_export, stream_layout, touch
+from .forms import ArchiveExportForm, ArchivePeriodForm
+from .logs import LOG_NAME, TAIL_MAX_BYTES, clear_log, read_new, read_tail, ring_path
+from .hls import build_playlist
+from .live import LIVE_PLAYLIST, LIVE_SEGMENT_NAME, live_dir
+from .models import ExportJob, Segment, StorageTask, Stream, System, trigger_restart
+from .status import read_status
 
 # --- Constants ---
 GB_DIVIDER = 1 << 30
-CHUNK_SIZE = 8192
-DATETIME_WIDGET_FORMAT = "%Y-m-%dT%H:%M"
+DATETIME_WIDGET_FORMAT = "%Y-%m-%dT%H:%M"
 SMARTCTL_SCAN_CMD = ["smartctl", "--scan"]
 DRIVER_FALLBACKS = ("auto", "sat", "scsi", "ata", "nvme", "usbjmicron", "usbsunplus")
 IS_WINDOWS = (os.name == 'nt')  # <-- Флаг для определения ОС
+LOG_TAIL_LINES = 200  # строк лога при открытии страницы
+LOG_TAIL_MAX_LINES = 5000
+LOG_TAIL_MAX_BYTES = TAIL_MAX_BYTES  # предел ?bytes=: хвост читается с конца файла, а не весь лог в память
+LOG_FOLLOW_INTERVAL = 1  # секунд между проверками лога при слежении
+LOG_FOLLOW_KEEPALIVE = 15  # секунд между пустыми сообщениями, чтобы прокси не закрыл соединение
 
 
 def staff_member_required(user):
@@ -58,8 +73,10 @@ class SystemMonitorView(StaffRequiredMixin, TemplateView):
             'log_file_path': settings.LOGFILE,
             'disks': self._list_physical_disks(),
             'flag_status': self._get_flag_status(records_dir),
+            'storage_tasks': StorageTask.objects.filter(status__in=StorageTask.ACTIVE_STATUSES + ('failed',))[:10],
+            'export_jobs': ExportJob.objects.exclude(status='expired')[:10],
             'disk_usage': self._get_disk_usage(records_dir),
-            'system_log_content': _get_log_content(settings.LOGFILE)
+            'ingest': self._get_ingest_rows(),
         })
         return context
 
@@ -93,11 +110,18 @@ class SystemMonitorView(StaffRequiredMixin, TemplateView):
     @staticmethod
     def _get_flag_status(records_dir: Path) -> Dict[str, bool]:
         """Проверяет наличие управляющих флагов."""
-        flags = {
-            'is_stopped': 'stop.flag', 'is_restarting': 'restart.flag',
-            'is_removing': 'rm.flag', 'is_moving': 'mv.flag',
-        }
-        return {key: (records_dir / filename).exists() for key, filename in flags.items()}
+        flags = {'is_stopped': 'stop.flag', 'is_restarting': 'restart.flag'}
+        status = {key: (records_dir / filename).exists() for key, filename in flags.items()}
+        active_kinds = set(StorageTask.objects.filter(
+            status__in=StorageTask.ACTIVE_STATUSES).values_list('kind', flat=True))
+        status['is_moving'], status['is_removing'] = 'mv' in active_kinds, 'rm' in active_kinds
+        return status
+
+    @staticmethod
+    def _get_ingest_rows() -> List[Dict[str, Any]]:
+        """Живые метрики потоков из снимка службы записи."""
+        streams = read_status().get('streams', {})
+        return sorted(({'pk': int(pk), **info} for pk, info in streams.items()), key=lambda row: row['pk'])
 
     @staticmethod
     def _get_disk_usage(path: Path) -> Dict[str, Any]:
@@ -115,14 +139,78 @@ class SystemMonitorView(StaffRequiredMixin, TemplateView):
             return {'error': f"Ошибка при расчете места на диске: {e}"}
 
 
-def _get_log_content(log_path: Path, error_msg: str = "Лог-файл не найден.") -> str:
-    """Читает содержимое лог-файла."""
+def _stream_log_path(stream: Stream) -> Path:
+    """Лог ffmpeg потока; в режиме буфера в памяти — его последний сброс (в файле только предупреждения)."""
+    return ring_path(stream.pk) if stream.log_mode == 'ring' else stream.record_path / LOG_NAME
+
+
+def _log_path(pk: Optional[int]) -> Path:
+    return settings.LOGFILE if pk is None else _stream_log_path(get_object_or_404(Stream, pk=pk))
+
+
+def _int_param(value: Optional[str]) -> Optional[int]:
+    return None if value in (None, '') else int(value)
+
+
+@require_GET
+@user_passes_test(staff_member_required)
+def log_tail(request, pk: int = None):
+    """Последние строки системного лога или лога ffmpeg; ?before=<смещение> листает назад."""
+    try:
+        lines = min(max(_int_param(request.GET.get('lines')) or LOG_TAIL_LINES, 1), LOG_TAIL_MAX_LINES)
+        before = _int_param(request.GET.get('before'))
+        max_bytes = min(max(_int_param(request.GET.get('bytes')) or 0, 0), LOG_TAIL_MAX_BYTES)
+    except ValueError:
+        return HttpResponseBadRequest("Параметры lines, before и bytes должны быть числами.")
+    kwargs = {'lines': LOG_TAIL_MAX_LINES, 'max_bytes': max_bytes} if max_bytes else {'lines': lines}
     try:
-        return log_path.read_text(encoding='UTF-8', errors='ignore')
+        return JsonResponse(read_tail(_log_path(pk), before=before, **kwargs))
     except FileNotFoundError:
-        return error_msg
-    except Exception as e:
-        return f"Ошибка чтения лог-файла: {e}"
+        return JsonResponse({'text': '', 'start': 0, 'end': 0, 'size': 0, 'missing': True})
+
+
+async def _follow_log(path: Path, offset: Optional[int]):
+    """Server-Sent Events с новыми строками лога; id события — смещение в файле."""
+    inode = None
+    with suppress(OSError):
+        stat_result = await asyncio.to_thread(os.stat, path)
+        inode = stat_result.st_ino
+        if offset is None or offset > stat_result.st_size:
+            offset = stat_result.st_size
+    offset = offset or 0
+    idle = 0
+    while True:
+        try:
+            data, start, inode_now = await asyncio.to_thread(read_new, path, offset, inode)
+        except FileNotFoundError:
+            data, start, inode_now = b'', 0, None
+        if start != offset or inode_now != inode:
+            yield 'event: rotate\ndata: \n\n'  # файл заменён или очищен: клиент начинает заново
+        inode, offset = inode_now, start + len(data)
+        if data:
+            text = data.decode('UTF-8', 'replace').replace('\r', '').rstrip('\n')
+            yield f'id: {offset}\n' + ''.join(f'data: {line}\n' for line in text.split('\n')) + '\n'
+            idle = 0
+            continue
+        await asyncio.sleep(LOG_FOLLOW_INTERVAL)
+        idle += LOG_FOLLOW_INTERVAL
+        if idle >= LOG_FOLLOW_KEEPALIVE:
+            idle = 0
+            yield ': keepalive\n\n'
+
+
+@require_GET
+@user_passes_test(staff_member_required)
+def log_follow(request, pk: int = None):
+    """Слежение за логом (SSE). При переподключении продолжает с Last-Event-ID."""
+    try:
+        offset = _int_param(request.headers.get('Last-Event-ID') or request.GET.get('from'))
+    except ValueError:
+        return HttpResponseBadRequest("Некорректное смещение.")
+    response = StreamingHttpResponse(_follow_log(_log_path(pk), offset), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 
 def _run_powershell_command(command: str) -> subprocess.CompletedProcess:
@@ -204,6 +292,19 @@ def storage_status_view(request):
 
 
 # --- Функциональные представления ---
+@require_GET
+def metrics_view(request):
+    """Метрики для Prometheus: по токену METRICS_TOKEN или для персонала."""
+    token = settings.METRICS_TOKEN
+    if token:
+        scheme, _, supplied = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(supplied.encode(), token.encode()):
+            return HttpResponse("Требуется токен метрик.", status=401, content_type="text/plain; charset=utf-8")
+    elif not staff_member_required(request.user):
+        return HttpResponse("Доступ запрещён.", status=403, content_type="text/plain; charset=utf-8")
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @require_POST
 @user_passes_test(staff_member_required)
 def manage_storage(request):
@@ -293,36 +394,6 @@ class StreamArchiveFormView(StaffRequiredMixin, FormView):
     template_name = 'recorder/archive_form.html'
     form_class = ArchivePeriodForm
 
-    @staticmethod
-    async def _stream_content_generator(files: List[Path]):
-        for file_path in files:
-            async with await asyncio.to_thread(open, file_path, 'rb') as f:
-                while True:
-                    chunk = await asyncio.to_thread(f.read, CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    yield chunk
-
-    def post(self, request, *args, **kwargs):
-        stream = get_object_or_404(Stream, pk=self.kwargs['pk'])
-        start_str = request.POST.get('start')
-        end_str = request.POST.get('end')
-        if not start_str or not end_str:
-            return HttpResponseBadRequest("Поля 'start' и 'end' обязательны.")
-        try:
-            start_dt = timezone.make_aware(datetime.strptime(start_str, DATETIME_WIDGET_FORMAT))
-            end_dt = timezone.make_aware(datetime.strptime(end_str, DATETIME_WIDGET_FORMAT))
-        except (ValueError, TypeError):
-            return HttpResponseBadRequest("Неверный формат даты/времени.")
-        files_to_stream = stream.find_files_in_range(start_dt, end_dt)
-        if not files_to_stream:
-            return HttpResponse("За указанный период записи не найдены.", status=404,
-                                content_type="text/plain; charset=utf-8")
-        response = StreamingHttpResponse(self._stream_content_generator(files_to_stream), content_type='video/mp2t')
-        filename = f"{stream.host}_{stream.login}_{start_dt:%Y%m%d-%H%M}_{end_dt:%Y%m%d-%H%M}.{settings.SEGMENT_FORMAT}"
-        response['Content-Disposition'] = f'attachment;filename="{filename}"'
-        return response
-
     def setup(self, request, *args, **kwargs):
         """Получаем объект stream до всех остальных методов."""
         super().setup(request, *args, **kwargs)
@@ -339,15 +410,13 @@ class StreamArchiveFormView(StaffRequiredMixin, FormView):
 
     def get_context_data(self, **kwargs) -> Dict[str, Any]:
         context = super().get_context_data(**kwargs)
-        ffmpeg_log_path = self.stream.record_path / 'ffmpeg.log'
         context.update({
             'stream': self.stream,
             'title': str(self.stream),
-            'log_file_path': ffmpeg_log_path,
-            'ffmpeg_log_content': _get_log_content(
-                ffmpeg_log_path, "Лог-файл ffmpeg не найден."
-            ),
-            'segments': self.stream.record_path.glob(f'*.{settings.SEGMENT_FORMAT}'),
+            'log_file_path': _stream_log_path(self.stream),
+            'segments': self.stream.segments.order_by('start'),
+            'hls_available': settings.SEGMENT_FORMAT == 'ts',
+            'relay_url': self.stream.relay_url(self.request.get_host().rsplit(':', 1)[0]),
         })
         return context
 
@@ -356,21 +425,320 @@ class StreamArchiveFormView(StaffRequiredMixin, FormView):
         start_str = form.cleaned_data['start'].strftime(DATETIME_WIDGET_FORMAT)
         end_str = form.cleaned_data['end'].strftime(DATETIME_WIDGET_FORMAT)
 
-        download_url = reverse('stream-archive', kwargs={'pk': self.stream.pk})
-        return HttpResponseRedirect(f"{download_url}?start={start_str}&end={end_str}")
+        params = {'start': start_str, 'end': end_str}
+        if self.request.POST.get('action') == 'queue':
+            job, _created = request_export([self.stream], form.cleaned_data['start'], form.cleaned_data['end'],
+                                           form.cleaned_data['format'], self.request.user)
+            return HttpResponseRedirect(job.get_absolute_url())
+        if self.request.POST.get('action') == 'watch':
+            player_url = reverse('stream-archive-player', kwargs={'pk': self.stream.pk})
+            return HttpResponseRedirect(f"{player_url}?{urlencode(params)}")
+        if form.cleaned_data['format'] != 'raw':
+            params['format'] = form.cleaned_data['format']
+        download_url = reverse('stream-archive-download', kwargs={'pk': self.stream.pk})
+        return HttpResponseRedirect(f"{download_url}?{urlencode(params)}")
+
+
+def _get_period(request) -> Tuple[datetime, datetime]:
+    """Период из параметров start и end в формате поля datetime-local. ValueError — с текстом для ответа 400."""
+    start_str, end_str = request.GET.get('start'), request.GET.get('end')
+    if not start_str or not end_str:
+        raise ValueError("Параметры 'start' и 'end' обязательны.")
+    try:
+        return (timezone.make_aware(datetime.strptime(start_str, DATETIME_WIDGET_FORMAT)),
+                timezone.make_aware(datetime.strptime(end_str, DATETIME_WIDGET_FORMAT)))
+    except ValueError:
+        raise ValueError("Неверный формат даты/времени.") from None
+
+
+def _ranged_response(request, layout: ArchiveLayout, content_type: str) -> HttpResponse:
+    """Ответ с телом из частей файлов: длина, ETag и один диапазон Range (If-Range учитывается)."""
+    byte_range = None
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if range_header and (if_range is None or if_range == layout.etag):
+        try:
+            byte_range = parse_range(range_header, layout.length)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{layout.length}'
+            return response
+    start, end = byte_range or (0, layout.length)
+
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type, status=206 if byte_range else 200)
+    else:
+        response = StreamingHttpResponse(read_parts_padded(layout.parts(start, end)), content_type=content_type,
+                                         status=206 if byte_range else 200)
+    if byte_range:
+        response['Content-Range'] = f'bytes {start}-{end - 1}/{layout.length}'
+    response['Content-Length'] = end - start
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = layout.etag
+    return response
+
+
+@require_safe
+@user_passes_test(staff_member_required)
+def archive_download(request, pk: int):
+    """Отдаёт записи за период одним файлом, обрезанным по ключевым кадрам.
+
+    Как записано — с длиной, ETag и докачкой по Range; format=mp4 — фрагментированный MP4,
+    перепакованный на лету (длина заранее неизвестна, докачки нет).
+    """
+    stream = get_object_or_404(Stream, pk=pk)
+    try:
+        start_dt, end_dt = _get_period(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    export_format = request.GET.get('format', 'raw')
+    if export_format not in ('raw', 'mp4'):
+        return HttpResponseBadRequest("Неизвестный формат выгрузки.")
+    layout = stream_layout(stream, start_dt, end_dt)
+    if not layout.length:
+        return HttpResponse("За указанный период записи не найдены.", status=404,
+                            content_type="text/plain; charset=utf-8")
+    filename = f"{stream.host}_{stream.login}_{start_dt:%Y%m%d-%H%M}_{end_dt:%Y%m%d-%H%M}"
+
+    if export_format == 'mp4':
+        if request.method == 'HEAD':
+            response = HttpResponse(content_type='video/mp4')
+        else:
+            input_format = 'mpegts' if settings.SEGMENT_FORMAT == 'ts' else None
+            response = StreamingHttpResponse(remux_fmp4(read_parts(layout.parts()), input_format),
+                                             content_type='video/mp4')
+        response['Accept-Ranges'] = 'none'
+        response['Content-Disposition'] = f'attachment;filename="{filename}.mp4"'
+        return response
+
+    response = _ranged_response(request, layout, 'video/mp2t')
+    if response.status_code != 416:
+        response['Content-Disposition'] = f'attachment;filename="{filename}.{settings.SEGMENT_FORMAT}"'
+    return response
+
+
+class ArchiveExportFormView(StaffRequiredMixin, FormView):
+    """Выгрузка одного периода сразу с нескольких камер одним архивом."""
+    template_name = 'recorder/archive_export.html'
+    form_class = ArchiveExportForm
+
+    def get_initial(self) -> Dict[str, Any]:
+        """Камеры — из параметров stream (действие в списке потоков), период — вчера-завтра."""
+        today_start = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+        return {
+            'streams': self.request.GET.getlist('stream'),
+            'start': (today_start - timedelta(days=1)).strftime(DATETIME_WIDGET_FORMAT),
+            'end': (today_start + timedelta(days=1)).strftime(DATETIME_WIDGET_FORMAT),
+        }
+
+    def get_context_data(self, **kwargs) -> Dict[str, Any]:
+        context = super().get_context_data(**kwargs)
+        context['title'] = "Выгрузка архива нескольких камер"
+        return context
+
+    def form_valid(self, form) -> HttpResponseRedirect:
+        if self.request.POST.get('action') == 'queue':
+            job, _created = request_export(list(form.cleaned_data['streams']), form.cleaned_data['start'],
+                                           form.cleaned_data['end'], form.cleaned_data['format'], self.request.user)
+            return HttpResponseRedirect(job.get_absolute_url())
+        params = [('stream', stream.pk) for stream in form.cleaned_data['streams']]
+        params += [
+            ('start', form.cleaned_data['start'].strftime(DATETIME_WIDGET_FORMAT)),
+            ('end', form.cleaned_data['end'].strftime(DATETIME_WIDGET_FORMAT)),
+            ('format', form.cleaned_data['format']),
+        ]
+        return HttpResponseRedirect(f"{reverse('archive-export-download')}?{urlencode(params)}")
+
+
+@require_safe
+@user_passes_test(staff_member_required)
+def archive_export(request):
+    """Отдаёт записи нескольких камер за период одним архивом ZIP или TAR без сжатия.
+
+    Каталог на камеру, файл на сегмент (крайние обрезаны по ключевым кадрам).
+    Длина архива известна заранее, данные читаются по мере отправки.
+    """
+    try:
+        start_dt, end_dt = _get_period(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    bundle_class = BUNDLE_FORMATS.get(request.GET.get('format', 'zip'))
+    if bundle_class is None:
+        return HttpResponseBadRequest("Неизвестный формат выгрузки.")
+    try:
+        stream_pks = [int(pk) for pk in request.GET.getlist('stream')]
+    except ValueError:
+        return HttpResponseBadRequest("Неверный номер потока.")
+    streams = list(Stream.objects.filter(pk__in=stream_pks).order_by('pk'))
+    if not streams:
+        return HttpResponseBadRequest("Не выбраны камеры.")
+
+    entries = collect_entries(streams, start_dt, end_dt)
+    if not entries:
+        return HttpResponse("За указанный период записи не найдены.", status=404,
+                            content_type="text/plain; charset=utf-8")
+    bundle = bundle_class(entries)
+
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=bundle.content_type)
+    else:
+        response = StreamingHttpResponse(bundle.stream(), content_type=bundle.content_type)
+    response['Content-Length'] = bundle.length
+    response['Accept-Ranges'] = 'none'
+    filename = f"archive_{start_dt:%Y%m%d-%H%M}_{end_dt:%Y%m%d-%H%M}.{bundle.extension}"
+    response['Content-Disposition'] = f'attachment;filename="{filename}"'
+    return response
+
+
+class ExportJobView(StaffRequiredMixin, TemplateView):
+    """Состояние фоновой выгрузки; пока она идёт, страница обновляется сама."""
+    template_name = 'recorder/export_job.html'
+
+    def get_context_data(self, **kwargs) -> Dict[str, Any]:
+        context = super().get_context_data(**kwargs)
+        job = get_object_or_404(ExportJob, pk=self.kwargs['pk'])
+        context.update({
+            'job': job,
+            'title': f"Выгрузка архива: {job}",
+            'streams': job.streams.all(),
+            'active': job.status in ExportJob.ACTIVE_STATUSES,
+        })
+        return context
+
+
+@require_safe
+@user_passes_test(staff_member_required)
+def export_job_download(request, pk: int):
+    """Отдаёт готовую выгрузку из кэша с докачкой по Range."""
+    job = get_object_or_404(ExportJob, pk=pk)
+    try:
+        size = job.result_path.stat().st_size if job.status == 'done' else None
+    except FileNotFoundError:
+        size = None
+    if size is None:
+        return HttpResponse("Выгрузка не готова или удалена из кэша: запросите её снова.", status=404,
+                            content_type="text/plain; charset=utf-8")
+    touch(job)
+    response = _ranged_response(request, ArchiveLayout([(str(job.result_path), 0, size)]),
+                                EXPORT_CONTENT_TYPES[job.format])
+    if response.status_code != 416:
+        response['Content-Disposition'] = f'attachment;filename="{job.filename}"'
+    return response
+
+
+@require_safe
+@user_passes_test(staff_member_required)
+def hls_playlist(request, pk: int):
+    """Плейлист HLS VOD за период: части сегментов по ключевым кадрам, ссылающиеся на файлы диапазонами байт."""
+    stream = get_object_or_404(Stream, pk=pk)
+    if settings.SEGMENT_FORMAT != 'ts':
+        return HttpResponse("Просмотр доступен только для записей MPEG-TS.", status=404,
+                            content_type="text/plain; charset=utf-8")
+    try:
+        start_dt, end_dt = _get_period(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    segments = stream.segments_in_range(start_dt, end_dt).values_list('pk', 'path', 'size', 'start', 'end')
+    playlist = build_playlist(
+        segments, start_dt, end_dt, lambda segment_pk: reverse('hls-segment', args=(pk, segment_pk)))
+    if playlist is None:
+        return HttpResponse("За указанный период записи не найдены.", status=404,
+                            content_type="text/plain; charset=utf-8")
+    response = HttpResponse(playlist, content_type='application/vnd.apple.mpegurl')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@require_safe
+@user_passes_test(staff_member_required)
+def hls_segment(request, pk: int, segment_pk: int):
+    """Файл сегмента для плеера: части плейлиста запрашиваются диапазонами Range."""
+    segment = get_object_or_404(Segment, pk=segment_pk, stream_id=pk)
+    try:
+        size = os.stat(segment.path).st_size  # записываемый сегмент растёт: размер из индекса ещё неизвестен
+    except FileNotFoundError:
+        return HttpResponse("Файл сегмента не найден.", status=404, content_type="text/plain; charset=utf-8")
+    return _ranged_response(request, ArchiveLayout([(segment.path, 0, size)]), 'video/mp2t')
+
+
+@require_safe
+@user_passes_test(staff_member_required)
+def live_playlist(request, pk: int):
+    """Плейлист живого просмотра, который пишет ffmpeg службы записи."""
+    try:
+        playlist = (live_dir(pk) / LIVE_PLAYLIST).read_bytes()
+    except FileNotFoundError:
+        return HttpResponse("Живой просмотр недоступен: поток не записывается или просмотр выключен.", status=404,
+                            content_type="text/plain; charset=utf-8")
+    response = HttpResponse(playlist, content_type='application/vnd.apple.mpegurl')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@require_safe
+@user_passes_test(staff_member_required)
+def live_segment(request, pk: int, name: str):
+    """Часть живого просмотра из кольца в памяти."""
+    if not LIVE_SEGMENT_NAME.fullmatch(name):
+        return HttpResponseBadRequest("Неверное имя части.")
+    path = live_dir(pk) / name
+    try:
+        size = path.stat().st_size
+    except FileNotFoundError:
+        return HttpResponse("Часть уже удалена.", status=404, content_type="text/plain; charset=utf-8")
+    return _ranged_response(request, ArchiveLayout([(str(path), 0, size)]), 'video/mp2t')
+
+
+class ArchivePlayerView(StaffRequiredMixin, TemplateView):
+    """Просмотр записей за период в браузере (HLS, hls.js там, где нет встроенной поддержки)."""
+    template_name = 'recorder/archive_player.html'
+
+    def get_context_data(self, **kwargs) -> Dict[str, Any]:
+        context = super().get_context_data(**kwargs)
+        stream = get_object_or_404(Stream, pk=self.kwargs['pk'])
+        playlist_url = reverse('hls-playlist', kwargs={'pk': stream.pk})
+        context.update({
+            'stream': stream,
+            'title': str(stream),
+            'playlist_url': f"{playlist_url}?{urlencode({key: self.request.GET.get(key, '') for key in ('start', 'end')})}",
+            'start': self.request.GET.get('start', ''),
+            'end': self.request.GET.get('end', ''),
+        })
+        return context
+
+
+class LivePlayerView(StaffRequiredMixin, TemplateView):
+    """Живой просмотр в браузере: плеер тот же, что у архива."""
+    template_name = 'recorder/archive_player.html'
+
+    def get_context_data(self, **kwargs) -> Dict[str, Any]:
+        context = super().get_context_data(**kwargs)
+        stream = get_object_or_404(Stream, pk=self.kwargs['pk'])
+        context.update({
+            'stream': stream,
+            'title': str(stream),
+            'playlist_url': reverse('live-playlist', kwargs={'pk': stream.pk}),
+            'live': True,
+        })
+        return context
 
 
 @require_POST
 @user_passes_test(staff_member_required)
 def wipe_log(request, pk: int = None):
-    """Очищает системный лог или лог ffmpeg для потока."""
+    """Очищает системный лог или лог ffmpeg для потока вместе с ротированными копиями.
+
+    В режиме буфера в памяти очищается и его сброс: служба записи заметит это и очистит буфер.
+    """
     if pk:
-        log_path = get_object_or_404(Stream, pk=pk).record_path / 'ffmpeg.log'
+        log_path = get_object_or_404(Stream, pk=pk).record_path / LOG_NAME
         redirect_url = reverse('stream-archive', kwargs={'pk': pk})
+        if ring_path(pk).exists():
+            clear_log(ring_path(pk))
     else:
         log_path = settings.LOGFILE
         redirect_url = reverse('system-monitor')
-    log_path.open('wb').close()
+    clear_log(log_path)
     messages.success(request, f"Лог-файл '{log_path.name}' очищен.")
     return redirect(request.META.get('HTTP_REFERER', redirect_url))
 